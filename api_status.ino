@@ -25,7 +25,7 @@
  const char* password    = "xxxxxxxxxxxxxxxxxxx";
  const char* mqtt_server = "192.168.50.233";
  const int mqtt_port     = 1883;
- const char* mqtt_topic  = "api_status"; // MQTT主题
+ const char* mqtt_topic  = "api_status/snapshot"; // MQTT主题：所有服务商的紧凑汇总（retained）
  
  // 屏幕绘制相关
  #define SCREEN_WIDTH 135
@@ -57,34 +57,8 @@
  // 时间跟踪
  unsigned long lastRebootTime = 0;
  
- // MQTT回调函数
- void callback(char* topic, byte* payload, unsigned int length) {
-   String message;
-   for (unsigned int i = 0; i < length; i++) {
-     message += (char)payload[i];
-   }
- 
-   Serial.print("Message arrived [");
-   Serial.print(topic);
-   Serial.print("] ");
-   Serial.println(message);
-   // 解析JSON
-   StaticJsonDocument<512> doc;
- 
-   // 解析JSON值
-   DeserializationError deserial_error = deserializeJson(doc, message);
-   if (deserial_error) {
-     Serial.print("JSON Parsing Error: ");
-     Serial.println(deserial_error.c_str());
-     return;
-   }
- 
-   String provider = doc["provider"].as<String>();
-   bool online = doc["online"].as<bool>();
-   float response_time = doc["response_time"].as<float>();
-   String error_msg = doc["error"].as<String>();
-   unsigned long timestamp = doc["timestamp"].as<unsigned long>();
- 
+ // 更新单个服务商的状态，时间戳变了才往历史曲线里追加一个点
+ void applyStatus(String provider, bool online, float response_time, String error_msg, unsigned long timestamp) {
    Serial.print("Provider: ");
    Serial.println(provider);
    Serial.print("Online: ");
@@ -99,57 +73,101 @@
      deepseek.online = online;
      deepseek.response_time = response_time;
      deepseek.error = error_msg;
-     deepseek.timestamp = timestamp;
  
-     // 更新 deepseek_history
-     for (int i = 0; i < CURVE_HISTORY - 1; i++) {
-       deepseek_history[i] = deepseek_history[i + 1];
+     // 更新 deepseek_history（快照里没变化的服务商不追加）
+     if (timestamp != deepseek.timestamp) {
+       for (int i = 0; i < CURVE_HISTORY - 1; i++) {
+         deepseek_history[i] = deepseek_history[i + 1];
+       }
+       deepseek_history[CURVE_HISTORY - 1] = response_time;
      }
-     deepseek_history[CURVE_HISTORY - 1] = response_time;
+     deepseek.timestamp = timestamp;
    } else if (provider == "siliconflow") {
      siliconflow.online = online;
      siliconflow.response_time = response_time;
      siliconflow.error = error_msg;
-     siliconflow.timestamp = timestamp;
  
-     // 更新 siliconflow_history
-     for (int i = 0; i < CURVE_HISTORY - 1; i++) {
-       siliconflow_history[i] = siliconflow_history[i + 1];
+     // 更新 siliconflow_history（快照里没变化的服务商不追加）
+     if (timestamp != siliconflow.timestamp) {
+       for (int i = 0; i < CURVE_HISTORY - 1; i++) {
+         siliconflow_history[i] = siliconflow_history[i + 1];
+       }
+       siliconflow_history[CURVE_HISTORY - 1] = response_time;
      }
-     siliconflow_history[CURVE_HISTORY - 1] = response_time;
+     siliconflow.timestamp = timestamp;
    } else if (provider == "huoshan") {
      huoshan.online = online;
      huoshan.response_time = response_time;
      huoshan.error = error_msg;
-     huoshan.timestamp = timestamp;
  
-     // 更新 huoshan_history
-     for (int i = 0; i < CURVE_HISTORY - 1; i++) {
-       huoshan_history[i] = huoshan_history[i + 1];
+     // 更新 huoshan_history（快照里没变化的服务商不追加）
+     if (timestamp != huoshan.timestamp) {
+       for (int i = 0; i < CURVE_HISTORY - 1; i++) {
+         huoshan_history[i] = huoshan_history[i + 1];
+       }
+       huoshan_history[CURVE_HISTORY - 1] = response_time;
      }
-     huoshan_history[CURVE_HISTORY - 1] = response_time;
+     huoshan.timestamp = timestamp;
    } else if (provider == "tencent") { // 华为更新逻辑
      tencent.online = online;
      tencent.response_time = response_time;
      tencent.error = error_msg;
-     tencent.timestamp = timestamp;
  
-     // 更新 tencent_history
-     for (int i = 0; i < CURVE_HISTORY - 1; i++) {
-       tencent_history[i] = tencent_history[i + 1];
+     // 更新 tencent_history（快照里没变化的服务商不追加）
+     if (timestamp != tencent.timestamp) {
+       for (int i = 0; i < CURVE_HISTORY - 1; i++) {
+         tencent_history[i] = tencent_history[i + 1];
+       }
+       tencent_history[CURVE_HISTORY - 1] = response_time;
      }
-     tencent_history[CURVE_HISTORY - 1] = response_time;
+     tencent.timestamp = timestamp;
    } else if (provider == "bailian") { // Bailian 更新逻辑
      bailian.online = online;
      bailian.response_time = response_time;
      bailian.error = error_msg;
-     bailian.timestamp = timestamp;
  
-     // 更新 bailian_history
-     for (int i = 0; i < CURVE_HISTORY -1; i++) {
-       bailian_history[i] = bailian_history[i+1];
+     // 更新 bailian_history（快照里没变化的服务商不追加）
+     if (timestamp != bailian.timestamp) {
+       for (int i = 0; i < CURVE_HISTORY -1; i++) {
+         bailian_history[i] = bailian_history[i+1];
+       }
+       bailian_history[CURVE_HISTORY -1] = response_time;
      }
-     bailian_history[CURVE_HISTORY -1] = response_time;
+     bailian.timestamp = timestamp;
+   }
+ }
+ 
+ // MQTT回调函数
+ // 快照格式：{"p":{"deepseek":[1,812,1739154861],"tencent":[0,-1,1739154794,"API error: 500"]}}
+ // 每项依次是 是否在线、响应时间（毫秒，未知为 -1）、时间戳、离线时的错误信息
+ void callback(char* topic, byte* payload, unsigned int length) {
+   Serial.print("Message arrived [");
+   Serial.print(topic);
+   Serial.print("] ");
+   Serial.write(payload, length);
+   Serial.println();
+   // 解析JSON
+   StaticJsonDocument<1024> doc;
+ 
+   // 解析JSON值
+   DeserializationError deserial_error = deserializeJson(doc, payload, length);
+   if (deserial_error) {
+     Serial.print("JSON Parsing Error: ");
+     Serial.println(deserial_error.c_str());
+     return;
+   }
+ 
+   JsonObject providers = doc["p"].as<JsonObject>();
+   for (JsonPair item : providers) {
+     JsonArray values = item.value().as<JsonArray>();
+     float response_time = values[1].as<float>();
+     applyStatus(
+       String(item.key().c_str()),
+       values[0].as<int>() == 1,
+       response_time < 0 ? 0 : response_time,
+       values.size() > 3 ? values[3].as<String>() : String(""),
+       values[2].as<unsigned long>()
+     );
    }
  }
  
@@ -187,6 +205,7 @@
    // 初始化MQTT客户端
    client.setServer(mqtt_server, mqtt_port);
    client.setCallback(callback);
+   client.setBufferSize(1024); // 默认 256 字节放不下汇总快照
  
    // 初始化上次重启时间
    lastRebootTime = millis();
@@ -0,0 +1 @@
+"""网关和监控服务的性能测试脚本，用 python -m benchmark.<模块名> 运行"""
@@ -0,0 +1,76 @@
+"""对比网关请求体/响应体处理的 CPU 开销
+
+旧流程：request.json() 解析 -> 复制字典改 model -> httpx 用 json= 重新编码，
+        响应 aread() -> json.loads -> JSONResponse 重新编码
+新流程：请求体只解析一次，model 在字节上改写；响应字节原样透传
+
+运行：python -m benchmark.body_codec
+"""
+import json
+import time
+from typing import Callable
+
+from gateway import RequestPayload
+
+SIZES = [10_000, 100_000, 1_000_000]  # 提示词字符数
+ROUNDS = 50
+
+
+def make_request(chars: int) -> bytes:
+    # 多条消息混合中英文，接近真实的大上下文请求
+    chunk = "请帮我总结下面这段日志 the quick brown fox jumps over the lazy dog. "
+    messages = []
+    per_message = max(1, chars // 20)
+    while sum(len(m["content"]) for m in messages) < chars:
+        messages.append({"role": "user", "content": (chunk * (per_message // len(chunk) + 1))[:per_message]})
+    body = {"model": "deepseek-chat", "messages": messages, "temperature": 0.7, "stream": False}
+    return json.dumps(body, ensure_ascii=False).encode("utf-8")
+
+
+def make_response(chars: int) -> bytes:
+    body = {
+        "id": "chatcmpl-bench",
+        "object": "chat.completion",
+        "model": "deepseek-v3",
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": "好" * chars}, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": chars // 4, "completion_tokens": chars, "total_tokens": chars + chars // 4}
+    }
+    return json.dumps(body, ensure_ascii=False).encode("utf-8")
+
+
+def old_path(raw: bytes, upstream: bytes) -> bytes:
+    original_body = json.loads(raw)
+    modified_body = original_body.copy()
+    modified_body["model"] = "deepseek-v3"
+    json.dumps(modified_body).encode("utf-8")  # httpx 的 json= 参数
+    # JSONResponse.render
+    return json.dumps(json.loads(upstream), ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+
+
+def new_path(raw: bytes, upstream: bytes) -> bytes:
+    payload = RequestPayload(raw)
+    payload.for_model("deepseek-v3")
+    return upstream
+
+
+def measure(fn: Callable[[bytes, bytes], bytes], raw: bytes, upstream: bytes) -> float:
+    """每次请求的 CPU 时间（微秒）"""
+    fn(raw, upstream)
+    start = time.process_time()
+    for _ in range(ROUNDS):
+        fn(raw, upstream)
+    return (time.process_time() - start) / ROUNDS * 1e6
+
+
+def main():
+    print(f"{'prompt chars':>12} {'request KB':>10} {'old us':>10} {'new us':>10} {'saved us':>10} {'saved %':>8}")
+    for chars in SIZES:
+        raw = make_request(chars)
+        upstream = make_response(max(1000, chars // 10))
+        old = measure(old_path, raw, upstream)
+        new = measure(new_path, raw, upstream)
+        print(f"{chars:>12} {len(raw) / 1024:>10.1f} {old:>10.0f} {new:>10.0f} {old - new:>10.0f} {(old - new) / old * 100:>7.1f}%")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""对比 /api_status 落库方式的写入速度（行/秒）
+
+旧方式：每个 HTTP 请求一条 INSERT
+新方式：StatusIngestor 写缓冲，按批用 read_json 整批导入
+
+使用临时数据库文件，不会动 mqtt_status.duckdb。需要在仓库根目录运行：
+python -m benchmark.ingest
+"""
+import asyncio
+import os
+import random
+import tempfile
+import time
+
+ROWS = 20_000
+PROVIDERS = ["deepseek", "siliconflow", "huoshan", "tencent", "bailian"]
+
+tmpdir = tempfile.mkdtemp(prefix="ingest_bench_")
+os.environ["MQTT_STATUS_DB"] = os.path.join(tmpdir, "bench.duckdb")
+
+import server  # noqa: E402  需要先设置数据库路径
+from server import Status, StatusIngestor, db  # noqa: E402
+
+
+def make_statuses(count: int):
+    now = int(time.time())
+    return [
+        Status(
+            provider=random.choice(PROVIDERS),
+            online=random.random() > 0.05,
+            response_time=round(random.uniform(500, 20000), 2),
+            error=None,
+            timestamp=now + i
+        )
+        for i in range(count)
+    ]
+
+
+def single_row_inserts(statuses) -> float:
+    start = time.perf_counter()
+    for status in statuses:
+        db.sql(
+            "INSERT INTO api_monitor (provider, online, response_time, error, timestamp) VALUES (?, ?, ?, ?, ?)",
+            params=(status.provider, status.online, status.response_time, status.error, status.timestamp)
+        )
+    return len(statuses) / (time.perf_counter() - start)
+
+
+async def buffered_inserts(statuses) -> float:
+    ingestor = StatusIngestor(db)
+    await ingestor.start()
+    start = time.perf_counter()
+    for status in statuses:
+        await ingestor.put([status])
+    await ingestor.stop()
+    return len(statuses) / (time.perf_counter() - start)
+
+
+def main():
+    statuses = make_statuses(ROWS)
+    print(f"rows: {ROWS}, batch size: {server.INGEST_BATCH_SIZE}")
+    before = single_row_inserts(statuses)
+    print(f"single-row INSERT : {before:>12,.0f} rows/s")
+    after = asyncio.run(buffered_inserts(statuses))
+    print(f"buffered batches  : {after:>12,.0f} rows/s  ({after / before:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,294 @@
+"""网关压测：并发打 /v1/chat/completions，统计 RPS、延迟分位数、首 token 耗时和失败切换次数
+
+失败切换按网关响应头 X-Gateway-Attempts 统计（大于 1 说明换过服务商），
+实际服务的服务商取 X-Gateway-Provider。结果写成 JSON，用 --compare 和之前的结果对比找回归。
+
+直接压已经在跑的网关：
+python -m benchmark.load --requests 1000 --concurrency 50 --stream
+
+--spawn 会先拉起 benchmark.mock_upstream 和一个指向它的网关，不需要任何真实 API key：
+python -m benchmark.load --spawn --requests 1000 --concurrency 50 --compare benchmark/results/上次.json
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from typing import Dict, List, Optional
+
+import httpx
+
+from benchmark.mock_upstream import MOCK_API_KEY_ENV, gateway_providers, load_upstreams
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+READY_TIMEOUT = 30  # 等待拉起的网关完成首轮探测的秒数
+
+# 对比时展示的指标：(名称, 取值路径, 越大越好)
+COMPARE_METRICS = [
+    ("rps", ("rps",), True),
+    ("success %", ("success_rate",), True),
+    ("p50 ms", ("latency_ms", "p50"), False),
+    ("p99 ms", ("latency_ms", "p99"), False),
+    ("ttft p50 ms", ("ttft_ms", "p50"), False),
+    ("ttft p99 ms", ("ttft_ms", "p99"), False),
+    ("failovers", ("failovers",), False),
+]
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    """最近秩法分位数，样本为空返回 None"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, math.ceil(q * len(ordered)) - 1))
+    return round(ordered[index], 1)
+
+
+def distribution(values: List[float]) -> Dict[str, Optional[float]]:
+    return {
+        "p50": percentile(values, 0.5),
+        "p90": percentile(values, 0.9),
+        "p99": percentile(values, 0.99),
+        "max": round(max(values), 1) if values else None,
+        "mean": round(sum(values) / len(values), 1) if values else None
+    }
+
+
+def make_body(prompt_chars: int, stream: bool, model: str) -> bytes:
+    prompt = ("压测请求，请忽略。" * (prompt_chars // 9 + 1))[:prompt_chars]
+    return json.dumps(
+        {"model": model, "messages": [{"role": "user", "content": prompt}], "stream": stream},
+        ensure_ascii=False
+    ).encode("utf-8")
+
+
+async def send(client: httpx.AsyncClient, body: bytes, stream: bool) -> Dict:
+    """发一个请求，记录状态码、总耗时、首 token 耗时和网关标注的服务商"""
+    start = time.perf_counter()
+    record = {"status": 0, "latency": 0.0, "ttft": None, "provider": None, "attempts": 1, "error": None}
+    try:
+        async with client.stream(
+            "POST", "/v1/chat/completions", content=body, headers={"Content-Type": "application/json"}
+        ) as response:
+            record["status"] = response.status_code
+            record["provider"] = response.headers.get("x-gateway-provider")
+            record["attempts"] = int(response.headers.get("x-gateway-attempts", "1"))
+            if stream and response.status_code == 200:
+                async for line in response.aiter_lines():
+                    if record["ttft"] is None and line.startswith("data:") and line.strip() != "data: [DONE]":
+                        record["ttft"] = (time.perf_counter() - start) * 1000
+            else:
+                await response.aread()
+    except httpx.HTTPError as e:
+        record["error"] = f"{type(e).__name__}: {e}"
+    record["latency"] = (time.perf_counter() - start) * 1000
+    return record
+
+
+async def run_load(gateway: str, requests: int, concurrency: int, rate: float, body: bytes, stream: bool,
+                   timeout: float) -> Dict:
+    """rate 为 0 时是闭环压测（concurrency 个 worker 各自连发），否则按 rate 的固定节奏开环发请求"""
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    records: List[Dict] = []
+    async with httpx.AsyncClient(base_url=gateway, timeout=timeout, limits=limits) as client:
+        start = time.perf_counter()
+        if rate > 0:
+            semaphore = asyncio.Semaphore(concurrency)
+
+            async def paced(i: int):
+                await asyncio.sleep(max(0.0, start + i / rate - time.perf_counter()))
+                async with semaphore:
+                    records.append(await send(client, body, stream))
+
+            await asyncio.gather(*(paced(i) for i in range(requests)))
+        else:
+            remaining = iter(range(requests))
+
+            async def worker():
+                for _ in remaining:
+                    records.append(await send(client, body, stream))
+
+            await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+
+        try:
+            gateway_stats = (await client.get("/v1/gateway/stats")).json()
+        except (httpx.HTTPError, ValueError):
+            gateway_stats = None
+
+    ok = [r for r in records if r["status"] == 200]
+    statuses = Counter(str(r["status"]) if r["error"] is None else "transport_error" for r in records)
+    return {
+        "requests": len(records),
+        "ok": len(ok),
+        "elapsed_s": round(elapsed, 2),
+        "rps": round(len(ok) / elapsed, 1) if elapsed else 0.0,
+        "success_rate": round(len(ok) / len(records) * 100, 2) if records else 0.0,
+        "latency_ms": distribution([r["latency"] for r in ok]),
+        "ttft_ms": distribution([r["ttft"] for r in ok if r["ttft"] is not None]),
+        "failovers": sum(1 for r in ok if r["attempts"] > 1),
+        "statuses": dict(statuses),
+        "providers": dict(Counter(r["provider"] for r in ok if r["provider"])),
+        "errors": dict(Counter(r["error"] for r in records if r["error"]).most_common(5)),
+        "gateway_stats": gateway_stats
+    }
+
+
+def print_summary(summary: Dict):
+    print(f"请求 {summary['requests']}，成功 {summary['ok']}（{summary['success_rate']}%），"
+          f"耗时 {summary['elapsed_s']}s，RPS {summary['rps']}，失败切换 {summary['failovers']}")
+    print(f"{'':>12} {'p50':>8} {'p90':>8} {'p99':>8} {'max':>8} {'mean':>8}")
+    for label, key in (("latency ms", "latency_ms"), ("ttft ms", "ttft_ms")):
+        dist = summary[key]
+        if dist["p50"] is None:
+            continue
+        print(f"{label:>12} " + " ".join(f"{dist[k]:>8.1f}" for k in ("p50", "p90", "p99", "max", "mean")))
+    print("状态码：", summary["statuses"])
+    print("服务商：", summary["providers"])
+    if summary["errors"]:
+        print("传输错误：", summary["errors"])
+
+
+def metric(summary: Dict, path) -> Optional[float]:
+    value = summary
+    for key in path:
+        value = value.get(key) if isinstance(value, dict) else None
+    return value
+
+
+def print_compare(previous: Dict, current: Dict):
+    """逐项对比两次结果，变差的指标标 !"""
+    print(f"对比 {previous.get('label')}（{previous.get('time')}）")
+    print(f"{'metric':>12} {'before':>10} {'after':>10} {'change %':>9}")
+    for name, path, higher_is_better in COMPARE_METRICS:
+        before, after = metric(previous["summary"], path), metric(current["summary"], path)
+        if before is None or after is None:
+            continue
+        change = (after - before) / before * 100 if before else 0.0
+        worse = change < 0 if higher_is_better else change > 0
+        flag = " !" if worse and abs(change) >= 5 else ""
+        print(f"{name:>12} {before:>10.1f} {after:>10.1f} {change:>8.1f}%{flag}")
+
+
+def wait_ready(gateway: str, providers: List[str]):
+    """等网关起来并且每个服务商都完成过一次探测，否则全部是离线状态"""
+    deadline = time.time() + READY_TIMEOUT
+    while time.time() < deadline:
+        try:
+            probes = httpx.get(f"{gateway}/v1/gateway/probes", timeout=2).json()["providers"]
+            if all(probes.get(name, {}).get("last_probe") for name in providers):
+                return
+        except (httpx.HTTPError, ValueError, KeyError):
+            pass
+        time.sleep(0.5)
+    raise RuntimeError(f"网关 {gateway} 在 {READY_TIMEOUT}s 内没有就绪")
+
+
+def wait_upstream(url: str):
+    """等假上游开始监听；网关启动时立即探测，上游没起来的话第一次探测就会把服务商判成离线"""
+    deadline = time.time() + READY_TIMEOUT
+    while time.time() < deadline:
+        try:
+            httpx.get(f"{url}/mock/stats", timeout=2).raise_for_status()
+            return
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    raise RuntimeError(f"假上游 {url} 在 {READY_TIMEOUT}s 内没有就绪")
+
+
+def spawn(upstream_config: Optional[str], upstream_port: int, gateway_port: int) -> List[subprocess.Popen]:
+    """拉起假上游和指向它的网关，返回两个子进程"""
+    upstreams = load_upstreams(upstream_config)
+    providers_path = os.path.join(tempfile.mkdtemp(prefix="gateway_bench_"), "providers.json")
+    with open(providers_path, "w", encoding="utf-8") as f:
+        json.dump(gateway_providers(upstreams, f"http://127.0.0.1:{upstream_port}"), f)
+
+    env = dict(os.environ, PROVIDERS_CONFIG=providers_path, **{MOCK_API_KEY_ENV: "bench"})
+    env.pop("GATEWAY_STATUS_URL", None)  # 压测流量不要写进看板
+    upstream_cmd = [sys.executable, "-m", "benchmark.mock_upstream", "--port", str(upstream_port)]
+    if upstream_config:
+        upstream_cmd += ["--config", upstream_config]
+    gateway_cmd = [
+        sys.executable, "-c",
+        "import uvicorn, gateway; "
+        f"uvicorn.run(gateway.OpenAIGateway().app, host='127.0.0.1', port={gateway_port}, log_level='warning')"
+    ]
+    processes = [subprocess.Popen(upstream_cmd, env=env)]
+    try:
+        wait_upstream(f"http://127.0.0.1:{upstream_port}")
+        # 网关的 JSON 日志写在 stdout（失败切换等 WARNING 不采样，压测时很多），丢掉
+        processes.append(subprocess.Popen(gateway_cmd, env=env, stdout=subprocess.DEVNULL))
+        wait_ready(f"http://127.0.0.1:{gateway_port}", [u["name"] for u in upstreams])
+    except Exception:
+        stop(processes)
+        raise
+    return processes
+
+
+def stop(processes: List[subprocess.Popen]):
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="网关压测")
+    parser.add_argument("--gateway", default="http://127.0.0.1:8000")
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--rate", type=float, default=0, help="开环压测的目标 RPS，0 表示闭环")
+    parser.add_argument("--stream", action="store_true", help="发流式请求并统计首 token 耗时")
+    parser.add_argument("--prompt-chars", type=int, default=200)
+    parser.add_argument("--model", default="deepseek-chat")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--label", default="run", help="结果文件名前缀")
+    parser.add_argument("--output", help=f"结果 JSON 路径，默认写到 {RESULTS_DIR}")
+    parser.add_argument("--compare", help="之前的结果 JSON，用来对比")
+    parser.add_argument("--spawn", action="store_true", help="自动拉起假上游和网关")
+    parser.add_argument("--upstreams", help="--spawn 时的假服务商配置，默认 mock_upstream.DEFAULT_UPSTREAMS")
+    parser.add_argument("--upstream-port", type=int, default=9100)
+    parser.add_argument("--gateway-port", type=int, default=8100)
+    args = parser.parse_args()
+
+    processes = []
+    gateway = args.gateway
+    if args.spawn:
+        processes = spawn(args.upstreams, args.upstream_port, args.gateway_port)
+        gateway = f"http://127.0.0.1:{args.gateway_port}"
+    try:
+        body = make_body(args.prompt_chars, args.stream, args.model)
+        summary = asyncio.run(
+            run_load(gateway, args.requests, args.concurrency, args.rate, body, args.stream, args.timeout)
+        )
+    finally:
+        stop(processes)
+
+    result = {
+        "label": args.label,
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "config": {k: v for k, v in vars(args).items() if k not in ("output", "compare")},
+        "summary": summary
+    }
+    print_summary(summary)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            print_compare(json.load(f), result)
+
+    output = args.output or os.path.join(RESULTS_DIR, f"{args.label}-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"结果已写入 {output}")
+
+
+if __name__ == "__main__":
+    main()
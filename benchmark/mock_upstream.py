@@ -0,0 +1,218 @@
+"""本地模拟的 OpenAI 兼容上游，给网关压测用，不花钱也不受真实服务商波动影响
+
+每个假服务商挂在 /p/<name> 下（base_url 填 http://127.0.0.1:9100/p/<name>），
+支持 POST /chat/completions（普通和 SSE 流式）和 GET /models。
+每个服务商可以单独配置：
+
+    latency         首字节前的等待（毫秒），{"dist": "fixed"|"normal"|"lognormal", "median": 300, "sigma": 0.5}
+    error_rate      返回 500 的概率
+    rate_limit_rate 返回 429 的概率，另外超过 max_concurrency 的并发也一律 429
+    retry_after     429 响应里的 Retry-After（秒）
+    chunks          流式响应的 chunk 数
+    chunk_interval  chunk 间隔（毫秒），chunk_jitter 为上下浮动比例
+    stream_abort_rate 流式响应发完响应头后在随机位置（可能一个 chunk 都没发）断开连接的概率
+
+配置是一个 JSON 数组（每项带 name），不给就用 DEFAULT_UPSTREAMS。运行：
+python -m benchmark.mock_upstream --port 9100 --config upstreams.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+from typing import Dict, List, Optional
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+MOCK_API_KEY_ENV = "BENCH_UPSTREAM_KEY"  # 生成给网关的服务商配置统一用这个环境变量取 key
+
+DEFAULT_UPSTREAMS = [
+    {
+        "name": "fast",
+        "latency": {"dist": "lognormal", "median": 200, "sigma": 0.3},
+        "error_rate": 0.01,
+        "chunks": 20,
+        "chunk_interval": 15
+    },
+    {
+        "name": "slow",
+        "latency": {"dist": "lognormal", "median": 800, "sigma": 0.6},
+        "error_rate": 0.02,
+        "chunks": 20,
+        "chunk_interval": 40
+    },
+    {
+        "name": "flaky",
+        "latency": {"dist": "normal", "median": 400, "sigma": 150},
+        "error_rate": 0.2,
+        "chunks": 20,
+        "chunk_interval": 25
+    },
+    {
+        "name": "limited",
+        "latency": {"dist": "fixed", "median": 300},
+        "rate_limit_rate": 0.05,
+        "max_concurrency": 8,
+        "retry_after": 1,
+        "chunks": 20,
+        "chunk_interval": 20
+    }
+]
+
+
+def load_upstreams(path: Optional[str] = None) -> List[Dict]:
+    """读取假服务商配置，path 默认取环境变量 BENCH_UPSTREAMS"""
+    path = path or os.getenv("BENCH_UPSTREAMS")
+    if not path:
+        return DEFAULT_UPSTREAMS
+    with open(path, encoding="utf-8") as f:
+        upstreams = json.load(f)
+    if not isinstance(upstreams, list) or not all(isinstance(u, dict) and "name" in u for u in upstreams):
+        raise ValueError(f"{path} 必须是 JSON 数组，每项至少包含 name")
+    return upstreams
+
+
+def gateway_providers(upstreams: List[Dict], base_url: str) -> List[Dict]:
+    """生成网关用的 PROVIDERS_CONFIG，把每个假服务商指到 base_url/p/<name>"""
+    return [
+        {
+            "name": u["name"],
+            "env_var": MOCK_API_KEY_ENV,
+            "base_url": f"{base_url.rstrip('/')}/p/{u['name']}",
+            "model": f"mock-{u['name']}",
+            **u.get("gateway", {})  # 网关侧的限流、连接池等可选键
+        }
+        for u in upstreams
+    ]
+
+
+def sample_ms(spec: Dict) -> float:
+    """按配置的分布采样一次耗时（毫秒），负数截到 0"""
+    dist = spec.get("dist", "fixed")
+    median = spec.get("median", 0)
+    if dist == "normal":
+        value = random.gauss(median, spec.get("sigma", 0))
+    elif dist == "lognormal":
+        value = median * random.lognormvariate(0, spec.get("sigma", 0.5))
+    else:
+        value = median
+    return max(0.0, value)
+
+
+class MockUpstream:
+    """按配置注入延迟、错误和限流的假上游"""
+
+    def __init__(self, upstreams: List[Dict]):
+        self.upstreams = {u["name"]: u for u in upstreams}
+        self.active: Dict[str, int] = {name: 0 for name in self.upstreams}
+        self.counters: Dict[str, Dict[str, int]] = {
+            name: {"requests": 0, "ok": 0, "errors": 0, "rate_limited": 0, "aborted": 0} for name in self.upstreams
+        }
+        self.app = FastAPI(title="Mock OpenAI Upstream")
+        self.app.add_api_route("/p/{name}/chat/completions", self.chat_completion, methods=["POST"])
+        self.app.add_api_route("/p/{name}/models", self.models, methods=["GET"])
+        self.app.add_api_route("/mock/stats", self.stats, methods=["GET"])
+
+    @staticmethod
+    def error(status_code: int, message: str, headers: Optional[Dict[str, str]] = None):
+        return JSONResponse(
+            {"error": {"message": message, "type": "mock_error", "code": status_code}},
+            status_code=status_code,
+            headers=headers
+        )
+
+    def completion(self, name: str, model: str, content: str) -> Dict:
+        return {
+            "id": f"chatcmpl-mock-{time.time_ns()}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 10, "completion_tokens": len(content), "total_tokens": 10 + len(content)}
+        }
+
+    async def stream(self, name: str, model: str, cfg: Dict):
+        """SSE 流，每个 chunk 一个字，按 chunk_interval 配速"""
+        try:
+            interval = cfg.get("chunk_interval", 20) / 1000
+            jitter = cfg.get("chunk_jitter", 0.2)
+            chunks = cfg.get("chunks", 20)
+            abort_at = random.randint(0, chunks) if random.random() < cfg.get("stream_abort_rate", 0) else None
+            for i in range(chunks):
+                if i == abort_at:
+                    self.counters[name]["aborted"] += 1
+                    raise ConnectionAbortedError("mock stream aborted")
+                chunk = {
+                    "id": "chatcmpl-mock",
+                    "object": "chat.completion.chunk",
+                    "model": model,
+                    "choices": [{"index": 0, "delta": {"content": "字"}, "finish_reason": None}]
+                }
+                yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8")
+                if interval:
+                    await asyncio.sleep(interval * random.uniform(1 - jitter, 1 + jitter))
+            yield b"data: [DONE]\n\n"
+            self.counters[name]["ok"] += 1
+        finally:
+            self.active[name] -= 1
+
+    async def chat_completion(self, name: str, request: Request):
+        cfg = self.upstreams.get(name)
+        if cfg is None:
+            return self.error(404, f"unknown mock provider {name}")
+        body = await request.json()
+        counters = self.counters[name]
+        counters["requests"] += 1
+
+        max_concurrency = cfg.get("max_concurrency")
+        if random.random() < cfg.get("rate_limit_rate", 0) or (max_concurrency and self.active[name] >= max_concurrency):
+            counters["rate_limited"] += 1
+            return self.error(429, "rate limit exceeded", {"Retry-After": str(cfg.get("retry_after", 1))})
+
+        self.active[name] += 1
+        streaming = False
+        try:
+            await asyncio.sleep(sample_ms(cfg.get("latency", {})) / 1000)
+            if random.random() < cfg.get("error_rate", 0):
+                counters["errors"] += 1
+                return self.error(500, "mock upstream error")
+            model = body.get("model", f"mock-{name}")
+            if body.get("stream"):
+                streaming = True  # 并发计数由流结束时释放
+                return StreamingResponse(self.stream(name, model, cfg), media_type="text/event-stream")
+            counters["ok"] += 1
+            return self.completion(name, model, "字" * cfg.get("chunks", 20))
+        finally:
+            if not streaming:
+                self.active[name] -= 1
+
+    async def models(self, name: str):
+        if name not in self.upstreams:
+            return self.error(404, f"unknown mock provider {name}")
+        return {"object": "list", "data": [{"id": f"mock-{name}", "object": "model"}]}
+
+    async def stats(self):
+        return {"active": self.active, "counters": self.counters}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="模拟的 OpenAI 兼容上游")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--config", help="假服务商配置（JSON 数组），默认用 DEFAULT_UPSTREAMS")
+    parser.add_argument("--providers-out", help="顺便写出网关用的 PROVIDERS_CONFIG 文件")
+    args = parser.parse_args()
+
+    upstreams = load_upstreams(args.config)
+    if args.providers_out:
+        with open(args.providers_out, "w", encoding="utf-8") as f:
+            json.dump(gateway_providers(upstreams, f"http://{args.host}:{args.port}"), f, ensure_ascii=False, indent=2)
+        print(f"网关配置已写入 {args.providers_out}，启动网关前设置 PROVIDERS_CONFIG 和 {MOCK_API_KEY_ENV}")
+    uvicorn.run(MockUpstream(upstreams).app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
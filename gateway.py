@@ -2,51 +2,214 @@ from datetime import datetime
 import os
 import time
 import json
+import re
+import hashlib
+import sqlite3
+import threading
+import math
+import random
 import asyncio
-from typing import AsyncIterator, Dict, List, Optional, Set
+import argparse
+import heapq
+import logging
+from collections import OrderedDict, deque
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Set, Tuple
 from fastapi.concurrency import asynccontextmanager
 import httpx
 from fastapi import FastAPI, HTTPException, Request, status
-from fastapi.responses import JSONResponse
-from openai import APIConnectionError, APIError, AsyncOpenAI
+from fastapi.responses import Response
 from pydantic import BaseModel
 from fastapi.responses import StreamingResponse
 import uvicorn
+from probe_engine import MISSING_API_KEY, PROVIDERS, CallbackSink, HttpSink, ProbeEngine, ProbeSink, ProbeTimer
+from shared_state import LEADER_RETRY, SHARED_DIR, WORKERS, ProbeLeader, WorkerBus, per_worker, prepare_shared_dir
+from telemetry import (
+    CONTENT_TYPE, FAST_BUCKETS, MetricsRegistry, log_event, setup_logging, span, span_event, span_set
+)
 
+# 结构化日志，异步写出、按 GATEWAY_LOG_SAMPLE 采样（见 telemetry.py）
+log, log_listener = setup_logging("gateway")
 
-# 服务商配置列表
-PROVIDERS = [
-    {
-        "name": "deepseek",
-        "env_var": "OPENAI_API_KEY",
-        "base_url": "https://api.deepseek.com",
-        "model": "deepseek-chat"
-    },
-    {
-        "name": "siliconflow",
-        "env_var": "SILICONFLOW_API_KEY",
-        "base_url": "https://api.siliconflow.cn/v1",
-        "model": "deepseek-ai/DeepSeek-V3"
-    },
-    {
-        "name": "huoshan",
-        "env_var": "HUOSHAN_API_KEY",
-        "base_url": "https://ark.cn-beijing.volces.com/api/v3",
-        "model": "ep-20250204220334-l2q5g"
-    },
-    {
-        "name": "tencent",
-        "env_var": "TENCENT_API_KEY",
-        "base_url": "https://api.lkeap.cloud.tencent.com/v1",
-        "model": "deepseek-v3"
-    },
-    {
-        "name": "bailian",
-        "env_var": "DASHSCOPE_API_KEY",
-        "base_url": "https://dashscope.aliyuncs.com/compatible-mode/v1",
-        "model": "deepseek-v3"
-    }
-]
+
+# 服务商列表在 probe_engine.py 里统一配置（可以用 PROVIDERS_CONFIG 指向 JSON 文件）
+# PROVIDERS 条目里还可以配置负载均衡相关的限制（不配就是不限制）：
+#   "max_concurrency": 20   同时在途请求上限
+#   "rpm": 600              每分钟请求数上限
+#   "tpm": 200000           每分钟 token 上限（按请求体估算）
+#   "weight": 2.0           加权随机时的额外权重，默认 1.0
+#   "probe": "models"       健康检查方式：connect / models / completion（见 probe_engine.py）
+# 例如 {"name": "deepseek", ..., "max_concurrency": 20, "rpm": 600}
+
+# 上游连接池配置，PROVIDERS 条目里可以用同名小写键单独覆盖
+# 例如 {"name": "deepseek", ..., "http2": True, "max_connections": 200}
+POOL_MAX_CONNECTIONS = int(os.getenv("GATEWAY_POOL_MAX_CONNECTIONS", "100"))
+POOL_MAX_KEEPALIVE = int(os.getenv("GATEWAY_POOL_MAX_KEEPALIVE", "20"))
+POOL_KEEPALIVE_EXPIRY = float(os.getenv("GATEWAY_POOL_KEEPALIVE_EXPIRY", "60"))
+POOL_HTTP2 = os.getenv("GATEWAY_HTTP2", "0") == "1"
+
+# 有 orjson 就用它做 JSON 编解码（uv add orjson），没有就用标准库
+try:
+    import orjson
+
+    def json_loads(data: bytes) -> Any:
+        return orjson.loads(data)
+
+    def json_dumps(obj: Any, sort_keys: bool = False) -> bytes:
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS if sort_keys else 0)
+except ImportError:
+    def json_loads(data: bytes) -> Any:
+        return json.loads(data)
+
+    def json_dumps(obj: Any, sort_keys: bool = False) -> bytes:
+        return json.dumps(obj, sort_keys=sort_keys, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+# 请求体里的 "model": "..." 字段；JSON 字符串里的引号一定是转义过的，
+# 所以不带反斜杠的 "model" 只可能是对象的键
+MODEL_FIELD = re.compile(rb'"model"\s*:\s*("(?:[^"\\]|\\.)*")')
+
+def patch_model(raw: bytes, body: Dict, model: str) -> bytes:
+    """把请求体里的 model 换成服务商的模型名
+
+    顶层 model 是字符串、且整个请求体里只有这一个 "model" 键时，直接在字节上替换，
+    不做完整的反序列化和序列化；其他情况（没有 model、嵌套对象里也有 model）重新编码。
+    """
+    original = body.get("model")
+    if isinstance(original, str):
+        matches = []
+        for match in MODEL_FIELD.finditer(raw):
+            matches.append(match)
+            if len(matches) > 1:
+                break
+        if len(matches) == 1:
+            match = matches[0]
+            if json.loads(match.group(1)) == original:
+                return raw[:match.start(1)] + json.dumps(model, ensure_ascii=False).encode("utf-8") + raw[match.end(1):]
+    return json_dumps({**body, "model": model})
+
+class RequestPayload:
+    """只读一次、只解析一次的请求体，转发时按服务商改写 model"""
+    def __init__(self, raw: bytes):
+        self.received = time.perf_counter()  # 网关开始处理的时间，用来算转发前的开销
+        self.forwarded = False
+        self.reservation: Optional["Reservation"] = None  # 准入预留的名额，第一次拿到 Lease 时归还
+        self.raw = raw
+        self.body: Dict = json_loads(raw)
+        if not isinstance(self.body, dict):
+            raise ValueError("Request body must be a JSON object")
+        self.stream = bool(self.body.get("stream", False))
+        self._patched: Dict[str, bytes] = {}
+        self._fingerprint: Optional[str] = None
+
+    def for_model(self, model: str) -> bytes:
+        if model not in self._patched:
+            self._patched[model] = patch_model(self.raw, self.body, model)
+        return self._patched[model]
+
+    @property
+    def fingerprint(self) -> str:
+        """请求体的规范化哈希
+
+        model 会被网关改写成各服务商自己的模型名，所以不参与计算；
+        stream 参与计算，流式和非流式的响应格式不同。
+        """
+        if self._fingerprint is None:
+            canonical = {k: v for k, v in self.body.items() if k != "model"}
+            self._fingerprint = hashlib.sha256(json_dumps(canonical, sort_keys=True)).hexdigest()
+        return self._fingerprint
+
+# HTTP/2 需要额外安装 h2（uv add "httpx[http2]"），没装就退回 HTTP/1.1
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+class PoolMetrics(BaseModel):
+    http2: bool = False
+    max_connections: int = 0
+    max_keepalive: int = 0
+    total_requests: int = 0
+    failed_requests: int = 0
+    in_flight: int = 0
+    peak_in_flight: int = 0
+    open_connections: int = 0
+    idle_connections: int = 0
+
+class ProviderPool:
+    """每个服务商一个长连接的 httpx.AsyncClient
+
+    在 lifespan 里 start，关闭时 close；网关转发和健康检查都复用这里的连接，
+    不再为每个请求重新做 DNS / TCP / TLS 握手。
+    """
+    def __init__(self, providers: List[Dict] = PROVIDERS):
+        self.providers = {p["name"]: p for p in providers}
+        self.clients: Dict[str, httpx.AsyncClient] = {}
+        self.metrics_by_provider: Dict[str, PoolMetrics] = {}
+
+    def _build_client(self, provider: Dict) -> httpx.AsyncClient:
+        http2 = provider.get("http2", POOL_HTTP2)
+        if http2 and not HTTP2_AVAILABLE:
+            log_event(log, logging.WARNING, "http2_unavailable", provider=provider["name"])
+            http2 = False
+        limits = httpx.Limits(
+            max_connections=provider.get("max_connections", POOL_MAX_CONNECTIONS),
+            max_keepalive_connections=provider.get("max_keepalive", POOL_MAX_KEEPALIVE),
+            keepalive_expiry=provider.get("keepalive_expiry", POOL_KEEPALIVE_EXPIRY)
+        )
+        self.metrics_by_provider[provider["name"]] = PoolMetrics(
+            http2=http2,
+            max_connections=limits.max_connections,
+            max_keepalive=limits.max_keepalive_connections
+        )
+        return httpx.AsyncClient(
+            base_url=provider["base_url"],
+            limits=limits,
+            http2=http2,
+            timeout=30
+        )
+
+    async def start(self):
+        for provider in self.providers.values():
+            self.clients[provider["name"]] = self._build_client(provider)
+
+    async def close(self):
+        for client in self.clients.values():
+            await client.aclose()
+        self.clients.clear()
+
+    def client(self, name: str) -> httpx.AsyncClient:
+        if name not in self.clients:
+            # 没走 lifespan（比如单独测试 APIMonitor）时按需创建
+            self.clients[name] = self._build_client(self.providers[name])
+        return self.clients[name]
+
+    @asynccontextmanager
+    async def track(self, name: str) -> AsyncIterator[None]:
+        """统计在途请求数和失败数"""
+        metrics = self.metrics_by_provider[name]
+        metrics.total_requests += 1
+        metrics.in_flight += 1
+        metrics.peak_in_flight = max(metrics.peak_in_flight, metrics.in_flight)
+        try:
+            yield
+        except Exception:
+            # 被对冲取消（CancelledError）不算失败
+            metrics.failed_requests += 1
+            raise
+        finally:
+            metrics.in_flight -= 1
+
+    def metrics(self) -> Dict[str, Any]:
+        result = {}
+        for name, metrics in self.metrics_by_provider.items():
+            client = self.clients.get(name)
+            # httpcore 的连接池没有公开接口，取不到就保持 0
+            pool = getattr(getattr(client, "_transport", None), "_pool", None)
+            connections = getattr(pool, "connections", []) if pool else []
+            metrics.open_connections = len(connections)
+            metrics.idle_connections = sum(1 for c in connections if c.is_idle())
+            result[name] = metrics.model_dump()
+        return result
 
 class ProviderStatus(BaseModel):
     online: bool = False
@@ -57,133 +220,1481 @@ class ProviderStatus(BaseModel):
     failed_requests: int = 0
     last_error: Optional[str] = None  # 新增错误信息字段
     retry_count: int = 0
+    ttft: float = 0.0  # 流式首 token 耗时（毫秒，指数平均）
+    tokens_per_sec: float = 0.0  # 流式输出速度（SSE 事件数/秒，指数平均）
+    stream_requests: int = 0
+
+# 流式输出速度的指数平均系数
+STREAM_EWMA_ALPHA = 0.3
+
+# 滑动窗口统计配置
+LATENCY_WINDOW = int(os.getenv("GATEWAY_LATENCY_WINDOW", "256"))  # 每个服务商保留最近多少个延迟样本
+EWMA_TAU = float(os.getenv("GATEWAY_EWMA_TAU", "60"))  # 时间衰减常数（秒），越小越灵敏
+EWMA_MIN_ALPHA = 0.05  # 同一时刻的并发样本也至少要有这么大的权重
+ERROR_WINDOW_SECONDS = int(os.getenv("GATEWAY_ERROR_WINDOW", "300"))  # 错误率统计窗口
+ERROR_BUCKET_SECONDS = 10
+ERROR_PENALTY_MS = 30000  # 评分时一次失败折算成多少毫秒延迟（沿用原来的 30 秒惩罚）
+
+# 熔断器配置
+CB_WINDOW_SECONDS = int(os.getenv("GATEWAY_CB_WINDOW", "60"))  # 失败率统计窗口
+CB_MIN_REQUESTS = int(os.getenv("GATEWAY_CB_MIN_REQUESTS", "5"))  # 窗口内至少这么多请求才按失败率判断
+CB_FAILURE_RATE = float(os.getenv("GATEWAY_CB_FAILURE_RATE", "0.5"))
+CB_CONSECUTIVE_FAILURES = int(os.getenv("GATEWAY_CB_CONSECUTIVE_FAILURES", "3"))
+CB_OPEN_SECONDS = float(os.getenv("GATEWAY_CB_OPEN_SECONDS", "30"))  # 第一次熔断的时长，再次熔断翻倍
+CB_MAX_OPEN_SECONDS = float(os.getenv("GATEWAY_CB_MAX_OPEN_SECONDS", "300"))
+CB_HALF_OPEN_TRIALS = int(os.getenv("GATEWAY_CB_HALF_OPEN_TRIALS", "1"))  # 半开状态同时放行的试探请求数
+CB_HALF_OPEN_SUCCESSES = int(os.getenv("GATEWAY_CB_HALF_OPEN_SUCCESSES", "2"))  # 连续成功几次才恢复
+CB_TRIAL_TIMEOUT = 60.0  # 试探请求迟迟没有结果（比如被对冲取消）时，名额自动回收
+CB_PROBE_TICK = 5  # APIMonitor 检查熔断恢复的间隔（秒）
+
+# 被动健康检查：从真实流量推断服务商状态
+PASSIVE_WINDOW = float(os.getenv("GATEWAY_PASSIVE_WINDOW", "120"))  # 最近这么多秒内有真实流量的服务商不做主动探测
+PASSIVE_REPORT_INTERVAL = float(os.getenv("GATEWAY_PASSIVE_REPORT_INTERVAL", "60"))  # 多久汇总一次流量生成状态记录
+# 流量状态记录的上报地址（server.py 的 /api_status），不配就只在 /v1/gateway/probes 里看
+GATEWAY_STATUS_URL = os.getenv("GATEWAY_STATUS_URL")
+
+class LatencyWindow:
+    """单个延迟指标：时间衰减 EWMA + 环形缓冲区上的分位数
+
+    EWMA 每次更新 O(1)；分位数在有新样本后第一次读取时排序一次并缓存。
+    """
+    def __init__(self, size: int = LATENCY_WINDOW, tau: float = EWMA_TAU):
+        self.samples = deque(maxlen=size)
+        self.tau = tau
+        self.ewma = 0.0
+        self.count = 0
+        self.last_update = 0.0
+        self._sorted: Optional[List[float]] = None
+
+    def add(self, value: float, now: Optional[float] = None):
+        now = time.time() if now is None else now
+        if self.count == 0:
+            self.ewma = value
+        else:
+            alpha = max(EWMA_MIN_ALPHA, 1 - math.exp(-(now - self.last_update) / self.tau))
+            self.ewma += alpha * (value - self.ewma)
+        self.samples.append(value)
+        self.count += 1
+        self.last_update = now
+        self._sorted = None
+
+    def quantile(self, q: float) -> float:
+        if not self.samples:
+            return 0.0
+        if self._sorted is None:
+            self._sorted = sorted(self.samples)
+        index = min(len(self._sorted) - 1, int(q * len(self._sorted)))
+        return self._sorted[index]
+
+    def snapshot(self) -> Dict[str, float]:
+        return {
+            "ewma": round(self.ewma, 2),
+            "p50": round(self.quantile(0.5), 2),
+            "p90": round(self.quantile(0.9), 2),
+            "p99": round(self.quantile(0.99), 2),
+            "samples": len(self.samples)
+        }
+
+class ErrorWindow:
+    """按时间分桶的滑动窗口错误率，维护窗口内的累计值，读写都是均摊 O(1)"""
+    def __init__(self, window: int = ERROR_WINDOW_SECONDS, bucket: int = ERROR_BUCKET_SECONDS):
+        self.window = window
+        self.bucket = bucket
+        self.buckets = deque()  # [桶起始时间, 请求数, 失败数]
+        self.total = 0
+        self.failures = 0
+
+    def _expire(self, now: float):
+        while self.buckets and self.buckets[0][0] <= now - self.window:
+            _, total, failures = self.buckets.popleft()
+            self.total -= total
+            self.failures -= failures
+
+    def add(self, success: bool, now: Optional[float] = None):
+        now = time.time() if now is None else now
+        self._expire(now)
+        start = now - now % self.bucket
+        if not self.buckets or self.buckets[-1][0] != start:
+            self.buckets.append([start, 0, 0])
+        self.buckets[-1][1] += 1
+        self.total += 1
+        if not success:
+            self.buckets[-1][2] += 1
+            self.failures += 1
+
+    def error_rate(self, now: Optional[float] = None) -> float:
+        self._expire(time.time() if now is None else now)
+        return self.failures / self.total if self.total else 0.0
+
+class CircuitBreaker:
+    """单个服务商的熔断器：closed -> open -> half_open -> closed
+
+    closed:    正常路由，窗口失败率或连续失败数超过阈值就熔断
+    open:      直接跳过，不再为死掉的上游白等一个超时
+    half_open: 熔断时间到了之后只放行少量试探请求，连续成功才恢复，失败则再次熔断
+
+    open / half_open 时只有健康检查和本轮的试探请求能改变状态：
+    熔断前就发出去、熔断后才回来的请求（包括其他 worker 广播过来的结果）一律忽略。
+    generation 在每次熔断和恢复时加一，试探请求带着发出时的 generation，过期的不算数。
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
 
-class RoutingManager:
     def __init__(self):
+        self.state = self.CLOSED
+        self.errors = ErrorWindow(window=CB_WINDOW_SECONDS)
+        self.consecutive_failures = 0
+        self.open_seconds = CB_OPEN_SECONDS
+        self.open_until = 0.0
+        self.trials: List[float] = []  # 正在进行的试探请求的开始时间
+        self.trial_successes = 0
+        self.times_opened = 0
+        self.generation = 0
+
+    def _trip(self, now: float):
+        if self.state == self.HALF_OPEN:
+            # 试探失败，熔断时间翻倍
+            self.open_seconds = min(self.open_seconds * 2, CB_MAX_OPEN_SECONDS)
+        self.state = self.OPEN
+        self.open_until = now + self.open_seconds
+        self.trials.clear()
+        self.trial_successes = 0
+        self.times_opened += 1
+        self.generation += 1
+
+    def _close(self):
+        self.state = self.CLOSED
+        self.open_seconds = CB_OPEN_SECONDS
+        self.errors = ErrorWindow(window=CB_WINDOW_SECONDS)
+        self.consecutive_failures = 0
+        self.trials.clear()
+        self.generation += 1
+
+    def _free_trials(self, now: float) -> int:
+        self.trials = [t for t in self.trials if now - t < CB_TRIAL_TIMEOUT]
+        return CB_HALF_OPEN_TRIALS - len(self.trials)
+
+    def available(self, now: Optional[float] = None) -> bool:
+        """只读判断：现在能不能往这个服务商发请求"""
+        now = time.time() if now is None else now
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN:
+            return now >= self.open_until
+        return self._free_trials(now) > 0
+
+    def allow_request(self, now: Optional[float] = None) -> bool:
+        """真正发请求前调用；半开状态下会占用一个试探名额"""
+        now = time.time() if now is None else now
+        if self.state == self.OPEN and now >= self.open_until:
+            self.state = self.HALF_OPEN
+            self.trial_successes = 0
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.HALF_OPEN and self._free_trials(now) > 0:
+            self.trials.append(now)
+            return True
+        return False
+
+    def trial_token(self) -> Optional[int]:
+        """allow_request 放行之后调用：半开状态下返回这次试探的凭证，交给 record(trial=...)"""
+        return self.generation if self.state == self.HALF_OPEN else None
+
+    def record(self, success: bool, now: Optional[float] = None, trial: Optional[int] = None,
+               probe: bool = False) -> bool:
+        """记录一次结果，返回是否计入；open / half_open 时只计入健康检查（probe）和本轮试探（trial）"""
+        now = time.time() if now is None else now
+        if self.state != self.CLOSED and not probe and (trial is None or trial != self.generation):
+            return False
+        if self.state == self.HALF_OPEN:
+            if self.trials:
+                self.trials.pop(0)
+            if not success:
+                self._trip(now)
+                return True
+            self.trial_successes += 1
+            if self.trial_successes >= CB_HALF_OPEN_SUCCESSES:
+                self._close()
+            return True
+        if self.state == self.OPEN:
+            # 能走到这里的只有健康检查，检查通过就提前进入半开
+            if success:
+                self.state = self.HALF_OPEN
+                self.trial_successes = 1
+            return True
+
+        self.errors.add(success, now)
+        self.consecutive_failures = 0 if success else self.consecutive_failures + 1
+        if not success and (self.consecutive_failures >= CB_CONSECUTIVE_FAILURES or (
+            self.errors.total >= CB_MIN_REQUESTS and self.errors.error_rate(now) >= CB_FAILURE_RATE
+        )):
+            self._trip(now)
+        return True
+
+    def snapshot(self) -> Dict[str, Any]:
+        now = time.time()
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "window_error_rate": round(self.errors.error_rate(now), 4),
+            "open_remaining": round(max(0.0, self.open_until - now), 1) if self.state == self.OPEN else 0.0,
+            "trials_in_flight": len(self.trials),
+            "times_opened": self.times_opened
+        }
+
+class ProviderWindow:
+    """单个服务商的有界内存统计"""
+    def __init__(self):
+        self.latency = LatencyWindow()  # 完整请求耗时（只统计成功的）
+        self.first_byte = LatencyWindow()  # 拿到响应头的耗时
+        self.ttft = LatencyWindow()  # 流式首 token 耗时
+        self.errors = ErrorWindow()
+
+    def score(self, interactive: bool = False) -> float:
+        """越小越好：期望延迟 + 失败折算的延迟"""
+        latency = self.latency.ewma
+        if interactive and self.ttft.count:
+            latency = self.ttft.ewma
+        return latency * 0.6 + self.errors.error_rate() * ERROR_PENALTY_MS * 0.4
+
+def is_provider_error(status_code: int) -> bool:
+    """上游返回的错误是不是服务商自己的问题
+
+    5xx、超时（408）和限流（429）算服务商不健康；其他 4xx 是请求本身有问题，服务商是好的。
+    """
+    return status_code >= 500 or status_code in (408, 429)
+
+class TrafficHealth:
+    """真实流量的健康汇总
+
+    记录每个服务商最近一次有流量的时间（用来跳过主动探测），
+    并按周期把这段时间的请求数、失败数和平均耗时汇总成和 server.py 的 Status 同结构的记录。
+    """
+    def __init__(self):
+        self.last_seen: Dict[str, float] = {}
+        self.pending: Dict[str, Dict[str, Any]] = {}
+        self.last_reports: Dict[str, Dict] = {}
+
+    def _period(self, provider: str) -> Dict[str, Any]:
+        period = self.pending.get(provider)
+        if period is None:
+            period = {"requests": 0, "failures": 0, "latency_total": 0.0, "latency_count": 0, "error": None}
+            self.pending[provider] = period
+        return period
+
+    def seen(self, provider: str):
+        self.last_seen[provider] = time.time()
+
+    def record(self, provider: str, success: bool, latency: Optional[float] = None, error: Optional[str] = None):
+        self.seen(provider)
+        period = self._period(provider)
+        period["requests"] += 1
+        if success:
+            if latency is not None:
+                period["latency_total"] += latency
+                period["latency_count"] += 1
+        else:
+            period["failures"] += 1
+            period["error"] = error
+
+    def idle(self, provider: str, now: Optional[float] = None) -> bool:
+        """最近 PASSIVE_WINDOW 秒内没有真实流量"""
+        now = now or time.time()
+        return now - self.last_seen.get(provider, 0.0) >= PASSIVE_WINDOW
+
+    def drain(self, online: Dict[str, bool]) -> List[Dict]:
+        """取出上一个周期的汇总，online 由调用方（熔断器的判断）给出"""
+        reports = []
+        now = int(time.time())
+        for provider, period in self.pending.items():
+            if not period["requests"]:
+                continue
+            report = {
+                "provider": provider,
+                "online": online.get(provider, period["failures"] < period["requests"]),
+                "response_time": round(period["latency_total"] / period["latency_count"], 2) if period["latency_count"] else None,
+                "error": period["error"] if period["failures"] else None,
+                "timestamp": now
+            }
+            reports.append(report)
+            self.last_reports[provider] = {**report, "requests": period["requests"], "failures": period["failures"]}
+        self.pending.clear()
+        return reports
+
+    def snapshot(self) -> Dict[str, Any]:
+        now = time.time()
+        return {
+            provider: {
+                "idle_seconds": round(now - seen, 1),
+                "last_report": self.last_reports.get(provider)
+            }
+            for provider, seen in self.last_seen.items()
+        }
+
+# 负载均衡策略：weighted / p2c / least / best
+BALANCER = os.getenv("GATEWAY_BALANCER", "weighted")
+SATURATED_RETRY_AFTER = 1  # 所有服务商都满载时建议客户端多久后重试（秒）
+
+def estimate_tokens(body: Dict) -> int:
+    """粗略估算一次请求会消耗的 token（约 4 个字符一个 token，加上最大输出）
+
+    每个请求转发前都会调用，格式不对的字段直接跳过，留给上游返回 400。
+    """
+    chars = 0
+    messages = body.get("messages")
+    for message in messages if isinstance(messages, list) else []:
+        content = message.get("content") if isinstance(message, dict) else None
+        if isinstance(content, str):
+            chars += len(content)
+        elif isinstance(content, list):
+            chars += sum(
+                len(part["text"]) for part in content if isinstance(part, dict) and isinstance(part.get("text"), str)
+            )
+    max_tokens = body.get("max_tokens")
+    if not isinstance(max_tokens, int) or isinstance(max_tokens, bool):
+        max_tokens = 0
+    return chars // 4 + max(max_tokens, 0)
+
+class Lease:
+    """一次在途请求对并发名额的占用，release 可以重复调用"""
+    def __init__(self, limiter: "ProviderLimiter"):
+        self.limiter = limiter
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.limiter.in_flight -= 1
+            if self.limiter.on_release is not None:
+                self.limiter.on_release()
+
+class ProviderLimiter:
+    """单个服务商的并发、RPM、TPM 限制和在途请求计数"""
+    def __init__(self, provider: Dict):
+        # 多 worker 时每个 worker 只管自己那一份限额
+        self.max_concurrency = per_worker(provider.get("max_concurrency"))
+        self.rpm = per_worker(provider.get("rpm"))
+        self.tpm = per_worker(provider.get("tpm"))
+        self.weight = float(provider.get("weight", 1.0))
+        self.in_flight = 0
+        self.requests = deque()  # 最近一分钟的请求时间
+        self.tokens = deque()  # 最近一分钟的 (时间, token 数)
+        self.tokens_used = 0
+        self.on_release: Optional[Callable[[], None]] = None  # 名额释放时通知排队的请求
+
+    def _expire(self, now: float):
+        while self.requests and self.requests[0] <= now - 60:
+            self.requests.popleft()
+        while self.tokens and self.tokens[0][0] <= now - 60:
+            self.tokens_used -= self.tokens.popleft()[1]
+
+    def has_capacity(self, tokens: int = 0, now: Optional[float] = None) -> bool:
+        return self.free_slots(tokens, now) > 0
+
+    def free_slots(self, tokens: int = 0, now: Optional[float] = None) -> float:
+        """还能再放进来几个这样的请求，不限时是 inf"""
+        now = time.time() if now is None else now
+        self._expire(now)
+        slots = math.inf
+        if self.max_concurrency is not None:
+            slots = min(slots, self.max_concurrency - self.in_flight)
+        if self.rpm is not None:
+            slots = min(slots, self.rpm - len(self.requests))
+        if self.tpm is not None:
+            remaining = self.tpm - self.tokens_used
+            slots = min(slots, remaining // tokens if tokens else (math.inf if remaining >= 0 else 0))
+        return max(slots, 0)
+
+    def acquire(self, tokens: int = 0) -> Lease:
+        now = time.time()
+        self._expire(now)
+        self.in_flight += 1
+        self.requests.append(now)
+        if tokens:
+            self.tokens.append((now, tokens))
+            self.tokens_used += tokens
+        return Lease(self)
+
+    def snapshot(self) -> Dict[str, Any]:
+        self._expire(time.time())
+        return {
+            "in_flight": self.in_flight,
+            "max_concurrency": self.max_concurrency,
+            "rpm_used": len(self.requests),
+            "rpm": self.rpm,
+            "tpm_used": self.tokens_used,
+            "tpm": self.tpm
+        }
+
+class BalancingStrategy:
+    """负载均衡策略：从已按评分排好序的候选里挑一个"""
+    name = "best"
+
+    def choose(self, candidates: List[Dict], routing: "RoutingManager", interactive: bool) -> Dict:
+        return candidates[0]
+
+class WeightedRandomStrategy(BalancingStrategy):
+    """按 权重/评分 加权随机，评分越好分到的流量越多，但不会全压在一家"""
+    name = "weighted"
+
+    def choose(self, candidates, routing, interactive):
+        weights = [
+            routing.limiters[p["name"]].weight / (routing.windows[p["name"]].score(interactive) + 1.0)
+            for p in candidates
+        ]
+        return random.choices(candidates, weights=weights)[0]
+
+class PowerOfTwoStrategy(BalancingStrategy):
+    """随机抽两个，选在途请求少的；一样多再比评分"""
+    name = "p2c"
+
+    def choose(self, candidates, routing, interactive):
+        if len(candidates) == 1:
+            return candidates[0]
+        pair = random.sample(candidates, 2)
+        return min(pair, key=lambda p: (
+            routing.limiters[p["name"]].in_flight,
+            routing.windows[p["name"]].score(interactive)
+        ))
+
+class LeastOutstandingStrategy(BalancingStrategy):
+    """选在途请求最少的，一样多时按评分（candidates 已经有序，min 是稳定的）"""
+    name = "least"
+
+    def choose(self, candidates, routing, interactive):
+        return min(candidates, key=lambda p: routing.limiters[p["name"]].in_flight)
+
+BALANCING_STRATEGIES = {
+    cls.name: cls for cls in (BalancingStrategy, WeightedRandomStrategy, PowerOfTwoStrategy, LeastOutstandingStrategy)
+}
+
+# 对冲请求（hedging）配置：主服务商迟迟没有首字节时，向次优服务商再发一份
+HEDGING_ENABLED = os.getenv("GATEWAY_HEDGING", "0") == "1"
+HEDGE_QUANTILE = float(os.getenv("GATEWAY_HEDGE_QUANTILE", "0.9"))
+HEDGE_DEFAULT_DELAY = float(os.getenv("GATEWAY_HEDGE_DEFAULT_DELAY_MS", "2000"))  # 样本不足时的等待（毫秒）
+HEDGE_MIN_DELAY = 50.0
+HEDGE_MIN_SAMPLES = 20
+# 每个主请求最多"挣"多少次对冲机会，上限 1.0，保证上游花费不会超过两倍
+HEDGE_BUDGET_RATIO = min(float(os.getenv("GATEWAY_HEDGE_BUDGET_RATIO", "0.2")), 1.0)
+HEDGE_BUDGET_BURST = 10.0
+
+class HedgeBudget:
+    """对冲预算：令牌桶，每个主请求存入 ratio 个令牌，每次对冲消耗 1 个
+
+    桶从 0 开始，因此对冲次数永远不超过 ratio * 主请求数。
+    """
+    def __init__(self, ratio: float = HEDGE_BUDGET_RATIO, burst: float = HEDGE_BUDGET_BURST):
+        self.ratio = ratio
+        self.burst = burst
+        self.tokens = 0.0
+        self.primary_requests = 0
+        self.hedged_requests = 0
+        self.hedge_wins = 0
+        self.denied = 0
+
+    def on_request(self):
+        self.primary_requests += 1
+        self.tokens = min(self.burst, self.tokens + self.ratio)
+
+    def try_acquire(self) -> bool:
+        if self.tokens >= 1.0:
+            self.tokens -= 1.0
+            self.hedged_requests += 1
+            return True
+        self.denied += 1
+        return False
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "enabled": HEDGING_ENABLED,
+            "ratio": self.ratio,
+            "tokens": round(self.tokens, 3),
+            "primary_requests": self.primary_requests,
+            "hedged_requests": self.hedged_requests,
+            "hedge_wins": self.hedge_wins,
+            "denied": self.denied
+        }
+
+# 失败切换配置
+REQUEST_TIMEOUT = float(os.getenv("GATEWAY_REQUEST_TIMEOUT", "60"))  # 客户端没给超时时，整个请求（含重试）最多多少秒
+MAX_REQUEST_TIMEOUT = float(os.getenv("GATEWAY_MAX_REQUEST_TIMEOUT", "600"))
+# 客户端声明的超时（秒），X-Stainless-Timeout 是 OpenAI 官方 SDK 自动带上的
+DEADLINE_HEADERS = ("x-gateway-timeout", "x-stainless-timeout")
+MAX_ATTEMPTS = int(os.getenv("GATEWAY_MAX_ATTEMPTS", "3"))  # 每个请求最多尝试几个服务商（含第一次）
+MIN_ATTEMPT_TIMEOUT = float(os.getenv("GATEWAY_MIN_ATTEMPT_TIMEOUT", "2"))  # 剩余时间不到这么多秒就不再重试
+RETRY_BUDGET_RATIO = min(float(os.getenv("GATEWAY_RETRY_BUDGET_RATIO", "0.2")), 1.0)
+RETRY_BUDGET_BURST = 10.0
+
+class Deadline:
+    """一个请求的整体截止时间，每次尝试分到剩余时间的一份
+
+    split=False 时不平分，每次尝试都可以用完剩余时间。
+    """
+    def __init__(self, timeout: float, split: bool = True):
+        self.timeout = timeout
+        self.split = split
+        self.expires = time.monotonic() + timeout
+
+    @classmethod
+    def from_request(cls, request: Request, stream: bool) -> "Deadline":
+        for header in DEADLINE_HEADERS:
+            try:
+                timeout = float(request.headers.get(header, ""))
+            except ValueError:
+                continue
+            if timeout > 0:
+                return cls(min(timeout, MAX_REQUEST_TIMEOUT))
+        # 客户端没给超时：非流式请求的上游生成完才回响应头，平分会把长回答判成超时再发给备选服务商重新生成，
+        # 所以第一次尝试用满整个超时，快速失败（5xx、429）后剩下的时间再留给重试
+        return cls(REQUEST_TIMEOUT, split=stream)
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires - time.monotonic())
+
+    def attempt_timeout(self, attempts_left: int) -> float:
+        """剩余时间平分给剩下的尝试；不够每次 MIN_ATTEMPT_TIMEOUT 时少分几份，不够一份就全给这一次"""
+        remaining = self.remaining()
+        if not self.split:
+            return remaining
+        shares = max(1, min(attempts_left, int(remaining // MIN_ATTEMPT_TIMEOUT)))
+        return remaining / shares
+
+class RetryBudget:
+    """全局重试预算：令牌桶，每个请求存入 ratio 个令牌，每次失败切换消耗 1 个
+
+    和对冲预算不同，桶一开始是满的，冷启动时的偶发失败也能重试；
+    上游大面积故障时重试次数被限制在 ratio * 请求数左右，不会把故障放大成几倍的流量。
+    """
+    def __init__(self, ratio: float = RETRY_BUDGET_RATIO, burst: float = RETRY_BUDGET_BURST):
+        self.ratio = ratio
+        self.burst = burst
+        self.tokens = burst
+        self.requests = 0
+        self.retries = 0
+        self.recovered = 0
+        self.denied = 0
+
+    def on_request(self):
+        self.requests += 1
+        self.tokens = min(self.burst, self.tokens + self.ratio)
+
+    def try_acquire(self) -> bool:
+        if self.tokens >= 1.0:
+            self.tokens -= 1.0
+            self.retries += 1
+            return True
+        self.denied += 1
+        return False
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "ratio": self.ratio,
+            "tokens": round(self.tokens, 3),
+            "requests": self.requests,
+            "retries": self.retries,
+            "recovered": self.recovered,
+            "denied": self.denied,
+            "max_attempts": MAX_ATTEMPTS
+        }
+
+# 准入控制配置
+MAX_IN_FLIGHT = int(os.getenv("GATEWAY_MAX_IN_FLIGHT", "256"))  # 所有服务商加起来的在途请求上限，0 表示不限
+QUEUE_SIZE = int(os.getenv("GATEWAY_QUEUE_SIZE", "100"))  # 等待上游名额的请求最多排多少个，满了直接 429
+QUEUE_TIMEOUT = float(os.getenv("GATEWAY_QUEUE_TIMEOUT", "5"))  # 最多排队多少秒（还要给转发留够 MIN_ATTEMPT_TIMEOUT）
+QUEUE_POLL_INTERVAL = 0.05  # RPM/TPM 窗口滑动、熔断恢复没有通知，排队时按这个间隔重新检查
+CLIENT_RPM = int(os.getenv("GATEWAY_CLIENT_RPM", "0"))  # 每个客户端每分钟请求数，0 表示不限
+CLIENT_TPM = int(os.getenv("GATEWAY_CLIENT_TPM", "0"))  # 每个客户端每分钟 token 数（按请求体估算），0 表示不限
+CLIENT_PRIORITY = 5  # 排队优先级，数字越小越先放行
+MAX_CLIENTS = 10000  # 最多记住多少个客户端的令牌桶，多了淘汰最久没来的（满桶和新建的桶等价）
+# 按客户端单独配置：JSON 对象，键是客户端发给网关的 API key，例如
+# {"sk-team-a": {"name": "team-a", "rpm": 120, "tpm": 200000, "priority": 1}}
+CLIENTS_CONFIG = os.getenv("GATEWAY_CLIENTS_CONFIG")
+
+def load_clients(path: Optional[str] = CLIENTS_CONFIG) -> Dict[str, Dict]:
+    if not path:
+        return {}
+    with open(path, encoding="utf-8") as f:
+        clients = json.load(f)
+    if not isinstance(clients, dict):
+        raise ValueError(f"{path} 必须是 JSON 对象，键是 API key")
+    return clients
+
+class TokenBucket:
+    """每分钟 per_minute 个令牌的令牌桶，桶容量也是 per_minute"""
+    def __init__(self, per_minute: int):
+        self.rate = per_minute / 60
+        self.capacity = float(per_minute)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """还要等多少秒才够 amount 个令牌，0 表示现在就够；超过容量的按容量算"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        deficit = min(amount, self.capacity) - self.tokens
+        return deficit / self.rate if deficit > 0 else 0.0
+
+    def take(self, amount: float):
+        self.tokens -= min(amount, self.capacity)
+
+class ClientLimiter:
+    """单个客户端的请求数和 token 数限速"""
+    def __init__(self, name: str, rpm: int, tpm: int, priority: int):
+        self.name = name
+        self.priority = priority
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.rejected = 0
+
+    def check(self, tokens: int) -> Tuple[Optional[str], float]:
+        """两个桶都够才扣，否则返回 (被哪个限制挡住, 建议等待秒数)"""
+        now = time.monotonic()
+        if self.requests is not None:
+            wait = self.requests.wait_time(1, now)
+            if wait:
+                return "client_rpm", wait
+        if self.tokens is not None:
+            wait = self.tokens.wait_time(tokens, now)
+            if wait:
+                return "client_tpm", wait
+        if self.requests is not None:
+            self.requests.take(1)
+        if self.tokens is not None:
+            self.tokens.take(tokens)
+        return None, 0.0
+
+class QueuedRequest:
+    def __init__(self, tokens: int, interactive: bool):
+        self.tokens = tokens
+        self.interactive = interactive
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+
+class Reservation:
+    """准入放行后、拿到服务商名额（Lease）之前预留的名额，release 可以重复调用"""
+    def __init__(self, admission: "AdmissionController"):
+        self.admission = admission
+        self.waited = 0.0  # 排队的秒数
+        self.released = False
+        admission.reserved += 1
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.admission.reserved -= 1
+            self.admission.changed.set()
+
+class AdmissionController:
+    """准入控制：按客户端限速，上游名额不够时按优先级排队，排不上就尽早 429
+
+    客户端限速在解析完请求体后马上做，不占任何上游资源；
+    排队发生在路由之前。放行时预留一个名额（Reservation），直到请求第一次拿到服务商名额（Lease）才归还，
+    判断容量时把预留的也算上：对冲时 Lease 在单独的任务里才拿，不能指望放行的请求先跑到那一步。
+    """
+    def __init__(self, routing: "RoutingManager", clients: Optional[Dict[str, Dict]] = None):
+        self.routing = routing
+        self.client_configs = load_clients() if clients is None else clients
+        self.clients: "OrderedDict[str, ClientLimiter]" = OrderedDict()
+        self.queue: List[Tuple[int, int, QueuedRequest]] = []
+        self.waiting = 0
+        self.seq = 0
+        self.changed = asyncio.Event()
+        self.pump_task: Optional[asyncio.Task] = None
+        self.reserved = 0  # 已放行、还没拿到 Lease 的请求数
+        self.admitted = 0
+        self.queued = 0
+        self.rejected: Dict[str, int] = {}
+        for limiter in routing.limiters.values():
+            limiter.on_release = self.changed.set
+
+    def identify(self, request: Request) -> ClientLimiter:
+        """按客户端的 API key 找限速器，没带 key 的按来源 IP 算"""
+        auth = request.headers.get("authorization", "")
+        api_key = auth[7:].strip() if auth[:7].lower() == "bearer " else ""
+        config = self.client_configs.get(api_key, {}) if api_key else {}
+        if config.get("name"):
+            name = config["name"]
+        elif api_key:
+            name = "key:" + hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:12]
+        else:
+            name = "ip:" + (request.client.host if request.client else "unknown")
+        limiter = self.clients.get(name)
+        if limiter is None:
+            limiter = self.clients[name] = ClientLimiter(
+                name,
+                rpm=per_worker(config.get("rpm", CLIENT_RPM)),
+                tpm=per_worker(config.get("tpm", CLIENT_TPM)),
+                priority=config.get("priority", CLIENT_PRIORITY)
+            )
+            if len(self.clients) > MAX_CLIENTS:
+                self.clients.popitem(last=False)
+        else:
+            self.clients.move_to_end(name)
+        return limiter
+
+    def reject(self, reason: str, retry_after: float, detail: str):
+        self.rejected[reason] = self.rejected.get(reason, 0) + 1
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail=detail,
+            headers={"Retry-After": str(max(1, math.ceil(retry_after)))}
+        )
+
+    def check_client(self, client: ClientLimiter, tokens: int):
+        reason, wait = client.check(tokens)
+        if reason:
+            client.rejected += 1
+            limit = "requests" if reason == "client_rpm" else "tokens"
+            self.reject(reason, wait, f"Rate limit exceeded for {client.name}: too many {limit} per minute")
+
+    def has_capacity(self, tokens: int, interactive: bool) -> bool:
+        """扣掉已预留的名额后，网关总在途数没满，并且可路由的服务商还有空位；一个可路由的都没有时交给 dispatch 返回 503"""
+        limiters = self.routing.limiters
+        if MAX_IN_FLIGHT and sum(limiter.in_flight for limiter in limiters.values()) + self.reserved >= MAX_IN_FLIGHT:
+            return False
+        ranked = self.routing.rank_providers(interactive)
+        return not ranked or sum(limiters[p["name"]].free_slots(tokens) for p in ranked) > self.reserved
+
+    async def acquire(self, priority: int, tokens: int, interactive: bool, deadline: "Deadline") -> Reservation:
+        """等到有上游名额，返回预留的名额（带排队的秒数）；队列满了或者等不到就抛 429"""
+        if not self.queue and self.has_capacity(tokens, interactive):
+            self.admitted += 1
+            return Reservation(self)
+        if self.waiting >= QUEUE_SIZE:
+            self.reject("queue_full", SATURATED_RETRY_AFTER, "Gateway overloaded, request queue is full")
+        budget = min(QUEUE_TIMEOUT, deadline.remaining() - MIN_ATTEMPT_TIMEOUT)
+        if budget <= 0:
+            self.reject("queue_timeout", SATURATED_RETRY_AFTER, "Gateway overloaded, no upstream capacity")
+
+        waiter = QueuedRequest(tokens, interactive)
+        self.seq += 1
+        heapq.heappush(self.queue, (priority, self.seq, waiter))
+        self.waiting += 1
+        self.queued += 1
+        if self.pump_task is None:
+            self.pump_task = asyncio.create_task(self._pump())
+        start = time.monotonic()
+        reservation = None
+        try:
+            async with asyncio.timeout(budget):
+                reservation = await waiter.future
+        except TimeoutError:
+            self.reject("queue_timeout", budget, f"Gateway overloaded, no upstream capacity within {budget:.1f}s")
+        finally:
+            self.waiting -= 1
+            if not waiter.future.done():
+                waiter.future.cancel()
+            elif reservation is None and not waiter.future.cancelled():
+                # 已经放行，但还没拿到结果就超时或者被取消了，预留的名额还回去
+                waiter.future.result().release()
+        self.admitted += 1
+        reservation.waited = time.monotonic() - start
+        return reservation
+
+    async def _pump(self):
+        """按优先级放行排队的请求，队头放不进去后面的也等着（不让小请求一直插队）"""
+        try:
+            while self.waiting:
+                self.changed.clear()
+                if len(self.queue) > 2 * self.waiting:
+                    # 超时、断开的请求留在堆里的空位，攒多了清一次
+                    self.queue = [entry for entry in self.queue if not entry[2].future.done()]
+                    heapq.heapify(self.queue)
+                while self.queue:
+                    waiter = self.queue[0][2]
+                    if waiter.future.done():
+                        heapq.heappop(self.queue)
+                        continue
+                    if not self.has_capacity(waiter.tokens, waiter.interactive):
+                        break
+                    heapq.heappop(self.queue)
+                    waiter.future.set_result(Reservation(self))
+                if self.waiting:
+                    try:
+                        async with asyncio.timeout(QUEUE_POLL_INTERVAL):
+                            await self.changed.wait()
+                    except TimeoutError:
+                        pass
+        finally:
+            self.pump_task = None
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "max_in_flight": MAX_IN_FLIGHT,
+            "in_flight": sum(limiter.in_flight for limiter in self.routing.limiters.values()),
+            "reserved": self.reserved,
+            "queue_size": QUEUE_SIZE,
+            "waiting": self.waiting,
+            "admitted": self.admitted,
+            "queued": self.queued,
+            "rejected": self.rejected,
+            "clients": len(self.clients)
+        }
+
+# 响应缓存配置：只缓存 temperature=0 的确定性请求
+CACHE_ENABLED = os.getenv("GATEWAY_CACHE", "0") == "1"
+CACHE_TTL = float(os.getenv("GATEWAY_CACHE_TTL", "3600"))  # 秒
+CACHE_MAX_BYTES = int(os.getenv("GATEWAY_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))  # 内存层总大小
+CACHE_MAX_ENTRY_BYTES = int(os.getenv("GATEWAY_CACHE_MAX_ENTRY_BYTES", str(1024 * 1024)))  # 单条上限
+CACHE_DB = os.getenv("GATEWAY_CACHE_DB")  # 设置后启用 SQLite 磁盘层，例如 gateway_cache.sqlite
+
+# 请求合并（single-flight）：deterministic 只合并 temperature=0 的请求，all 全部合并，off 关闭
+COALESCE_MODE = os.getenv("GATEWAY_COALESCE", "deterministic")
+
+def is_deterministic(body: Dict) -> bool:
+    return body.get("temperature") == 0 and (body.get("n") or 1) == 1
+
+def cache_key(payload: RequestPayload) -> Optional[str]:
+    """确定性请求的缓存键；不可缓存时返回 None"""
+    return payload.fingerprint if is_deterministic(payload.body) else None
+
+def coalesce_key(payload: RequestPayload) -> Optional[str]:
+    """请求合并的键；不参与合并时返回 None
+
+    非确定性请求默认不合并：同一个 prompt 的批量请求往往就是想要多个不同的采样结果。
+    """
+    if COALESCE_MODE == "off" or (COALESCE_MODE != "all" and not is_deterministic(payload.body)):
+        return None
+    return payload.fingerprint
+
+class CacheEntry(BaseModel):
+    body: bytes
+    content_type: str
+    stream: bool
+    created: float
+
+class ResponseCache:
+    """两级响应缓存：内存 LRU（TTL + 总字节数淘汰）+ 可选的 SQLite 磁盘层
+
+    磁盘层不用 DuckDB：mqtt_status.duckdb 被 server.py 进程独占写锁，
+    SQLite 是标准库自带的，不增加依赖。
+    """
+    def __init__(self, ttl: float = CACHE_TTL, max_bytes: int = CACHE_MAX_BYTES, db_path: Optional[str] = CACHE_DB):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.entries: "OrderedDict[str, CacheEntry]" = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.db: Optional[sqlite3.Connection] = None
+        self.db_lock = threading.Lock()
+        if db_path:
+            self.db = sqlite3.connect(db_path, check_same_thread=False)
+            self.db.execute("""
+            CREATE TABLE IF NOT EXISTS response_cache (
+                key TEXT PRIMARY KEY,
+                body BLOB,
+                content_type TEXT,
+                stream INTEGER,
+                created REAL
+            )
+            """)
+            self.db.commit()
+
+    def _remember(self, key: str, entry: CacheEntry):
+        if key in self.entries:
+            self.bytes -= len(self.entries.pop(key).body)
+        self.entries[key] = entry
+        self.bytes += len(entry.body)
+        while self.bytes > self.max_bytes and self.entries:
+            _, evicted = self.entries.popitem(last=False)
+            self.bytes -= len(evicted.body)
+            self.evictions += 1
+
+    def _disk_get(self, key: str) -> Optional[CacheEntry]:
+        with self.db_lock:
+            row = self.db.execute(
+                "SELECT body, content_type, stream, created FROM response_cache WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            return None
+        return CacheEntry(body=row[0], content_type=row[1], stream=bool(row[2]), created=row[3])
+
+    def _disk_put(self, key: str, entry: CacheEntry):
+        with self.db_lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO response_cache VALUES (?, ?, ?, ?, ?)",
+                (key, entry.body, entry.content_type, int(entry.stream), entry.created)
+            )
+            self.db.execute("DELETE FROM response_cache WHERE created < ?", (time.time() - self.ttl,))
+            self.db.commit()
+
+    async def get(self, key: str) -> Optional[CacheEntry]:
+        now = time.time()
+        entry = self.entries.get(key)
+        if entry is not None and now - entry.created < self.ttl:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+        if entry is not None:
+            self.bytes -= len(self.entries.pop(key).body)
+        if self.db is not None:
+            entry = await asyncio.to_thread(self._disk_get, key)
+            if entry is not None and now - entry.created < self.ttl:
+                self._remember(key, entry)
+                self.hits += 1
+                self.disk_hits += 1
+                return entry
+        self.misses += 1
+        return None
+
+    async def put(self, key: str, body: bytes, content_type: str, stream: bool):
+        if len(body) > CACHE_MAX_ENTRY_BYTES:
+            return
+        entry = CacheEntry(body=body, content_type=content_type, stream=stream, created=time.time())
+        self._remember(key, entry)
+        self.stores += 1
+        if self.db is not None:
+            await asyncio.to_thread(self._disk_put, key, entry)
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    def snapshot(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": CACHE_ENABLED,
+            "entries": len(self.entries),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "stores": self.stores,
+            "evictions": self.evictions,
+            "disk": self.db is not None
+        }
+
+class StreamBroadcast:
+    """把一路上游 SSE 流分发给多个订阅者
+
+    后台任务从上游读取并保存所有 chunk，每个订阅者从头按自己的进度读，
+    晚到的订阅者也能拿到完整的流。上游读取不再受最慢的订阅者限制，
+    内存占用以一次完整响应为上限；所有订阅者都断开后停止读取上游。
+    """
+    def __init__(self, source: AsyncIterator[bytes], on_done):
+        self.chunks: List[bytes] = []
+        self.done = False
+        self.subscribers = 0
+        self.changed = asyncio.Condition()
+        self.on_done = on_done
+        self.task = asyncio.create_task(self._pump(source))
+
+    async def _pump(self, source: AsyncIterator[bytes]):
+        try:
+            async for chunk in source:
+                self.chunks.append(chunk)
+                async with self.changed:
+                    self.changed.notify_all()
+        except Exception as e:
+            log_event(log, logging.ERROR, "stream_broadcast_error", error=str(e))
+        finally:
+            await source.aclose()
+            self.done = True
+            async with self.changed:
+                self.changed.notify_all()
+            self.on_done()
+
+    async def subscribe(self) -> AsyncIterator[bytes]:
+        self.subscribers += 1
+        index = 0
+        try:
+            while True:
+                while index < len(self.chunks):
+                    yield self.chunks[index]
+                    index += 1
+                if self.done:
+                    return
+                async with self.changed:
+                    await self.changed.wait_for(lambda: index < len(self.chunks) or self.done)
+        finally:
+            self.subscribers -= 1
+            if self.subscribers == 0 and not self.done:
+                self.task.cancel()
+
+class Flight:
+    """一次正在进行中的上游请求，后来的相同请求等它的结果"""
+    def __init__(self, key: str, registry: "SingleFlight"):
+        self.key = key
+        self.registry = registry
+        self.result: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.followers = 0
+
+    def fail(self, error: Exception):
+        # 以结果的形式保存异常，没有跟随者时也不会出现 "exception was never retrieved"
+        self.result.set_result(error)
+        self.registry.finish(self)
+
+    def abandon(self):
+        """领头请求的客户端断开了，跟随者各自重新发起"""
+        self.result.set_result(None)
+        self.registry.finish(self)
+
+    def lead(self, response: Response) -> Response:
+        """领头请求拿到了响应：普通响应直接共享 body，流式响应改为广播"""
+        if isinstance(response, StreamingResponse):
+            broadcast = StreamBroadcast(response.body_iterator, on_done=lambda: self.registry.finish(self))
+            shared = (broadcast, response.status_code, dict(response.headers))
+            self.result.set_result(shared)
+            return StreamingResponse(
+                content=broadcast.subscribe(),
+                status_code=response.status_code,
+                headers=dict(response.headers)
+            )
+        self.result.set_result(response)
+        self.registry.finish(self)
+        return response
+
+    async def join(self) -> Optional[Response]:
+        """等领头请求的结果；返回 None 表示领头请求被放弃，需要自己发起"""
+        self.followers += 1
+        self.registry.coalesced += 1
+        outcome = await asyncio.shield(self.result)
+        if outcome is None:
+            return None
+        if isinstance(outcome, Exception):
+            raise outcome
+        if isinstance(outcome, tuple):
+            broadcast, status_code, headers = outcome
+            headers = {**headers, "X-Gateway-Coalesced": "1"}
+            return StreamingResponse(content=broadcast.subscribe(), status_code=status_code, headers=headers)
+        headers = {k: v for k, v in outcome.headers.items() if k.lower() != "content-length"}
+        headers["X-Gateway-Coalesced"] = "1"
+        return Response(content=outcome.body, status_code=outcome.status_code, headers=headers)
+
+class SingleFlight:
+    """相同请求的合并表：key -> 正在进行的 Flight"""
+    def __init__(self):
+        self.flights: Dict[str, Flight] = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    def get(self, key: str) -> Optional[Flight]:
+        return self.flights.get(key)
+
+    def start(self, key: str) -> Flight:
+        flight = Flight(key, self)
+        self.flights[key] = flight
+        self.leaders += 1
+        return flight
+
+    def finish(self, flight: Flight):
+        if self.flights.get(flight.key) is flight:
+            del self.flights[flight.key]
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "mode": COALESCE_MODE,
+            "in_flight": len(self.flights),
+            "leaders": self.leaders,
+            "coalesced": self.coalesced
+        }
+
+class SSEMeter:
+    """粗略统计 SSE 事件数（约等于输出 token 数），跨 chunk 边界也不会漏算"""
+    def __init__(self):
+        self.events = 0
+        self._tail = b""
+
+    def feed(self, chunk: bytes):
+        data = self._tail + chunk
+        self.events += data.count(b"data:")
+        # 保留 4 个字节就够拼出跨边界的 "data:"，又不会被重复计数
+        self._tail = data[-4:]
+
+class RoutingManager:
+    def __init__(self, strategy: Optional[BalancingStrategy] = None):
         self.provider_stats = {p["name"]: ProviderStatus() for p in PROVIDERS}
         self.history = []
+        self.windows = {p["name"]: ProviderWindow() for p in PROVIDERS}
+        self.breakers = {p["name"]: CircuitBreaker() for p in PROVIDERS}
+        self.limiters = {p["name"]: ProviderLimiter(p) for p in PROVIDERS}
+        self.traffic = TrafficHealth()
+        self.bus: Optional[WorkerBus] = None  # 多 worker 时把本地记录的结果广播给其他 worker
+        if strategy is None:
+            if BALANCER not in BALANCING_STRATEGIES:
+                log_event(log, logging.WARNING, "unknown_balancer", balancer=BALANCER, fallback="weighted")
+            strategy = BALANCING_STRATEGIES.get(BALANCER, WeightedRandomStrategy)()
+        self.strategy = strategy
         
-    def update_stats(self, provider: str, success: bool, response_time: float):
-        # 其他统计逻辑保持不变...
+    def update_stats(self, provider: str, success: bool, response_time: Optional[float], trial: Optional[int] = None,
+                     probe: bool = False):
+        """记录一次请求结果
+
+        延迟只统计成功的请求（失败的 response_time 只是惩罚值，None 表示这次结果不带可比的延迟），
+        失败由窗口错误率体现，这样旧数据会随时间淡出，不会越平均越小。
+        是否下线交给熔断器决定，单次失败不会让服务商直接掉线；
+        熔断器没有计入的结果（熔断期间回来的非试探请求）也不改变在线状态。
+        """
         stats = self.provider_stats[provider]
-        stats.online = success
+        window = self.windows[provider]
+        breaker = self.breakers[provider]
+        window.errors.add(success)
+        if success and response_time is not None:
+            window.latency.add(response_time)
+        if breaker.record(success, trial=trial, probe=probe):
+            stats.online = success or (breaker.state == CircuitBreaker.CLOSED and stats.online)
         stats.total_requests += 1
         stats.failed_requests += 0 if success else 1
-        stats.success_rate = 1 - (stats.failed_requests / stats.total_requests)
-        stats.response_time = (stats.response_time + response_time) / stats.total_requests
+        stats.success_rate = 1 - window.errors.error_rate()
+        stats.response_time = window.latency.ewma
         stats.last_check = datetime.now()
-        print(provider,":",stats)
+        log_event(
+            log, logging.DEBUG, "provider_stats", provider=provider, success=success, online=stats.online,
+            success_rate=round(stats.success_rate, 4), response_time=round(stats.response_time, 1)
+        )
+
+    def share(self, *event):
+        if self.bus is not None:
+            self.bus.publish(list(event))
+
+    def record_traffic(self, provider: str, success: bool, response_time: float, error: Optional[str] = None,
+                       share: bool = True, trial: Optional[int] = None):
+        """记录一次真实请求的结果：和探测结果一样更新统计，同时计入被动健康汇总
+
+        share=False 用于应用其他 worker 广播过来的结果，不再转发；
+        trial 是半开时这次试探的凭证，只对本 worker 的熔断器有意义，不广播。
+        """
+        self.update_stats(provider, success, response_time, trial=trial)
+        self.traffic.record(provider, success, response_time if success else None, error)
+        if not success:
+            self.provider_stats[provider].last_error = error
+        if share:
+            self.share("traffic", provider, success, response_time, error)
+
+    def record_seen(self, provider: str, share: bool = True):
+        """服务商刚有过流量，但结果不说明它健康与否（客户端断开、请求本身有问题）"""
+        self.traffic.seen(provider)
+        if share:
+            self.share("seen", provider)
+
+    def record_stream(self, provider: str, ttft: float, tokens_per_sec: float, share: bool = True):
+        """记录一次流式请求的首 token 耗时和输出速度"""
+        if share:
+            self.share("stream", provider, ttft, tokens_per_sec)
+        stats = self.provider_stats[provider]
+        window = self.windows[provider]
+        window.ttft.add(ttft)
+        if stats.stream_requests == 0:
+            stats.tokens_per_sec = tokens_per_sec
+        else:
+            stats.tokens_per_sec += STREAM_EWMA_ALPHA * (tokens_per_sec - stats.tokens_per_sec)
+        stats.ttft = window.ttft.ewma
+        stats.stream_requests += 1
+
+    def record_first_byte(self, provider: str, latency: float, share: bool = True):
+        self.windows[provider].first_byte.add(latency)
+        if share:
+            self.share("first_byte", provider, latency)
+
+    def apply_shared(self, event: List[Any]):
+        """应用其他 worker 广播的一条记录"""
+        kind, provider, *args = event
+        if provider not in self.provider_stats:
+            return
+        if kind == "traffic":
+            self.record_traffic(provider, *args, share=False)
+        elif kind == "seen":
+            self.record_seen(provider, share=False)
+        elif kind == "stream":
+            self.record_stream(provider, *args, share=False)
+        elif kind == "first_byte":
+            self.record_first_byte(provider, *args, share=False)
 
-    def get_best_provider(self) -> Optional[Dict]:
+    def hedge_delay(self, provider: str) -> float:
+        """对冲等待时间（毫秒）：该服务商首字节耗时的滚动分位数"""
+        samples = self.windows[provider].first_byte
+        if len(samples.samples) < HEDGE_MIN_SAMPLES:
+            return HEDGE_DEFAULT_DELAY
+        return max(HEDGE_MIN_DELAY, samples.quantile(HEDGE_QUANTILE))
+
+    def snapshot(self) -> Dict[str, Any]:
+        """各服务商的滑动窗口统计，给 /v1/gateway/stats 用"""
+        result = {}
+        for name, window in self.windows.items():
+            stats = self.provider_stats[name]
+            result[name] = {
+                "online": stats.online,
+                "last_check": stats.last_check.isoformat() if stats.last_check != datetime.min else None,
+                "last_error": stats.last_error,
+                "total_requests": stats.total_requests,
+                "failed_requests": stats.failed_requests,
+                "window_requests": window.errors.total,
+                "error_rate": round(window.errors.error_rate(), 4),
+                "latency_ms": window.latency.snapshot(),
+                "first_byte_ms": window.first_byte.snapshot(),
+                "ttft_ms": window.ttft.snapshot(),
+                "tokens_per_sec": round(stats.tokens_per_sec, 2),
+                "circuit": self.breakers[name].snapshot(),
+                "limits": self.limiters[name].snapshot(),
+                "score": round(window.score(), 2),
+                "interactive_score": round(window.score(interactive=True), 2)
+            }
+        return result
+
+    def get_best_provider(self, interactive: bool = False, tokens: int = 0) -> Optional[Dict]:
+        """按负载均衡策略挑选服务商
+
+        interactive=True 时（流式请求）优先看首 token 耗时；
+        并发、RPM、TPM 已满的服务商不参与挑选。
+        """
+        ranked = self.rank_providers(interactive)
+        now = time.time()
+        candidates = [p for p in ranked if self.limiters[p["name"]].has_capacity(tokens, now)]
+        my_choice = self.strategy.choose(candidates, self, interactive) if candidates else None
+        log_event(
+            log, logging.DEBUG, "route", provider=my_choice["name"] if my_choice else None,
+            candidates=len(candidates), interactive=interactive
+        )
+        return my_choice
+
+    def has_capacity(self, provider: str, tokens: int = 0) -> bool:
+        return self.limiters[provider].has_capacity(tokens)
+
+    def is_routable(self, provider: str, now: Optional[float] = None) -> bool:
+        """熔断器放行，并且在线或者正处于可以试探的恢复阶段"""
+        breaker = self.breakers[provider]
+        if not breaker.available(now):
+            return False
+        return self.provider_stats[provider].online or breaker.state != CircuitBreaker.CLOSED
+
+    def rank_providers(self, interactive: bool = False) -> List[Dict]:
+        """按综合评分从好到差排列当前可用的服务商"""
         available = []
+        now = time.time()
         for provider in PROVIDERS:
-            stats = self.provider_stats[provider["name"]]
-            if stats.online and stats.success_rate > 0.7:
-                available.append((provider, stats))
+            if not self.is_routable(provider["name"], now):
+                continue
+            # 根据滑动窗口的延迟和错误率综合评分，每个服务商 O(1)
+            available.append((self.windows[provider["name"]].score(interactive), provider))
         
-        if not available:
-            return None
-        
-        my_choice = min(
-            available,
-            key=lambda x: (x[1].response_time * 0.6 + (1 - x[1].success_rate) * 0.4)
-        )[0]
+        available.sort(key=lambda x: x[0])
+        return [provider for _, provider in available]
 
-        print("get_best_provider:",my_choice)
-        # 根据响应时间和成功率综合评分
-        return my_choice
+# 是否由网关自己主动探测；monitor.py 配了 GATEWAY_PROBE_URL 把结果推过来时可以设为 0，避免重复探测
+GATEWAY_PROBES = os.getenv("GATEWAY_PROBES", "1") == "1"
+
+class ProbeStatus(BaseModel):
+    """探测结果，和 server.py 的 Status 结构一致"""
+    provider: str
+    online: bool
+    response_time: float | None = None
+    error: str | None = None
+    timestamp: int
 
 class APIMonitor:
-    def __init__(self, routing: RoutingManager):
-        #这里相当于是依赖注入了对应的路由管理器
+    def __init__(self, routing: RoutingManager, pool: ProviderPool):
+        #这里相当于是依赖注入了对应的路由管理器和连接池
         self.routing = routing
-        
-    async def check_provider(self, provider: Dict):
-        """使用OpenAI SDK进行健康检查"""
-        status = self.routing.provider_stats[provider["name"]]
-        """异步检查单个服务商可用性"""
-        api_key = os.getenv(provider["env_var"])
-        if not api_key:
-            return
-            
-        try:
-            client = AsyncOpenAI(
-                api_key=api_key,
-                base_url=provider["base_url"],
-                timeout=10.0
-            )
-            start_time = time.time()
-            # 发送真实的API请求测试
-            response = await client.chat.completions.create(
-                messages=[{"role": "user", "content": "ping"}],
-                model=provider["model"],
-                max_tokens=5,
-                temperature=0.1
-            )
-            # 验证响应有效性
-            if not response.choices or not response.choices[0].message.content:
-                raise ValueError("Invalid API response")
-            
-            latency = (time.time() - start_time) * 1000  # 毫秒
+        self.pool = pool
+        # 共享的探测引擎，健康检查复用网关的连接池，结果直接喂给 RoutingManager
+        # 最近有真实流量的服务商不做主动探测，健康状况直接从流量里看
+        self.engine = ProbeEngine(
+            PROVIDERS,
+            [CallbackSink(self.on_probe)],
+            client_factory=lambda provider: pool.client(provider["name"]),
+            skip_unconfigured=True,
+            should_probe=lambda provider: routing.traffic.idle(provider["name"])
+        )
+        # 从真实流量汇总出来的状态记录发到这里
+        self.traffic_sinks: List[ProbeSink] = [HttpSink(GATEWAY_STATUS_URL)] if GATEWAY_STATUS_URL else []
+        # 多 worker 时只有拿到探测锁的 worker 探测和上报流量汇总，单进程时自己就是
+        self.leader = ProbeLeader(SHARED_DIR) if WORKERS > 1 and SHARED_DIR else None
+        self.leading = asyncio.Event()
+        if self.leader is None:
+            self.leading.set()
+        self.latest: Dict[str, Dict] = {}  # 每个服务商最近一次探测结果，新 worker 启动时发给它
 
+    def on_probe(self, result: Dict, share: bool = True):
+        """处理一次探测结果（自己探测的、monitor.py 推过来的，或者其他 worker 广播的）"""
+        name = result["provider"]
+        if name not in self.routing.provider_stats or result["error"] == MISSING_API_KEY:
+            return
+        self.latest[name] = result
+        if share:
+            self.routing.share("probe", result)
+        status = self.routing.provider_stats[name]
+        if result["online"]:
+            # connect / models 探测只有几毫秒，和真实请求的延迟不可比，只记成败，不进延迟窗口和评分
+            # （耗时仍然可以在 /v1/gateway/probes 的 timings 里看到）
+            provider = next(p for p in PROVIDERS if p["name"] == name)
+            response_time = result["response_time"] if self.engine.strategy(provider) == "completion" else None
             #对RoutingManager上报最新的情况
-            self.routing.update_stats(
-                provider["name"],
-                success=True,
-                response_time=latency
-            )
-            status.online = True
+            self.routing.update_stats(name, success=True, response_time=response_time, probe=True)
             status.retry_count = 0
             status.last_error = None
-
-        except Exception as e:
-            status.online = False
-            status.last_error = self._format_error(e)
+        else:
+            status.last_error = result["error"]
             status.retry_count += 1
-            self.routing.update_stats(
-                provider["name"],
-                success=False,
-                response_time=30000  #失败一次我就给你加30秒的惩罚
-            )
-        
-        finally:
-            status.last_check = datetime.now()
-    
-    def _format_error(self, e: Exception) -> str:
-        """格式化错误信息"""
-        if isinstance(e, APIConnectionError):
-            return f"Connection error: {e.__cause__}"
-        elif isinstance(e, APIError):
-            return f"API error: {e.code} {e.message}"
-        return f"{type(e).__name__}: {str(e)}"
+            #失败一次我就给你加30秒的惩罚
+            self.routing.update_stats(name, success=False, response_time=ERROR_PENALTY_MS, probe=True)
+        status.last_check = datetime.now()
 
     async def run_continuous_check(self):  # 修复2：正确的方法名称
-        """持续运行健康检查"""
+        """持续运行健康检查
+
+        探测引擎按自适应间隔检查每个服务商（出问题的查得勤，健康的查得少）；
+        另外每隔几秒看一眼熔断到期的服务商，唤醒一次探测代替真实流量去试探，
+        恢复了就不用等下一次计划的检查。
+        """
+        tasks = [self.watch_breakers(), self.report_traffic(), self.elect()]
+        if GATEWAY_PROBES:
+            tasks.append(self.run_probes())
+        await asyncio.gather(*tasks)
+
+    async def elect(self):
+        """多 worker 时反复尝试拿探测锁，持有锁的 worker 退出后由其他 worker 接手"""
+        if self.leader is None:
+            return
+        try:
+            while not self.leader.try_acquire():
+                await asyncio.sleep(LEADER_RETRY)
+            log_event(log, logging.INFO, "prober_elected", pid=os.getpid())
+            self.leading.set()
+            await asyncio.Event().wait()
+        finally:
+            self.leader.release()
+
+    async def run_probes(self):
+        await self.leading.wait()
+        await self.engine.run()
+
+    async def report_traffic(self):
+        """定期把真实流量汇总成状态记录（和 server.py 的 Status 同结构）发给 traffic_sinks"""
+        try:
+            while True:
+                await asyncio.sleep(PASSIVE_REPORT_INTERVAL)
+                online = {name: stats.online for name, stats in self.routing.provider_stats.items()}
+                reports = self.routing.traffic.drain(online)
+                if not self.leading.is_set():
+                    # 所有 worker 的流量都广播到了 leader，由它统一上报，其他 worker 只清空
+                    continue
+                for report in reports:
+                    results = await asyncio.gather(
+                        *(sink.publish(report) for sink in self.traffic_sinks), return_exceptions=True
+                    )
+                    for result in results:
+                        if isinstance(result, Exception):
+                            log_event(log, logging.WARNING, "traffic_report_failed", provider=report["provider"], error=str(result))
+        finally:
+            for sink in self.traffic_sinks:
+                await sink.close()
+
+    async def watch_breakers(self):
         while True:
             try:
-                await self.run_health_check_cycle()  # 修复3：调用实际检查方法
-                await asyncio.sleep(300)
-            except asyncio.CancelledError:
-                break
+                self.probe_recovering()
             except Exception as e:
-                print(f"Monitor error: {str(e)}")
-                await asyncio.sleep(60)
-    
+                log_event(log, logging.ERROR, "monitor_error", error=str(e))
+            await asyncio.sleep(CB_PROBE_TICK)
+
+    def probe_recovering(self):
+        """对熔断时间已到的服务商发起试探；不主动探测（或者不是探测 worker）时留给真实流量去试探"""
+        if not GATEWAY_PROBES or not self.leading.is_set():
+            return
+        now = time.time()
+        for provider in PROVIDERS:
+            breaker = self.routing.breakers[provider["name"]]
+            if breaker.state == CircuitBreaker.OPEN and breaker.available(now) and breaker.allow_request(now):
+                self.engine.wake(provider["name"])
+
     async def run_health_check_cycle(self):
         """执行完整健康检查周期"""
-        tasks = []
-        for provider in PROVIDERS:
-            tasks.append(self.check_provider(provider))
-        await asyncio.gather(*tasks)
+        await self.engine.probe_all()
         #都跑完了打印一个你当前的最佳选择给我们看看呗
         self.routing.get_best_provider()
 
+class GatewayMetrics:
+    """/metrics 暴露的指标，耗时都以秒为单位
+
+    outcome 取 success / error（算服务商的失败）/ rejected（请求本身的问题）/ cancelled（客户端断开或对冲落败）
+    """
+    def __init__(self):
+        self.registry = MetricsRegistry()
+        self.upstream_latency = self.registry.histogram(
+            "gateway_upstream_latency_seconds",
+            "Upstream request duration until the response (or the last stream chunk) is received",
+            ("provider", "outcome")
+        )
+        self.first_byte = self.registry.histogram(
+            "gateway_upstream_first_byte_seconds", "Upstream time to response headers", ("provider",)
+        )
+        self.ttft = self.registry.histogram(
+            "gateway_ttft_seconds", "Time to the first streamed chunk", ("provider",)
+        )
+        self.overhead = self.registry.histogram(
+            "gateway_overhead_seconds",
+            "Time spent in the gateway from the parsed body to the first upstream send",
+            ("provider",), FAST_BUCKETS
+        )
+        self.body_parse = self.registry.histogram(
+            "gateway_body_parse_seconds", "Request body parse time", ("outcome",), FAST_BUCKETS
+        )
+        self.queue_wait = self.registry.histogram(
+            "gateway_queue_wait_seconds", "Time waiting for an upstream connection from the pool",
+            ("provider",), FAST_BUCKETS
+        )
+        self.failovers = self.registry.counter(
+            "gateway_failovers", "Requests served by a backup after the first provider failed", ("provider",)
+        )
+        self.failover_stops = self.registry.counter(
+            "gateway_failover_stops",
+            "Failed requests that were not retried further: not_retryable, no_backup, deadline, budget or max_attempts",
+            ("reason",)
+        )
+        self.in_flight = self.registry.gauge(
+            "gateway_upstream_in_flight", "Upstream requests in flight", ("provider",)
+        )
+        self.admission_wait = self.registry.histogram(
+            "gateway_admission_wait_seconds", "Time queued for upstream capacity before routing"
+        )
+        self.admission_queue = self.registry.gauge(
+            "gateway_admission_queue_depth", "Requests waiting for upstream capacity"
+        )
+        self.admission_rejected = self.registry.counter(
+            "gateway_admission_rejected",
+            "Requests shed with 429: client_rpm, client_tpm, queue_full or queue_timeout",
+            ("reason",)
+        )
+        self.online = self.registry.gauge("gateway_provider_online", "Provider online (1) or offline (0)", ("provider",))
+        self.circuit = self.registry.gauge(
+            "gateway_circuit_state", "Circuit breaker state, 1 for the current state", ("provider", "state")
+        )
+
+    def render(self, routing: "RoutingManager", pool: ProviderPool, admission: AdmissionController) -> str:
+        """状态类的指标在抓取时从 RoutingManager、连接池和准入控制现取"""
+        self.admission_queue.set(admission.waiting)
+        for reason, count in admission.rejected.items():
+            self.admission_rejected.set_total(count, reason=reason)
+        for name, metrics in pool.metrics_by_provider.items():
+            self.in_flight.set(metrics.in_flight, provider=name)
+        for name, stats in routing.provider_stats.items():
+            self.online.set(1 if stats.online else 0, provider=name)
+            state = routing.breakers[name].state
+            for candidate in (CircuitBreaker.CLOSED, CircuitBreaker.HALF_OPEN, CircuitBreaker.OPEN):
+                self.circuit.set(1 if candidate == state else 0, provider=name, state=candidate)
+        return self.registry.render()
+
 class OpenAIGateway:
     def __init__(self):
         self.app = FastAPI(title="AI Gateway")
         self.routing = RoutingManager()
-        self.monitor = APIMonitor(self.routing)
+        self.pool = ProviderPool()
+        self.monitor = APIMonitor(self.routing, self.pool)
         self.background_tasks: Set[asyncio.Task] = set()
+        self.hedge_budget = HedgeBudget()
+        self.cache = ResponseCache() if CACHE_ENABLED else None
+        self.flights = SingleFlight()
+        self.retry_budget = RetryBudget()
+        self.admission = AdmissionController(self.routing)
+        self.metrics = GatewayMetrics()
+        self.bus: Optional[WorkerBus] = None
 
         
         # 使用新的 lifespan 处理机制
@@ -191,6 +1702,14 @@ class OpenAIGateway:
         async def lifespan(app: FastAPI) -> AsyncIterator[None]:
             """生命周期管理"""
             # 启动阶段
+            log_listener.start()
+            await self.pool.start()
+            if WORKERS > 1 and SHARED_DIR:
+                self.bus = WorkerBus(SHARED_DIR, self.on_peer_event)
+                await self.bus.start()
+                self.routing.bus = self.bus
+                # 让负责探测的 worker 把最近的探测结果发过来
+                self.bus.publish(["hello"])
             monitor_task = asyncio.create_task(self.monitor.run_continuous_check())
             self.background_tasks.add(monitor_task)
             monitor_task.add_done_callback(self.background_tasks.discard)
@@ -198,12 +1717,19 @@ class OpenAIGateway:
             yield  # 应用运行阶段
             
             # 关闭阶段
-            for task in self.background_tasks:
+            for task in list(self.background_tasks):
                 task.cancel()
                 try:
                     await task
                 except asyncio.CancelledError:
                     pass
+            if self.bus is not None:
+                self.routing.bus = None
+                await self.bus.close()
+            await self.pool.close()
+            if self.cache is not None:
+                self.cache.close()
+            log_listener.stop()
 
         self.app = FastAPI(
             title="AI Gateway",
@@ -216,120 +1742,643 @@ class OpenAIGateway:
             self.chat_completion,
             methods=["POST"]
         )
+        self.app.add_api_route(
+            "/v1/gateway/pools",
+            self.pool_metrics,
+            methods=["GET"]
+        )
+        self.app.add_api_route(
+            "/v1/gateway/stats",
+            self.gateway_stats,
+            methods=["GET"]
+        )
+        self.app.add_api_route(
+            "/v1/gateway/cache",
+            self.cache_metrics,
+            methods=["GET"]
+        )
+        self.app.add_api_route(
+            "/v1/gateway/coalescing",
+            self.coalescing_metrics,
+            methods=["GET"]
+        )
+        self.app.add_api_route(
+            "/v1/gateway/hedging",
+            self.hedging_metrics,
+            methods=["GET"]
+        )
+        self.app.add_api_route(
+            "/v1/gateway/retries",
+            self.retry_metrics,
+            methods=["GET"]
+        )
+        self.app.add_api_route(
+            "/v1/gateway/admission",
+            self.admission_metrics,
+            methods=["GET"]
+        )
+        self.app.add_api_route(
+            "/v1/gateway/probe",
+            self.receive_probe,
+            methods=["POST"]
+        )
+        self.app.add_api_route(
+            "/v1/gateway/probes",
+            self.probe_metrics,
+            methods=["GET"]
+        )
+        self.app.add_api_route(
+            "/v1/gateway/workers",
+            self.worker_metrics,
+            methods=["GET"]
+        )
+        self.app.add_api_route(
+            "/metrics",
+            self.prometheus_metrics,
+            methods=["GET"]
+        )
+
+    async def forward_request(self, provider: Dict, payload: RequestPayload, tokens: int = 0,
+                              timeout: float = REQUEST_TIMEOUT):
+        """转发请求到指定服务商
 
-    async def forward_request(self, provider: Dict, request: Request):
-        print("进入了forward_request")
-        """转发请求到指定服务商"""
+        以 stream=True 发送，非流式请求拿到响应头就返回，响应体由调用方读取；
+        流式请求再多等第一个 chunk，上游还没吐出内容就断掉的流也能换服务商重试。
+        timeout 限制拿到响应头（流式是第一个 chunk）之前的总时间，也作为后续每次读取的超时。
+        返回的 content 是尚未读完的 httpx.Response，用完必须关闭；
+        返回的 lease 是并发名额，请求彻底结束时释放。
+        失败都抛 HTTPException：上游的状态码原样保留，超时 504，连接等其他错误 502。
+        """
         api_key = os.getenv(provider["env_var"])
         if not api_key:
-            raise ValueError(f"Missing API key for {provider['name']}")
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail=f"Missing API key for {provider['name']}"
+            )
+        breaker = self.routing.breakers[provider["name"]]
+        if not breaker.allow_request():
+            # 熔断中直接失败，不占用连接也不等超时
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail=f"Circuit open for {provider['name']}"
+            )
+        trial = breaker.trial_token()
+        lease = self.routing.limiters[provider["name"]].acquire(tokens)
+        if payload.reservation is not None:
+            # 名额已经真正占上了，准入时预留的那份还回去
+            payload.reservation.release()
+        name = provider["name"]
+        timer = None
+        response = None
             
         try:
-            original_body = await request.json()
-            modified_body = original_body.copy()
-            modified_body["model"] = provider["model"]
-            stream_mode = modified_body.get("stream", False)  # 获取流式模式标志
-
-            async with httpx.AsyncClient(base_url=provider["base_url"]) as client:
-                # 添加流式传输支持
-                stream = modified_body.get("stream", False)
-                
+            # 请求体已经解析过一次，这里只在字节上改写 model
+            content = payload.for_model(provider["model"])
+            stream_mode = payload.stream  # 获取流式模式标志
+
+            client = self.pool.client(provider["name"])
+            async with self.pool.track(provider["name"]):
                 start = time.time()
-                response = await client.post(
+                # trace 扩展记下拿到连接的时间点，算出在连接池里排队的时间
+                timer = ProbeTimer()
+                upstream_request = client.build_request(
+                    "POST",
                     "/chat/completions",
-                    json=modified_body,
+                    content=content,
                     headers={
                         "Authorization": f"Bearer {api_key}",
                         "Content-Type": "application/json"
                     },
-                    timeout=30,
-                    # 关键修改：根据stream参数启用流式响应
-                    follow_redirects=stream_mode
+                    timeout=timeout,
+                    extensions={"trace": timer.trace}
                 )
+                if not payload.forwarded:
+                    payload.forwarded = True
+                    self.metrics.overhead.observe(timer.start - payload.received, provider=name)
+                async with asyncio.timeout(timeout):
+                    response = await client.send(upstream_request, stream=True)
+                    first_byte = time.time() - start
+                self.routing.record_first_byte(provider["name"], first_byte * 1000)
+                self.metrics.first_byte.observe(first_byte, provider=name)
+                acquired = [
+                    timer.marks[event] for event in ("connection.connect_tcp.started", "send_request_headers.started")
+                    if event in timer.marks
+                ]
+                if acquired:
+                    self.metrics.queue_wait.observe(min(acquired) - timer.start, provider=name)
+                if not response.is_success:
+                    # raise_for_status 对 3xx 也会抛，错误信息要用到响应体，先读完再关闭
+                    await response.aread()
+                    await response.aclose()
                 response.raise_for_status()
 
-                # 更新统计信息
-                self.routing.update_stats(
-                    provider["name"],
-                    True,
-                    (time.time() - start) * 1000
-                )
+                chunks, first_chunk, first_chunk_at = None, None, None
+                if stream_mode:
+                    chunks = response.aiter_bytes()
+                    first_chunk = await anext(chunks, b"")
+                    first_chunk_at = time.time() if first_chunk else None
 
-                # 返回原始响应内容和 headers，并携带流式模式标志
+                # 返回尚未读完的响应和过滤后的 headers，并携带流式模式标志
                 return {
                     "content": response,
-                    "headers": dict(response.headers),
+                    "headers": self._relay_headers(response.headers),
                     "status_code": response.status_code,
-                    "stream": stream_mode  # 新增流式模式标志
+                    "stream": stream_mode,
+                    "start": start,
+                    "lease": lease,
+                    "chunks": chunks,
+                    "first_chunk": first_chunk,
+                    "first_chunk_at": first_chunk_at,
+                    "trial": trial
                 }
                 
+        except asyncio.CancelledError:
+            lease.release()
+            if response is not None:
+                # 已经被取消了，关闭连接交给单独的任务
+                asyncio.create_task(response.aclose())
+            self.observe_upstream(name, timer, "cancelled")
+            raise
         except httpx.HTTPStatusError as e:
-            self.routing.update_stats(provider["name"], False, 30000)
+            lease.release()
+            self.observe_upstream(name, timer, "error" if is_provider_error(e.response.status_code) else "rejected")
+            if is_provider_error(e.response.status_code):
+                self.routing.record_traffic(provider["name"], False, ERROR_PENALTY_MS, f"API error: {e.response.status_code}",
+                                            trial=trial)
+            else:
+                # 请求本身的问题，不算服务商失败，只说明它刚有过流量
+                self.routing.record_seen(provider["name"])
             # 改为抛出HTTPException而不是返回JSONResponse
             raise HTTPException(
                 status_code=e.response.status_code,
                 detail=f"Upstream error: {e.response.text}"
             )
         except Exception as e:
-            self.routing.update_stats(provider["name"], False, 30000)
+            lease.release()
+            if response is not None:
+                await response.aclose()
+            self.observe_upstream(name, timer, "error")
+            timed_out = isinstance(e, (TimeoutError, httpx.TimeoutException))
+            error = f"Upstream timeout after {timeout:.1f}s" if timed_out else f"{type(e).__name__}: {e}"
+            self.routing.record_traffic(provider["name"], False, ERROR_PENALTY_MS, error, trial=trial)
+            raise HTTPException(
+                status_code=status.HTTP_504_GATEWAY_TIMEOUT if timed_out else status.HTTP_502_BAD_GATEWAY,
+                detail=error
+            )
+
+    def observe_upstream(self, provider: str, timer: Optional[ProbeTimer], outcome: str):
+        """记一次上游耗时，timer 为 None 说明请求还没发出去"""
+        if timer is not None:
+            self.metrics.upstream_latency.observe(time.perf_counter() - timer.start, provider=provider, outcome=outcome)
+
+    @staticmethod
+    def _relay_headers(headers: httpx.Headers) -> Dict[str, str]:
+        """去掉逐跳和编码相关的头，长度和编码由网关自己的响应重新决定"""
+        skip = {"content-length", "content-encoding", "transfer-encoding", "connection", "keep-alive"}
+        return {k: v for k, v in headers.items() if k.lower() not in skip}
+
+    async def relay_stream(self, provider: Dict, result: Dict, cache_key: Optional[str] = None) -> AsyncIterator[bytes]:
+        """边收边转发上游 SSE，同时记录首 token 耗时和输出速度
+
+        第一个 chunk 已经由 forward_request 读好，这里先发出去再接着读剩下的。
+        StreamingResponse 按需拉取这个生成器，下游读得慢时上游也不会被多读，
+        客户端断开时生成器被取消，finally 里关闭上游连接。
+        传了 cache_key 时顺便攒下完整的流，成功结束后写入缓存。
+        """
+        response: httpx.Response = result["content"]
+        start = result["start"]
+        first_chunk_at = result["first_chunk_at"]
+        meter = SSEMeter()
+        success = False
+        client_gone = False
+        recorded: Optional[List[bytes]] = [] if cache_key else None
+        recorded_bytes = 0
+        async def chunks() -> AsyncIterator[bytes]:
+            if result["first_chunk"]:
+                yield result["first_chunk"]
+            async for chunk in result["chunks"]:
+                yield chunk
+
+        try:
+            async for chunk in chunks():
+                if first_chunk_at is None:
+                    first_chunk_at = time.time()
+                meter.feed(chunk)
+                if recorded is not None:
+                    recorded_bytes += len(chunk)
+                    # 超过单条上限就不缓存了，也不再继续占内存
+                    recorded = recorded if recorded_bytes <= CACHE_MAX_ENTRY_BYTES else None
+                    if recorded is not None:
+                        recorded.append(chunk)
+                yield chunk
+            success = True
+            if recorded is not None and response.status_code == 200:
+                await self.cache.put(cache_key, b"".join(recorded), "text/event-stream", stream=True)
+        except (asyncio.CancelledError, GeneratorExit):
+            # 客户端断开，不是服务商的问题
+            client_gone = True
+            raise
+        finally:
+            await response.aclose()
+            result["lease"].release()
+            end = time.time()
+            outcome = "success" if success else "cancelled" if client_gone else "error"
+            self.metrics.upstream_latency.observe(end - start, provider=provider["name"], outcome=outcome)
+            if first_chunk_at is not None:
+                self.metrics.ttft.observe(first_chunk_at - start, provider=provider["name"])
+            if success:
+                self.routing.record_traffic(provider["name"], True, (end - start) * 1000, trial=result["trial"])
+            elif client_gone:
+                self.routing.record_seen(provider["name"])
+            else:
+                self.routing.record_traffic(provider["name"], False, ERROR_PENALTY_MS, "Stream interrupted",
+                                            trial=result["trial"])
+            if success and first_chunk_at is not None:
+                duration = end - first_chunk_at
+                self.routing.record_stream(
+                    provider["name"],
+                    ttft=(first_chunk_at - start) * 1000,
+                    tokens_per_sec=meter.events / duration if duration > 0 else 0.0
+                )
+
+    async def build_response(self, provider: Dict, result: Dict, cache_key: Optional[str] = None,
+                             deadline: Optional[Deadline] = None):
+        """把 forward_request 的结果包装成流式或普通响应
+
+        非流式请求在这里读完响应体，读失败或者超过 deadline 抛 HTTPException，调用方还可以换服务商重试。
+        """
+        if cache_key:
+            result["headers"]["X-Gateway-Cache"] = "MISS"
+        # 标出实际服务的服务商，压测脚本据此统计分布和失败切换
+        result["headers"]["X-Gateway-Provider"] = provider["name"]
+        if result["stream"]:
+            return StreamingResponse(
+                content=self.relay_stream(provider, result, cache_key),
+                headers=result["headers"],
+                status_code=result["status_code"],
+                media_type="text/event-stream"  # 强制指定流式类型
+            )
+        response = result["content"]
+        try:
+            async with asyncio.timeout(deadline.remaining() if deadline else None):
+                body = await response.aread()
+        except Exception as e:
+            timed_out = isinstance(e, (TimeoutError, httpx.TimeoutException))
+            error = "Upstream read timeout" if timed_out else f"Upstream read error: {e}"
+            self.metrics.upstream_latency.observe(time.time() - result["start"], provider=provider["name"], outcome="error")
+            self.routing.record_traffic(provider["name"], False, ERROR_PENALTY_MS, error, trial=result["trial"])
             raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail=str(e)
+                status_code=status.HTTP_504_GATEWAY_TIMEOUT if timed_out else status.HTTP_502_BAD_GATEWAY,
+                detail=error
             )
+        finally:
+            await response.aclose()
+            result["lease"].release()
+        # 更新统计信息
+        elapsed = time.time() - result["start"]
+        self.metrics.upstream_latency.observe(elapsed, provider=provider["name"], outcome="success")
+        self.routing.record_traffic(provider["name"], True, elapsed * 1000, trial=result["trial"])
+        content_type = result["content"].headers.get("content-type", "application/json")
+        if cache_key and result["status_code"] == 200:
+            await self.cache.put(cache_key, body, content_type, stream=False)
+        # 上游的响应字节原样透传，不再 json.loads 后由 JSONResponse 重新编码
+        return Response(
+            content=body,
+            headers=result["headers"],
+            status_code=result["status_code"],
+            media_type=content_type
+        )
+
+    async def pool_metrics(self):
+        """各服务商连接池的使用情况"""
+        return self.pool.metrics()
+
+    async def gateway_stats(self):
+        """各服务商的滑动窗口延迟分位数和错误率"""
+        return self.routing.snapshot()
+
+    async def receive_probe(self, result: ProbeStatus):
+        """接收 monitor.py 推过来的探测结果（GATEWAY_PROBE_URL）"""
+        self.monitor.on_probe(result.model_dump())
+        return {"message": "Probe result received."}
+
+    async def probe_metrics(self):
+        """探测引擎的状态：是否主动探测、每个服务商的连续成功/失败/跳过次数，以及真实流量的汇总"""
+        providers = self.monitor.engine.snapshot()
+        if not self.monitor.leading.is_set():
+            # 不负责探测的 worker 自己的引擎没跑过，最近一次探测时间取广播过来的结果
+            for name, result in self.monitor.latest.items():
+                providers[name]["last_probe"] = result["timestamp"]
+        return {
+            "active": GATEWAY_PROBES,
+            "prober": self.monitor.leading.is_set(),
+            "providers": providers,
+            "traffic": self.routing.traffic.snapshot()
+        }
+
+    def on_peer_event(self, event: List[Any], sender: str):
+        """处理其他 worker 广播过来的事件"""
+        kind = event[0]
+        if kind == "probe":
+            self.monitor.on_probe(event[1], share=False)
+        elif kind == "hello":
+            if self.monitor.leading.is_set():
+                self.bus.send_to(sender, [["probe", result] for result in self.monitor.latest.values()])
+        else:
+            self.routing.apply_shared(event)
+
+    async def worker_metrics(self):
+        """多 worker 模式下本 worker 的状态：是否负责探测、和其他 worker 之间收发的事件批数"""
+        return {
+            "pid": os.getpid(),
+            "workers": WORKERS,
+            "prober": self.monitor.leading.is_set(),
+            "bus": self.bus.snapshot() if self.bus is not None else None
+        }
+
+    async def prometheus_metrics(self):
+        """Prometheus 抓取接口"""
+        return Response(content=self.metrics.render(self.routing, self.pool, self.admission), media_type=CONTENT_TYPE)
+
+    async def cache_metrics(self):
+        """响应缓存的命中率和容量"""
+        if self.cache is None:
+            return {"enabled": False}
+        return self.cache.snapshot()
+
+    @staticmethod
+    def cached_response(entry: CacheEntry) -> Response:
+        """用缓存内容构造响应；流式请求按 SSE 事件逐个回放"""
+        headers = {"X-Gateway-Cache": "HIT"}
+        if entry.stream:
+            async def replay() -> AsyncIterator[bytes]:
+                for event in entry.body.split(b"\n\n"):
+                    if event:
+                        yield event + b"\n\n"
+            return StreamingResponse(content=replay(), headers=headers, media_type=entry.content_type)
+        return Response(content=entry.body, headers=headers, media_type=entry.content_type)
+
+    async def coalescing_metrics(self):
+        """请求合并的情况"""
+        return self.flights.snapshot()
+
+    async def hedging_metrics(self):
+        """对冲请求的预算和命中情况"""
+        return self.hedge_budget.snapshot()
+
+    async def retry_metrics(self):
+        """失败切换的预算和结果"""
+        return self.retry_budget.snapshot()
+
+    async def admission_metrics(self):
+        """准入控制：在途数、排队数和各原因的拒绝次数"""
+        return self.admission.snapshot()
+
+    @staticmethod
+    def _discard_loser(task: asyncio.Task):
+        """被取消前已经拿到响应的一方，要把连接还回连接池"""
+        if task.cancelled() or task.exception() is not None:
+            return
+        task.result()["lease"].release()
+        asyncio.create_task(task.result()["content"].aclose())
+
+    async def hedged_forward(self, provider: Dict, payload: RequestPayload, interactive: bool, tried: Set[str],
+                             tokens: int = 0, timeout: float = REQUEST_TIMEOUT):
+        """对冲转发：主服务商超过阈值仍无首字节时，向次优服务商再发一份，谁先到用谁
+
+        返回 (实际服务的 provider, forward_request 的结果)。
+        """
+        primary = asyncio.create_task(self.forward_request(provider, payload, tokens, timeout))
+        owners = {primary: provider}
+        winner = None
+        try:
+            delay = self.routing.hedge_delay(provider["name"]) / 1000
+            done, _ = await asyncio.wait({primary}, timeout=delay)
+            if done:
+                winner = primary
+                return provider, primary.result()
+
+            backup = next(
+                (
+                    p for p in self.routing.rank_providers(interactive)
+                    if p["name"] not in tried and self.routing.has_capacity(p["name"], tokens)
+                ),
+                None
+            )
+            if backup is None or not self.hedge_budget.try_acquire():
+                winner = primary
+                return provider, await primary
+
+            log_event(log, logging.INFO, "hedge", provider=provider["name"], backup=backup["name"],
+                      delay_ms=round(delay * 1000))
+            tried.add(backup["name"])
+            hedge = asyncio.create_task(self.forward_request(backup, payload, tokens, max(0.0, timeout - delay)))
+            owners[hedge] = backup
+            pending = set(owners)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        winner = task
+                        if task is hedge:
+                            self.hedge_budget.hedge_wins += 1
+                        return owners[task], task.result()
+            # 两边都失败，按主请求的错误处理
+            raise primary.exception()
+        finally:
+            # 自己被取消、或者同一轮两边都成功时，没用上的一方也要释放名额、关掉响应
+            for task in owners:
+                if task is not winner:
+                    task.cancel()
+                    task.add_done_callback(self._discard_loser)
 
     async def chat_completion(self, request: Request):
         """处理聊天补全请求"""
-        # 智能路由选择
-        provider = self.routing.get_best_provider()
-        print("本次请求由：",provider," 执行；")
-        if not provider:
+        # 请求体只读取、解析一次，后面的路由、缓存、转发和重试都复用
+        raw = await request.body()
+        parse_start = time.perf_counter()
+        try:
+            payload = RequestPayload(raw)
+        except ValueError as e:
+            self.metrics.body_parse.observe(time.perf_counter() - parse_start, outcome="invalid")
             raise HTTPException(
-                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
-                detail="No available AI providers"
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Invalid JSON body: {e}"
             )
-            
-        # 请求转发
+        self.metrics.body_parse.observe(time.perf_counter() - parse_start, outcome="ok")
+        # 流式请求是交互式流量，路由时优先看首 token 耗时
+        interactive = payload.stream
+        tokens = estimate_tokens(payload.body)
+        # 客户端限速最先做，超限的请求不占缓存、合并和上游的任何资源
+        request.state.client = self.admission.identify(request)
+        self.admission.check_client(request.state.client, tokens)
+
+        # 确定性请求先查缓存（Cache-Control: no-cache 跳过读取，no-store 跳过写入）
+        key = None
+        if self.cache is not None:
+            cache_control = request.headers.get("cache-control", "")
+            key = cache_key(payload)
+            if key and "no-cache" not in cache_control:
+                entry = await self.cache.get(key)
+                if entry is not None:
+                    return self.cached_response(entry)
+            if "no-store" in cache_control:
+                key = None
+
+        # 相同请求正在上游处理中，就搭同一趟车
+        flight_key = coalesce_key(payload)
+        if flight_key is None:
+            return await self.dispatch(request, payload, interactive, tokens, key)
+        flight = self.flights.get(flight_key)
+        if flight is not None:
+            response = await flight.join()
+            if response is not None:
+                return response
+            return await self.dispatch(request, payload, interactive, tokens, key)
+        flight = self.flights.start(flight_key)
         try:
-            result = await self.forward_request(provider, request)
-            
-            if result["stream"]:
-                # 创建异步生成器逐块转发流式数据
-                async def generate_stream():
-                    async for chunk in result["content"].aiter_bytes():
-                        yield chunk
-
-                return StreamingResponse(
-                    content=generate_stream(),
-                    headers=result["headers"],
-                    status_code=result["status_code"],
-                    media_type="text/event-stream"  # 强制指定流式类型
-                )
-            else:
-                return JSONResponse(
-                    content=json.loads(await result["content"].aread()),
-                    headers=result["headers"],
-                    status_code=result["status_code"]
-                )
-        except HTTPException as e:
-            print("============================================")
-            print("触发了chat_completion的失败重试逻辑，错误如下：")
-            print(e)
-            # 获取原始请求体
-            original_body = await request.json()
-            print("触发了错误的请求体为：")
-            print(original_body)
-            print("============================================")
-            # 失败重试逻辑
-            backup_providers = [p for p in PROVIDERS if p["name"] != provider["name"]]
-            for backup in backup_providers:
+            response = await self.dispatch(request, payload, interactive, tokens, key)
+        except asyncio.CancelledError:
+            flight.abandon()
+            raise
+        except Exception as e:
+            flight.fail(e)
+            raise
+        return flight.lead(response)
+
+    @staticmethod
+    def request_priority(request: Request) -> int:
+        """客户端配置的优先级；请求头 X-Gateway-Priority 只能把自己往后排，不能插队"""
+        client = getattr(request.state, "client", None)
+        priority = client.priority if client is not None else CLIENT_PRIORITY
+        try:
+            return max(priority, int(request.headers.get("x-gateway-priority", priority)))
+        except ValueError:
+            return priority
+
+    async def dispatch(self, request: Request, payload: RequestPayload, interactive: bool, tokens: int, key: Optional[str]):
+        """路由、转发、失败切换，返回最终响应"""
+        deadline = Deadline.from_request(request, payload.stream)
+        with span("gateway.dispatch", stream=payload.stream, tokens=tokens, deadline=deadline.timeout) as current:
+            # 上游名额不够时先排队，放行时预留的名额在第一次拿到 Lease 时归还
+            reservation = await self.admission.acquire(self.request_priority(request), tokens, interactive, deadline)
+            payload.reservation = reservation
+            if reservation.waited:
+                self.metrics.admission_wait.observe(reservation.waited)
+                span_set(current, queued=round(reservation.waited, 3))
+            try:
+                # 智能路由选择
+                provider = self.routing.get_best_provider(interactive=interactive, tokens=tokens)
+                span_set(current, provider=provider["name"] if provider else None)
+                if not provider and self.routing.rank_providers(interactive):
+                    # 有健康的服务商，只是都满载了
+                    raise HTTPException(
+                        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                        detail="All AI providers are at capacity",
+                        headers={"Retry-After": str(SATURATED_RETRY_AFTER)}
+                    )
+                if not provider:
+                    raise HTTPException(
+                        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                        detail="No available AI providers"
+                    )
+
+                # 请求转发（请求头 X-Gateway-Hedge: 1 可以单独为本次请求开启对冲）
+                self.hedge_budget.on_request()
+                self.retry_budget.on_request()
+                hedging = HEDGING_ENABLED or request.headers.get("x-gateway-hedge") == "1"
+                tried = {provider["name"]}
+                # 第一次尝试就要给后面可能的重试留出时间
+                attempts_left = min(MAX_ATTEMPTS, len(self.routing.rank_providers(interactive)))
+                timeout = deadline.attempt_timeout(attempts_left)
                 try:
-                    result = await self.forward_request(backup, request)
-                    return JSONResponse(content=result)
-                except:
-                    continue
-            raise e
+                    with span("gateway.forward", provider=provider["name"], hedging=hedging, timeout=round(timeout, 2)):
+                        if hedging:
+                            provider, result = await self.hedged_forward(provider, payload, interactive, tried, tokens, timeout)
+                        else:
+                            result = await self.forward_request(provider, payload, tokens, timeout)
+                    return await self.build_response(provider, result, key, deadline)
+                except HTTPException as e:
+                    return await self.failover(provider, e, payload, interactive, tokens, key, tried, deadline, current)
+            finally:
+                # 没走到转发（没有可用服务商、熔断等）也要把预留的名额还回去
+                reservation.release()
+
+    async def failover(self, failed: Dict, error: HTTPException, payload: RequestPayload, interactive: bool,
+                       tokens: int, key: Optional[str], tried: Set[str], deadline: Deadline, current: Any):
+        """第一次尝试失败后按实时评分依次换服务商重试
+
+        只有服务商自己的问题（5xx、408、429、超时）才重试，其他 4xx 直接返回给客户端；
+        每次重试要从全局预算里拿令牌，剩余时间平分给剩下的尝试，
+        时间不够、预算用完、没有可用的备选或者次数到上限就返回最后一次的错误。
+        """
+        attempts = len(tried)
+        while True:
+            if not is_provider_error(error.status_code):
+                reason = "not_retryable"
+                break
+            if attempts >= MAX_ATTEMPTS:
+                reason = "max_attempts"
+                break
+            backups = [
+                p for p in self.routing.rank_providers(interactive)
+                if p["name"] not in tried and self.routing.has_capacity(p["name"], tokens)
+            ]
+            if not backups:
+                reason = "no_backup"
+                break
+            if deadline.remaining() < MIN_ATTEMPT_TIMEOUT:
+                reason = "deadline"
+                break
+            if not self.retry_budget.try_acquire():
+                reason = "budget"
+                break
+
+            backup = backups[0]
+            tried.add(backup["name"])
+            attempts += 1
+            timeout = deadline.attempt_timeout(min(MAX_ATTEMPTS - attempts + 1, len(backups)))
+            log_event(
+                log, logging.WARNING, "failover", provider=failed["name"], backup=backup["name"],
+                status=error.status_code, detail=str(error.detail)[:200], attempt=attempts, timeout=round(timeout, 2)
+            )
+            span_event(current, "failover", provider=failed["name"], backup=backup["name"], status=error.status_code)
+            try:
+                with span("gateway.forward", provider=backup["name"], attempt=attempts, timeout=round(timeout, 2)):
+                    result = await self.forward_request(backup, payload, tokens, timeout)
+                result["headers"]["X-Gateway-Attempts"] = str(attempts)
+                response = await self.build_response(backup, result, key, deadline)
+            except HTTPException as retry_error:
+                failed, error = backup, retry_error
+                continue
+            self.retry_budget.recovered += 1
+            self.metrics.failovers.inc(provider=backup["name"])
+            span_set(current, provider=backup["name"], attempts=attempts)
+            return response
+
+        self.metrics.failover_stops.inc(reason=reason)
+        span_set(current, failover_stop=reason, attempts=attempts)
+        if reason != "not_retryable":
+            log_event(log, logging.WARNING, "failover_stopped", provider=failed["name"], status=error.status_code,
+                      reason=reason, attempts=attempts)
+        raise error
+
+def create_app() -> FastAPI:
+    """uvicorn 多 worker 模式的应用工厂，每个 worker 进程各自创建一个网关"""
+    return OpenAIGateway().app
+
 
 # 运行服务
 if __name__ == "__main__":
-    gateway = OpenAIGateway()
-    uvicorn.run(gateway.app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="AI Gateway")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=WORKERS, help="worker 进程数，默认取 GATEWAY_WORKERS")
+    args = parser.parse_args()
+    if args.workers > 1:
+        # worker 进程重新 import 本模块，配置都通过环境变量传过去
+        prepare_shared_dir(args.port)
+        os.environ["GATEWAY_WORKERS"] = str(args.workers)
+        uvicorn.run("gateway:create_app", factory=True, host=args.host, port=args.port, workers=args.workers)
+    else:
+        uvicorn.run(create_app(), host=args.host, port=args.port)
\ No newline at end of file
@@ -3,14 +3,12 @@ import os
 import time
 import json
 import warnings
-from typing import Dict, Optional
+from typing import Dict, List, Optional
 import paho.mqtt.client as mqtt
 from paho.mqtt.client import CallbackAPIVersion
-from openai import OpenAI
-from openai import APIConnectionError, APIError, APIStatusError
 # 使用 asyncio 运行异步代码
 import asyncio
-import httpx
+from probe_engine import PROVIDERS, HttpSink, ProbeEngine, ProbeSink
 
 
 # -----------------------------------------------------------------------------
@@ -32,60 +30,62 @@ import httpx
 # 配置信息
 MQTT_BROKER = "192.168.50.233"
 MQTT_PORT = 1883
-STATUS_TOPIC = "api_status"  # 状态上报主题
-CHECK_INTERVAL = 60  # 检查间隔（秒）
+STATUS_TOPIC = "api_status"  # 状态上报主题，每个服务商发到 api_status/<provider>（retained）
+SNAPSHOT_TOPIC = f"{STATUS_TOPIC}/snapshot"  # 所有服务商的紧凑汇总（retained），给 ESP32 这类设备用
+MQTT_QOS = int(os.getenv("MQTT_QOS", "1"))
+MQTT_LEGACY_TOPIC = os.getenv("MQTT_LEGACY_TOPIC", "0") == "1"  # 同时发到老的单一主题 api_status（旧固件用）
+SNAPSHOT_INTERVAL = float(os.getenv("SNAPSHOT_INTERVAL", "5"))  # 汇总快照最多多久发一次（秒），有变化才发
+SNAPSHOT_ERROR_CHARS = 32  # 快照里的错误信息只保留前 32 个字符
+PUBLISH_QUEUE_SIZE = 1000  # 发布队列上限，满了丢掉最旧的
+SERVER_URL = "http://localhost:8000/api_status"  # 替换为 FastAPI 服务器的实际 IP 和端口
+# 网关的探测结果接收地址，例如 http://localhost:8000/v1/gateway/probe；
+# 配置后网关用这里的结果，网关自己设置 GATEWAY_PROBES=0 就不用再重复探测
+GATEWAY_PROBE_URL = os.getenv("GATEWAY_PROBE_URL")
 
 # 日志文件路径
 LOG_FILE = "mqtt_status.log"
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024)))  # 超过这个大小就轮转
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", "5"))  # 保留 mqtt_status.log.1 ~ .N
 
-# 服务商配置列表
-PROVIDERS = [
-    {
-        "name": "deepseek",
-        "env_var": "OPENAI_API_KEY",
-        "base_url": "https://api.deepseek.com",
-        "model": "deepseek-chat"
-    },
-    {
-        "name": "siliconflow",
-        "env_var": "SILICONFLOW_API_KEY",
-        "base_url": "https://api.siliconflow.cn/v1",
-        "model": "deepseek-ai/DeepSeek-V3"
-    },
-    {
-        "name": "huoshan",
-        "env_var": "HUOSHAN_API_KEY",
-        "base_url": "https://ark.cn-beijing.volces.com/api/v3",
-        "model": "ep-20250204220334-l2q5g"
-    },
-    {
-        "name": "tencent",
-        "env_var": "TENCENT_API_KEY",
-        "base_url": "https://api.lkeap.cloud.tencent.com/v1",
-        "model": "deepseek-v3"
-    },
-    {
-        "name": "bailian",
-        "env_var": "DASHSCOPE_API_KEY",
-        "base_url": "https://dashscope.aliyuncs.com/compatible-mode/v1",
-        "model": "deepseek-v3"
-    }
-]
-
-class APIMonitor:
+# 服务商列表和检查间隔在 probe_engine.py 里统一配置
+
+class APIMonitor(ProbeSink):
+    """探测引擎的 sink：MQTT、server.py 和日志文件的发布流水线
+
+    探测结果只放进队列，由后台任务整批处理：每个服务商发到自己的 retained 主题，
+    整批 POST 到 server.py 的 /api_status/batch，日志一次写入；
+    MQTT 断线期间每个服务商只保留最新的一条，重连后补发。
+    """
     def __init__(self):
         self.mqtt_client = mqtt.Client(client_id="api_monitor", callback_api_version=CallbackAPIVersion.VERSION2)
         self.mqtt_client.on_connect = self.on_connect
         self.mqtt_client.on_disconnect = self.on_disconnect
         self.mqtt_client.on_log = self.on_log  # 可选：用于调试日志
-        self.mqtt_client.connect(MQTT_BROKER, MQTT_PORT, 60)
+        # 异步连接，broker 不在线时也能启动，loop_start 的线程负责自动重连
+        self.mqtt_client.connect_async(MQTT_BROKER, MQTT_PORT, 60)
         self.mqtt_client.loop_start()
+        self.server_sink = HttpSink(f"{SERVER_URL}/batch")
+        sinks = [self]
+        if GATEWAY_PROBE_URL:
+            sinks.append(HttpSink(GATEWAY_PROBE_URL))
+        self.engine = ProbeEngine(PROVIDERS, sinks)
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.queue: Optional[asyncio.Queue] = None
+        self.reconnected = asyncio.Event()
+        self.latest: Dict[str, Dict] = {}  # 每个服务商的最新状态，用来生成快照
+        self.pending: Dict[str, Dict] = {}  # 断线期间没发出去的最新状态
+        self.snapshot_dirty = False
+        self.last_snapshot = 0.0
+        self.dropped = 0
     
     def on_connect(self, client, userdata, flags, reason_code, properties=None):
         """连接回调"""
         # Check if connection succeeded (0: Connection accepted)
         if reason_code.value == 0:
             print("Connected to MQTT broker successfully.")
+            # 回调在 paho 的线程里，通知事件循环补发断线期间的状态
+            if self.loop is not None:
+                self.loop.call_soon_threadsafe(self.notify_reconnected)
         else:
             print(f"Connection failed with reason code: {reason_code.value}")
     
@@ -96,103 +96,171 @@ class APIMonitor:
     def on_log(self, client, userdata, level, buf):
         """调试日志回调"""
         print(f"MQTT Log: {buf}")
-    
-    def check_provider_status(self, provider: Dict) -> Dict:
-        """检查单个服务商状态"""
-        status = {
-            "provider": provider["name"],
-            "online": False,
-            "response_time": None,
-            "error": None,
-            "timestamp": int(time.time())
-        }
-        
-        api_key = os.getenv(provider["env_var"])
-        if not api_key:
-            status["error"] = "API key not found"
-            return status
-        
+
+    def notify_reconnected(self):
+        # 放一个 None 唤醒发布任务
+        self.reconnected.set()
+        if self.queue is not None and not self.queue.full():
+            self.queue.put_nowait(None)
+
+    async def publish(self, status: Dict):
+        """只入队，不在探测路径上做任何 IO"""
+        if self.queue is None:
+            await self.publish_batch([status])
+            return
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(status)
+
+    async def run_publisher(self):
+        """发布流水线：攒一批处理一次，快照按 SNAPSHOT_INTERVAL 节流"""
+        while True:
+            timeout = None
+            if self.snapshot_dirty and self.mqtt_client.is_connected():
+                timeout = max(0.0, self.last_snapshot + SNAPSHOT_INTERVAL - time.time())
+            batch = []
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                while not self.queue.empty():
+                    batch.append(self.queue.get_nowait())
+            except asyncio.TimeoutError:
+                pass
+            if self.reconnected.is_set():
+                self.reconnected.clear()
+                self.flush_pending()
+            batch = [status for status in batch if status is not None]
+            if batch:
+                await self.publish_batch(batch)
+            if self.snapshot_dirty and time.time() - self.last_snapshot >= SNAPSHOT_INTERVAL:
+                self.publish_snapshot()
+
+    async def publish_batch(self, batch: List[Dict]):
+        if not batch:
+            return
+        for status in batch:
+            self.publish_status(status)
         try:
-            client = OpenAI(
-                api_key=api_key,
-                base_url=provider["base_url"],
-                timeout=10
-            )
-            
-            start_time = time.time()
-            # 发送测试请求
-            client.chat.completions.create(
-                messages=[{"role": "user", "content": "ping"}],
-                model=provider["model"],
-                max_tokens=5
-            )
-            status["response_time"] = round((time.time() - start_time) * 1000, 2)
-            status["online"] = True
-        except APIConnectionError as e:
-            status["error"] = f"Connection error: {e}"
-        except APIStatusError as e:
-            status["error"] = f"API error: {e.status_code} {e.message}"
-        except APIError as e:
-            status["error"] = f"API error: {e}"
+            await self.server_sink.publish_batch(batch)
         except Exception as e:
-            status["error"] = f"Unexpected error: {str(e)}"
-        
-        return status
-    
-    def check_all_providers(self):
-        """检查所有服务商"""
-        for provider in PROVIDERS:
-            status = self.check_provider_status(provider)
-            self.publish_status(status)
+            print(f"Error publishing status: {str(e)}")
+        # 写入日志文件
+        await asyncio.to_thread(self.log_payloads, [json.dumps(status, ensure_ascii=False) for status in batch])
+
+    async def check_all_providers(self):
+        """并发检查所有服务商一次"""
+        await self.engine.probe_all()
+
+    async def run(self):
+        """每个服务商跑独立的自适应检查计划，结果交给发布流水线"""
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=PUBLISH_QUEUE_SIZE)
+        publisher = asyncio.create_task(self.run_publisher())
+        try:
+            await self.engine.run()
+        finally:
+            publisher.cancel()
+            try:
+                await publisher
+            except asyncio.CancelledError:
+                pass
+            # 引擎关闭时会依次关闭所有 sink（包括这里的 close）
+            await self.engine.close()
+
+    async def close(self):
+        # 把队列里剩下的发完
+        if self.queue is not None and not self.queue.empty():
+            batch = []
+            while not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            await self.publish_batch([status for status in batch if status is not None])
+        if self.snapshot_dirty:
+            self.publish_snapshot()
+        await self.server_sink.close()
             
-    def log_payload(self, payload: str):
-        """将 payload 写入日志文件"""
+    def rotate_log(self):
+        """日志超过 LOG_MAX_BYTES 时轮转：mqtt_status.log -> .1 -> .2 ...，最旧的一份丢弃"""
+        try:
+            if os.path.getsize(LOG_FILE) < LOG_MAX_BYTES:
+                return
+        except OSError:
+            return
+        if LOG_BACKUP_COUNT <= 0:
+            os.remove(LOG_FILE)
+            return
+        for index in range(LOG_BACKUP_COUNT - 1, 0, -1):
+            if os.path.exists(f"{LOG_FILE}.{index}"):
+                os.replace(f"{LOG_FILE}.{index}", f"{LOG_FILE}.{index + 1}")
+        os.replace(LOG_FILE, f"{LOG_FILE}.1")
+
+    def log_payloads(self, payloads: List[str]):
+        """将一批 payload 写入日志文件"""
         timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        log_entry = f"[{timestamp}] Published status: {payload}\n"
+        self.rotate_log()
 
         # 确保以 UTF-8 格式写入文件
         with open(LOG_FILE, "a", encoding="utf-8") as log_file:
-            log_file.write(log_entry)
+            log_file.writelines(f"[{timestamp}] Published status: {payload}\n" for payload in payloads)
+
+    def log_payload(self, payload: str):
+        """将 payload 写入日志文件"""
+        self.log_payloads([payload])
+
+    def publish_mqtt(self, topic: str, payload: str) -> bool:
+        if not self.mqtt_client.is_connected():
+            return False
+        info = self.mqtt_client.publish(topic, payload, qos=MQTT_QOS, retain=True)  # 设置 retain 标志为 True
+        return info.rc == mqtt.MQTT_ERR_SUCCESS
     
     def publish_status(self, status: Dict):
-        """发布状态到MQTT"""
+        """发布状态到MQTT（api_status/<provider>），发不出去就留到重连后"""
         payload = json.dumps(status, ensure_ascii=False)
-        self.mqtt_client.publish(
-            f"{STATUS_TOPIC}",
-            payload,
-            retain=True  # 设置 retain 标志为 True
-        )
-        print(f"Published status: {payload}")
-
-        """发布状态到 FastAPI 服务器"""
-        async def send_request():
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    "http://localhost:8000/api_status",  # 替换为 FastAPI 服务器的实际 IP 和端口
-                    json=status
-                )
-                return response
+        self.latest[status["provider"]] = status
+        self.snapshot_dirty = True
+        published = self.publish_mqtt(f"{STATUS_TOPIC}/{status['provider']}", payload)
+        if MQTT_LEGACY_TOPIC:
+            published = self.publish_mqtt(STATUS_TOPIC, payload) and published
+        if published:
+            self.pending.pop(status["provider"], None)
+            print(f"Published status: {payload}")
+        else:
+            self.pending[status["provider"]] = status
+            print(f"MQTT unavailable, buffered status: {payload}")
 
-        try:
-            # 使用 asyncio.run 运行异步函数
-            response = asyncio.run(send_request())
-            
-            if response.status_code == 200:
-                print(f"Status published successfully: {payload}")
-            else:
-                print(f"Failed to publish status: {response.text}")
-                print(response)
-        except Exception as e:
-            print(f"Error publishing status: {str(e)}")
-        # 写入日志文件
-        self.log_payload(payload)
+    def flush_pending(self):
+        """重连后补发断线期间每个服务商的最新状态"""
+        pending, self.pending = self.pending, {}
+        for status in pending.values():
+            self.publish_status(status)
+        if self.latest:
+            self.snapshot_dirty = True
+
+    def snapshot_payload(self) -> str:
+        """紧凑格式：{"p":{"deepseek":[1,812,1739154861],"tencent":[0,-1,1739154794,"API error: 500"]}}
+
+        每项依次是 是否在线、响应时间（毫秒取整，未知为 -1）、时间戳，离线时再带上截断的错误信息。
+        """
+        providers = {}
+        for name, status in self.latest.items():
+            item = [
+                1 if status["online"] else 0,
+                round(status["response_time"]) if status["response_time"] is not None else -1,
+                status["timestamp"]
+            ]
+            if not status["online"] and status["error"]:
+                item.append(status["error"][:SNAPSHOT_ERROR_CHARS])
+            providers[name] = item
+        return json.dumps({"p": providers}, ensure_ascii=False, separators=(",", ":"))
+
+    def publish_snapshot(self):
+        if self.publish_mqtt(SNAPSHOT_TOPIC, self.snapshot_payload()):
+            self.snapshot_dirty = False
+            self.last_snapshot = time.time()
 
 if __name__ == "__main__":
     monitor = APIMonitor()
     try:
-        while True:
-            monitor.check_all_providers()
-            time.sleep(CHECK_INTERVAL)
+        asyncio.run(monitor.run())
     except KeyboardInterrupt:
         monitor.mqtt_client.loop_stop()
         print("Monitoring stopped")
\ No newline at end of file
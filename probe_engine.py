@@ -0,0 +1,426 @@
+"""服务商注册表和共享的健康检查引擎
+
+monitor.py 和 gateway.py 都从这里拿 PROVIDERS，用同一个 ProbeEngine 探测；
+一次探测的结果通过 sink 分发给所有消费者（MQTT、server.py、网关的 RoutingManager），
+不再各自维护一份服务商列表、各自花钱 ping 同一批接口。
+"""
+import os
+import time
+import ssl
+import json
+import socket
+import random
+import asyncio
+from collections import deque
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+import httpx
+
+
+# 默认的服务商配置列表，设置 PROVIDERS_CONFIG 指向 JSON 文件可以整体替换
+DEFAULT_PROVIDERS = [
+    {
+        "name": "deepseek",
+        "env_var": "OPENAI_API_KEY",
+        "base_url": "https://api.deepseek.com",
+        "model": "deepseek-chat"
+    },
+    {
+        "name": "siliconflow",
+        "env_var": "SILICONFLOW_API_KEY",
+        "base_url": "https://api.siliconflow.cn/v1",
+        "model": "deepseek-ai/DeepSeek-V3"
+    },
+    {
+        "name": "huoshan",
+        "env_var": "HUOSHAN_API_KEY",
+        "base_url": "https://ark.cn-beijing.volces.com/api/v3",
+        "model": "ep-20250204220334-l2q5g"
+    },
+    {
+        "name": "tencent",
+        "env_var": "TENCENT_API_KEY",
+        "base_url": "https://api.lkeap.cloud.tencent.com/v1",
+        "model": "deepseek-v3"
+    },
+    {
+        "name": "bailian",
+        "env_var": "DASHSCOPE_API_KEY",
+        "base_url": "https://dashscope.aliyuncs.com/compatible-mode/v1",
+        "model": "deepseek-v3"
+    }
+]
+
+PROVIDER_REQUIRED_KEYS = ("name", "env_var", "base_url", "model")
+MISSING_API_KEY = "API key not found"  # 没配 API key 时的 error，消费者据此区分“没配置”和“不可用”
+
+def load_providers(path: Optional[str] = None) -> List[Dict]:
+    """读取服务商配置
+
+    path（默认取环境变量 PROVIDERS_CONFIG）是一个 JSON 数组，每项至少包含
+    name / env_var / base_url / model，网关用的限流、连接池等可选键原样保留。
+    """
+    path = path or os.getenv("PROVIDERS_CONFIG")
+    if not path:
+        return [dict(provider) for provider in DEFAULT_PROVIDERS]
+    with open(path, encoding="utf-8") as config_file:
+        providers = json.load(config_file)
+    for provider in providers:
+        missing = [key for key in PROVIDER_REQUIRED_KEYS if key not in provider]
+        if missing:
+            raise ValueError(f"Provider config {provider.get('name', provider)} is missing {', '.join(missing)}")
+    return providers
+
+# 服务商注册表，monitor.py 和 gateway.py 共用
+PROVIDERS = load_providers()
+
+# 探测配置
+PROBE_INTERVAL = float(os.getenv("PROBE_INTERVAL", "60"))  # 基础检查间隔（秒）
+PROBE_MIN_INTERVAL = float(os.getenv("PROBE_MIN_INTERVAL", "10"))  # 出问题的服务商最快多久查一次
+PROBE_MAX_INTERVAL = float(os.getenv("PROBE_MAX_INTERVAL", "300"))  # 一直健康的服务商最慢多久查一次
+PROBE_BACKOFF = 1.5  # 连续成功时间隔每次放大的倍数
+PROBE_JITTER = 0.1  # 检查间隔随机浮动 ±10%，避免所有探测挤在同一时刻
+
+# 探测方式，PROVIDERS 条目里可以用 "probe" 单独指定：
+#   connect     只做 DNS + TCP + TLS 握手，不花钱，但只能说明网络可达
+#   models      GET /models，不花钱，能验证 API key 和服务是否在线
+#   completion  1 个 token 的补全请求，最贵，但能验证模型真的能用
+PROBE_STRATEGY = os.getenv("PROBE_STRATEGY", "completion")
+PROBE_STRATEGIES = ("connect", "models", "completion")
+
+# 自适应超时：按这个服务商最近成功探测的耗时分布算，慢但能用的服务商不会被误判下线
+PROBE_TIMEOUT = float(os.getenv("PROBE_TIMEOUT", "10"))  # 样本不够时的超时（秒）
+PROBE_MIN_TIMEOUT = float(os.getenv("PROBE_MIN_TIMEOUT", "2"))
+PROBE_MAX_TIMEOUT = float(os.getenv("PROBE_MAX_TIMEOUT", "30"))
+PROBE_TIMEOUT_FACTOR = 3.0  # 超时 = 最近耗时的 p95 × 这个倍数
+PROBE_TIMEOUT_MIN_SAMPLES = 5
+PROBE_LATENCY_SAMPLES = 50  # 每个服务商保留最近多少个成功探测的耗时
+
+
+class ProbeError(Exception):
+    """探测失败，message 就是上报的 error"""
+
+
+class ProbeTimer:
+    """记录一次探测各阶段的耗时（毫秒）
+
+    HTTP 探测通过 httpx 的 trace 扩展拿到连接、TLS 和首字节的时间点；
+    复用已有连接时没有 connect / tls 阶段，只有首字节。
+    httpx 的 connect 阶段里包含了 DNS 解析，只有 connect 探测方式能把 DNS 单独拆出来。
+    """
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.marks: Dict[str, float] = {}
+
+    def mark(self, name: str):
+        self.marks[name] = time.perf_counter()
+
+    async def trace(self, event: str, info: Dict[str, Any]):
+        # 事件名形如 connection.connect_tcp.started / http11.receive_response_headers.complete
+        self.mark(event.split(".", 1)[1] if event.startswith(("http11.", "http2.")) else event)
+
+    def _span(self, started: str, complete: str) -> Optional[float]:
+        if started in self.marks and complete in self.marks:
+            return round((self.marks[complete] - self.marks[started]) * 1000, 2)
+        return None
+
+    def breakdown(self) -> Dict[str, Optional[float]]:
+        first_byte = self.marks.get("receive_response_headers.complete")
+        return {
+            "dns": self._span("dns.started", "dns.complete"),
+            "connect": self._span("connection.connect_tcp.started", "connection.connect_tcp.complete"),
+            "tls": self._span("connection.start_tls.started", "connection.start_tls.complete"),
+            "first_byte": round((first_byte - self.start) * 1000, 2) if first_byte is not None else None,
+            "total": round((time.perf_counter() - self.start) * 1000, 2)
+        }
+
+
+class ProbeSink:
+    """探测结果的消费者，status 的结构和 server.py 的 Status 一致"""
+    async def publish(self, status: Dict):
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class HttpSink(ProbeSink):
+    """POST 到 server.py（或网关）的接口，复用同一个 AsyncClient 的连接"""
+    def __init__(self, url: str, timeout: float = 10):
+        self.url = url
+        self.timeout = timeout
+        self.client: Optional[httpx.AsyncClient] = None
+
+    async def publish(self, status: Dict):
+        await self.post(status)
+
+    async def publish_batch(self, statuses: List[Dict]):
+        """整批 POST（例如 server.py 的 /api_status/batch）"""
+        await self.post(statuses)
+
+    async def post(self, payload: Any):
+        if self.client is None:
+            self.client = httpx.AsyncClient(timeout=self.timeout)
+        response = await self.client.post(self.url, json=payload)
+        if response.status_code != 200:
+            print(f"Failed to publish status to {self.url}: {response.status_code} {response.text}")
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+
+class CallbackSink(ProbeSink):
+    """进程内的消费者，例如网关的 RoutingManager"""
+    def __init__(self, callback: Callable[[Dict], Optional[Awaitable[None]]]):
+        self.callback = callback
+
+    async def publish(self, status: Dict):
+        result = self.callback(status)
+        if asyncio.iscoroutine(result):
+            await result
+
+
+class ProbeSchedule:
+    """单个服务商的自适应检查间隔和超时
+
+    连续失败时间隔减半（不低于 PROBE_MIN_INTERVAL），尽快发现恢复；
+    连续成功时间隔逐步放大（不超过 PROBE_MAX_INTERVAL），少花探测费用。
+    超时取最近成功耗时 p95 的 PROBE_TIMEOUT_FACTOR 倍，探测超时一次就翻倍，
+    避免服务商整体变慢之后被一直判成超时。
+    """
+    def __init__(self):
+        self.successes = 0
+        self.failures = 0
+        self.skipped = 0
+        self.last_probe: Optional[float] = None
+        self.last_timings: Optional[Dict[str, Optional[float]]] = None
+        self.latencies = deque(maxlen=PROBE_LATENCY_SAMPLES)
+        self.timeout_backoff = 1.0
+        self.wake = asyncio.Event()
+        self.forced = False  # 被 wake 唤醒的这次探测不受 should_probe 限制
+
+    def record(self, online: bool, latency: Optional[float] = None, timed_out: bool = False):
+        self.last_probe = time.time()
+        if online:
+            self.successes += 1
+            self.failures = 0
+            self.timeout_backoff = 1.0
+            if latency is not None:
+                self.latencies.append(latency)
+        else:
+            self.failures += 1
+            self.successes = 0
+            if timed_out:
+                self.timeout_backoff = min(self.timeout_backoff * 2, PROBE_MAX_TIMEOUT / PROBE_MIN_TIMEOUT)
+
+    def interval(self) -> float:
+        if self.failures:
+            base = max(PROBE_MIN_INTERVAL, PROBE_INTERVAL / 2 ** self.failures)
+        else:
+            base = min(PROBE_MAX_INTERVAL, PROBE_INTERVAL * PROBE_BACKOFF ** max(self.successes - 1, 0))
+        return base * random.uniform(1 - PROBE_JITTER, 1 + PROBE_JITTER)
+
+    def timeout(self) -> float:
+        """这次探测的超时（秒）"""
+        if len(self.latencies) < PROBE_TIMEOUT_MIN_SAMPLES:
+            base = PROBE_TIMEOUT
+        else:
+            ordered = sorted(self.latencies)
+            p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+            base = p95 / 1000 * PROBE_TIMEOUT_FACTOR
+        return min(PROBE_MAX_TIMEOUT, max(PROBE_MIN_TIMEOUT, base * self.timeout_backoff))
+
+
+class ProbeEngine:
+    """对每个服务商跑独立的检查计划，结果发给所有 sink
+
+    client_factory(provider) 返回以 base_url 为前缀的 httpx.AsyncClient，用来复用调用方已有的连接池
+    （网关传 ProviderPool.client），不传就每个服务商建一个长期复用的 AsyncClient。
+    skip_unconfigured 为 True 时没有 API key 的服务商不探测也不上报。
+    should_probe(provider) 返回 False 时跳过这次计划的探测（例如网关最近有真实流量，不需要再花钱 ping）。
+    """
+    def __init__(
+        self,
+        providers: List[Dict] = PROVIDERS,
+        sinks: Optional[List[ProbeSink]] = None,
+        client_factory: Optional[Callable[[Dict], httpx.AsyncClient]] = None,
+        skip_unconfigured: bool = False,
+        should_probe: Optional[Callable[[Dict], bool]] = None
+    ):
+        self.providers = providers
+        self.sinks: List[ProbeSink] = list(sinks or [])
+        self.client_factory = client_factory
+        self.skip_unconfigured = skip_unconfigured
+        self.should_probe = should_probe
+        self.clients: Dict[str, httpx.AsyncClient] = {}
+        self.schedules: Dict[str, ProbeSchedule] = {p["name"]: ProbeSchedule() for p in providers}
+
+    def add_sink(self, sink: ProbeSink):
+        self.sinks.append(sink)
+
+    def get_client(self, provider: Dict) -> httpx.AsyncClient:
+        if self.client_factory is not None:
+            return self.client_factory(provider)
+        if provider["name"] not in self.clients:
+            self.clients[provider["name"]] = httpx.AsyncClient(base_url=provider["base_url"])
+        return self.clients[provider["name"]]
+
+    @staticmethod
+    def strategy(provider: Dict) -> str:
+        strategy = provider.get("probe", PROBE_STRATEGY)
+        return strategy if strategy in PROBE_STRATEGIES else "completion"
+
+    async def probe_connect(self, provider: Dict, timer: ProbeTimer):
+        """只做 DNS 解析、TCP 连接和 TLS 握手，各阶段分开计时"""
+        url = httpx.URL(provider["base_url"])
+        port = url.port or (443 if url.scheme == "https" else 80)
+        loop = asyncio.get_running_loop()
+        timer.mark("dns.started")
+        addresses = await loop.getaddrinfo(url.host, port, type=socket.SOCK_STREAM)
+        timer.mark("dns.complete")
+        timer.mark("connection.connect_tcp.started")
+        reader, writer = await asyncio.open_connection(addresses[0][4][0], port)
+        timer.mark("connection.connect_tcp.complete")
+        try:
+            if url.scheme == "https":
+                timer.mark("connection.start_tls.started")
+                await writer.start_tls(ssl.create_default_context(), server_hostname=url.host)
+                timer.mark("connection.start_tls.complete")
+        finally:
+            writer.close()
+
+    async def probe_http(self, provider: Dict, api_key: str, timer: ProbeTimer, timeout: float):
+        """GET /models 或者 1 个 token 的补全请求"""
+        client = self.get_client(provider)
+        headers = {"Authorization": f"Bearer {api_key}"}
+        extensions = {"trace": timer.trace}
+        if self.strategy(provider) == "models":
+            response = await client.get("/models", headers=headers, timeout=timeout, extensions=extensions)
+        else:
+            response = await client.post(
+                "/chat/completions",
+                json={
+                    "model": provider["model"],
+                    "messages": [{"role": "user", "content": "ping"}],
+                    "max_tokens": 1
+                },
+                headers=headers,
+                timeout=timeout,
+                extensions=extensions
+            )
+        if response.is_error:
+            raise ProbeError(f"API error: {response.status_code} {response.text[:200]}")
+        if self.strategy(provider) == "completion" and not response.json().get("choices"):
+            raise ProbeError("Invalid API response")
+
+    async def check(self, provider: Dict) -> Dict:
+        """检查单个服务商状态"""
+        status = {
+            "provider": provider["name"],
+            "online": False,
+            "response_time": None,
+            "error": None,
+            "timestamp": int(time.time())
+        }
+        schedule = self.schedules[provider["name"]]
+        api_key = os.getenv(provider["env_var"])
+        if not api_key:
+            status["error"] = MISSING_API_KEY
+            return status
+        timeout = schedule.timeout()
+        timer = ProbeTimer()
+        timed_out = False
+        try:
+            if self.strategy(provider) == "connect":
+                await asyncio.wait_for(self.probe_connect(provider, timer), timeout)
+            else:
+                await asyncio.wait_for(self.probe_http(provider, api_key, timer, timeout), timeout)
+            status["online"] = True
+        except (asyncio.TimeoutError, httpx.TimeoutException):
+            timed_out = True
+            status["error"] = f"Timeout: no response within {timeout:.1f}s"
+        except ProbeError as e:
+            status["error"] = str(e)
+        except (httpx.TransportError, OSError) as e:
+            status["error"] = f"Connection error: {type(e).__name__}: {e}"
+        except Exception as e:
+            status["error"] = f"Unexpected error: {str(e)}"
+        schedule.last_timings = timer.breakdown()
+        if status["online"]:
+            status["response_time"] = schedule.last_timings["total"]
+        schedule.record(status["online"], status["response_time"], timed_out)
+        return status
+
+    async def publish(self, status: Dict):
+        """并发发给所有 sink，某个 sink 出错不影响其他的"""
+        results = await asyncio.gather(*(sink.publish(status) for sink in self.sinks), return_exceptions=True)
+        for sink, result in zip(self.sinks, results):
+            if isinstance(result, Exception):
+                print(f"{type(sink).__name__} failed to publish {status['provider']}: {str(result)}")
+
+    async def probe(self, provider: Dict, force: bool = False) -> Optional[Dict]:
+        """探测一次并分发结果"""
+        if self.skip_unconfigured and not os.getenv(provider["env_var"]):
+            return None
+        if not force and self.should_probe is not None and not self.should_probe(provider):
+            self.schedules[provider["name"]].skipped += 1
+            return None
+        status = await self.check(provider)
+        await self.publish(status)
+        return status
+
+    async def probe_all(self):
+        """并发检查所有服务商，耗时等于最慢的那一个"""
+        await asyncio.gather(*(self.probe(provider) for provider in self.providers))
+
+    def wake(self, name: str):
+        """让某个服务商立刻检查一次（例如熔断到期需要试探）"""
+        schedule = self.schedules.get(name)
+        if schedule is not None:
+            schedule.forced = True
+            schedule.wake.set()
+
+    async def run_schedule(self, provider: Dict):
+        """单个服务商的检查循环
+
+        启动时立即检查一次，否则在第一次检查之前所有服务商都是离线的，网关只能返回 503；
+        之后的间隔由 schedule.interval() 随机浮动，各服务商的探测自然错开。
+        """
+        schedule = self.schedules[provider["name"]]
+        while True:
+            force, schedule.forced = schedule.forced, False
+            schedule.wake.clear()
+            try:
+                await self.probe(provider, force=force)
+            except Exception as e:
+                print(f"Check {provider['name']} failed: {str(e)}")
+            try:
+                await asyncio.wait_for(schedule.wake.wait(), schedule.interval())
+            except asyncio.TimeoutError:
+                pass
+
+    async def run(self):
+        await asyncio.gather(*(self.run_schedule(provider) for provider in self.providers))
+
+    def snapshot(self) -> Dict[str, Dict]:
+        result = {}
+        for provider in self.providers:
+            schedule = self.schedules[provider["name"]]
+            result[provider["name"]] = {
+                "successes": schedule.successes,
+                "failures": schedule.failures,
+                "skipped": schedule.skipped,
+                "last_probe": schedule.last_probe,
+                "strategy": self.strategy(provider),
+                "timeout": round(schedule.timeout(), 2),
+                "timings": schedule.last_timings
+            }
+        return result
+
+    async def close(self):
+        for sink in self.sinks:
+            await sink.close()
+        for client in self.clients.values():
+            await client.aclose()
+        self.clients.clear()
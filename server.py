@@ -1,8 +1,19 @@
-from fastapi import FastAPI, HTTPException, Query, Depends
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, HTTPException, Query, Request, Response
+from fastapi.concurrency import asynccontextmanager
+from fastapi.responses import FileResponse, StreamingResponse
 from pydantic import BaseModel
+from collections import deque
+from typing import AsyncIterator, Deque, Dict, Iterator, List, Optional, Set, Tuple
+import argparse
+import asyncio
 import duckdb
+import glob
 import json
+import os
+import re
+import tempfile
+import time
+import zlib
 
 from fastapi.staticfiles import StaticFiles
 
@@ -14,13 +25,33 @@ class Status(BaseModel):
     error: str | None = None
     timestamp: int
 
-app = FastAPI()
+STATUS_FIELDS = ["provider", "online", "response_time", "error", "timestamp"]
 
-# 挂载静态文件路径 (将其他静态文件放在 static 文件夹中)
-app.mount("/static", StaticFiles(directory="static"), name="static")
+# 数据库文件路径（benchmark 里会指向临时文件）
+DB_PATH = os.getenv("MQTT_STATUS_DB", "mqtt_status.duckdb")
+
+# 写入缓冲配置：攒够 INGEST_BATCH_SIZE 条或者等了 INGEST_FLUSH_INTERVAL 秒就整批写入
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "500"))
+INGEST_FLUSH_INTERVAL = float(os.getenv("INGEST_FLUSH_INTERVAL", "1.0"))
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", "10000"))  # 队列满了 post_status 会等待，形成背压
+
+# 推送配置
+STREAM_SNAPSHOT_SIZE = 100  # 新订阅者先收到的历史条数，和看板原来轮询的 limit 一致
+STREAM_QUEUE_SIZE = 1000  # 单个订阅者最多积压的消息数，超过就断开让它重连拿快照
+STREAM_HEARTBEAT = 15  # 没有新数据时多久发一次心跳（秒），防止代理断开空闲连接
+
+# 内存读缓存配置：最近的数据直接从内存返回，不查数据库
+RECENT_PER_PROVIDER = int(os.getenv("RECENT_PER_PROVIDER", "1000"))  # 每个服务商保留的最近条数
+RECENT_TOTAL = int(os.getenv("RECENT_TOTAL", "1000"))  # 不分服务商查询时保留的最近条数
+
+# 数据保留配置：超过 RETENTION_DAYS 天的原始数据导出成按月分区的 Parquet，再从热表删除
+RETENTION_DAYS = int(os.getenv("RETENTION_DAYS", "30"))
+ARCHIVE_DIR = os.getenv("MQTT_STATUS_ARCHIVE", "archive")
+ARCHIVE_GLOB = os.path.join(ARCHIVE_DIR, "*", "*.parquet")
+MAINTENANCE_INTERVAL = int(os.getenv("MAINTENANCE_INTERVAL", "3600"))  # 维护任务的执行间隔（秒）
 
 # 数据库连接池
-db = duckdb.connect("mqtt_status.duckdb", read_only=False)
+db = duckdb.connect(DB_PATH, read_only=False)
 
 # 初始化数据库表
 def init_database():
@@ -39,51 +70,803 @@ def init_database():
             timestamp INT
         )
         """)
+    # 按服务商 + 时间的范围查询走索引
+    db.sql("CREATE INDEX IF NOT EXISTS idx_api_monitor_provider_ts ON api_monitor (provider, timestamp)")
+    # 预聚合表：每个服务商按 1 分钟 / 1 小时 / 1 天分桶
+    db.sql("""
+    CREATE TABLE IF NOT EXISTS api_monitor_rollup (
+        provider VARCHAR,
+        resolution VARCHAR,
+        bucket INT,
+        count INT,
+        online_count INT,
+        error_count INT,
+        min_latency FLOAT,
+        avg_latency FLOAT,
+        p50_latency FLOAT,
+        p95_latency FLOAT,
+        max_latency FLOAT,
+        PRIMARY KEY (provider, resolution, bucket)
+    )
+    """)
+    # 维护任务的状态（归档水位线、批次号等）
+    db.sql("CREATE TABLE IF NOT EXISTS api_monitor_meta (key VARCHAR PRIMARY KEY, value BIGINT)")
 
 init_database()  # 初始化数据库表
 
-# 定义依赖，管理数据库连接
-async def get_db_conn():
+def get_meta(conn: duckdb.DuckDBPyConnection, key: str, default: Optional[int] = None) -> Optional[int]:
+    row = conn.execute("SELECT value FROM api_monitor_meta WHERE key = ?", [key]).fetchone()
+    return row[0] if row else default
+
+def set_meta(conn: duckdb.DuckDBPyConnection, key: str, value: Optional[int]):
+    if value is None:
+        conn.execute("DELETE FROM api_monitor_meta WHERE key = ?", [key])
+    else:
+        conn.execute("INSERT OR REPLACE INTO api_monitor_meta VALUES (?, ?)", [key, value])
+
+def has_archive() -> bool:
+    return bool(glob.glob(ARCHIVE_GLOB))
+
+def archive_source() -> str:
+    # read_parquet 的路径不能用参数绑定，手动转义单引号
+    path = ARCHIVE_GLOB.replace("'", "''")
+    return f"read_parquet('{path}', hive_partitioning = true)"
+
+def raw_source(conn: duckdb.DuckDBPyConnection, start: int) -> str:
+    """原始数据的来源：涉及已归档的时间段时把 Parquet 也并进来"""
+    if start < get_meta(conn, "archived_before", 0) and has_archive():
+        columns = ", ".join(STATUS_FIELDS)
+        return f"(SELECT {columns} FROM api_monitor UNION ALL SELECT {columns} FROM {archive_source()})"
+    return "api_monitor"
+
+def archive_month(timestamp: int) -> str:
+    # 和导出时 PARTITION_BY 的 month 列一致（UTC）
+    return time.strftime("%Y-%m", time.gmtime(timestamp))
+
+# 预聚合的分辨率：名称 -> 桶宽（秒）
+ROLLUP_RESOLUTIONS = {"1m": 60, "1h": 3600, "1d": 86400}
+SERIES_MAX_POINTS = 1000  # resolution=auto 时每个服务商最多返回的点数
+
+def refresh_rollups(conn: duckdb.DuckDBPyConnection, ranges: dict):
+    """重新计算受影响的桶
+
+    ranges 是 {provider: (最小时间戳, 最大时间戳)}，每种分辨率一条 SQL，只重算覆盖这段时间的桶；
+    新数据基本都落在最近的桶里，所以每次只扫很少的原始数据（走索引）。
+    百分位数没法由小桶合并，所以每个分辨率都直接从原始数据算。
+    迟到的数据如果落在已归档的时间段，连同 Parquet 一起算，避免用残缺的原始数据覆盖旧桶。
+    """
+    if not ranges:
+        return
+    source = raw_source(conn, min(start for start, _ in ranges.values()))
+    for resolution, width in ROLLUP_RESOLUTIONS.items():
+        conditions, params = [], [resolution, width]
+        for provider, (start, end) in ranges.items():
+            conditions.append("(provider = ? AND timestamp >= ? AND timestamp < ?)")
+            params.extend([provider, start - start % width, end - end % width + width])
+        conn.execute(
+            f"""
+            INSERT OR REPLACE INTO api_monitor_rollup
+            SELECT
+                provider,
+                ? AS resolution,
+                CAST(timestamp - timestamp % ? AS INT) AS bucket,
+                count(*),
+                count(*) FILTER (WHERE online),
+                count(*) FILTER (WHERE NOT online),
+                min(response_time),
+                avg(response_time),
+                quantile_cont(response_time, 0.5),
+                quantile_cont(response_time, 0.95),
+                max(response_time)
+            FROM {source}
+            WHERE {' OR '.join(conditions)}
+            GROUP BY provider, bucket
+            """,
+            params
+        )
+
+def rebuild_rollups(conn: duckdb.DuckDBPyConnection):
+    """根据原始数据重建全部预聚合（首次启用或者数据不一致时）"""
+    ranges = {
+        provider: (start, end)
+        for provider, start, end in conn.execute(
+            "SELECT provider, min(timestamp), max(timestamp) FROM api_monitor GROUP BY provider"
+        ).fetchall()
+    }
+    refresh_rollups(conn, ranges)
+
+def init_rollups():
+    # 老数据库第一次启动时预聚合表是空的，补算一遍
+    has_rollups = db.sql("SELECT count(*) FROM api_monitor_rollup").fetchone()[0]
+    has_raw = db.sql("SELECT count(*) FROM api_monitor").fetchone()[0]
+    if has_raw and not has_rollups:
+        rebuild_rollups(db)
+
+init_rollups()
+
+def archive_statuses(conn: duckdb.DuckDBPyConnection, cutoff: int) -> int:
+    """把 cutoff 之前的原始数据导出到 ARCHIVE_DIR/month=YYYY-MM/ 下并从热表删除，返回归档的行数
+
+    导出和删除没法放在同一个事务里：导出前先记下本次的批次号，
+    中途失败时下次沿用同一个批次号重新导出，覆盖上次写了一半的文件，不会重复归档。
+    """
+    seq = get_meta(conn, "archive_pending")
+    if seq is None:
+        if not conn.execute("SELECT count(*) FROM api_monitor WHERE timestamp < ?", [cutoff]).fetchone()[0]:
+            return 0
+        seq = get_meta(conn, "archive_seq", 0) + 1
+        set_meta(conn, "archive_seq", seq)
+        set_meta(conn, "archive_pending", seq)
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    target = ARCHIVE_DIR.replace("'", "''")
+    conn.execute(
+        f"""
+        COPY (
+            SELECT provider, online, response_time, error, timestamp,
+                   strftime(make_timestamp(timestamp::BIGINT * 1000000), '%Y-%m') AS month
+            FROM api_monitor
+            WHERE timestamp < ?
+        ) TO '{target}' (FORMAT parquet, PARTITION_BY (month), OVERWRITE_OR_IGNORE true, FILENAME_PATTERN 'part_{seq}_{{i}}')
+        """,
+        [cutoff]
+    )
     try:
-        yield db
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+        conn.begin()
+        archived = conn.execute("DELETE FROM api_monitor WHERE timestamp < ?", [cutoff]).fetchone()[0]
+        # 1 分钟的桶和原始数据差不多大，随原始数据一起淘汰；1h / 1d 的桶一直保留
+        conn.execute("DELETE FROM api_monitor_rollup WHERE resolution = '1m' AND bucket < ?", [cutoff])
+        set_meta(conn, "archived_before", max(get_meta(conn, "archived_before", 0), cutoff))
+        set_meta(conn, "archive_pending", None)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return archived
 
-# 定义接收监控数据的接口
-@app.post("/api_status", tags=["monitor"])
-async def post_status(status: Status, db_conn=Depends(get_db_conn)):
+# read_json 的列类型，和 api_monitor 表结构一致
+STATUS_JSON_COLUMNS = "{provider: 'VARCHAR', online: 'BOOLEAN', response_time: 'FLOAT', error: 'VARCHAR', timestamp: 'INT'}"
+
+def insert_statuses(conn: duckdb.DuckDBPyConnection, statuses: List[Status]):
+    """一次事务整批写入
+
+    DuckDB 的 Python 接口没有 appender，绑定大量参数又很慢（每行约 0.5ms），
+    所以先把整批数据写成临时 NDJSON 文件，再用 read_json 做一次列式批量导入，
+    并在同一个事务里增量更新预聚合。
+    """
+    if not statuses:
+        return
+    with tempfile.NamedTemporaryFile("w", suffix=".jsonl", encoding="utf-8", delete=False) as batch_file:
+        for status in statuses:
+            batch_file.write(status.model_dump_json())
+            batch_file.write("\n")
+    try:
+        conn.begin()
+        conn.execute(
+            f"""
+            INSERT INTO api_monitor (provider, online, response_time, error, timestamp)
+            SELECT provider, online, response_time, error, timestamp
+            FROM read_json(?, columns = {STATUS_JSON_COLUMNS}, format = 'newline_delimited')
+            """,
+            [batch_file.name]
+        )
+        # 同一个事务里更新受影响的预聚合桶
+        ranges = {}
+        for status in statuses:
+            start, end = ranges.get(status.provider, (status.timestamp, status.timestamp))
+            ranges[status.provider] = (min(start, status.timestamp), max(end, status.timestamp))
+        refresh_rollups(conn, ranges)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        os.remove(batch_file.name)
+
+# monitor.py 写的日志格式：[2025-02-10 10:33:11] Published status: {...}
+LOG_LINE = re.compile(rb"^\[[^\]]*\] Published status: (\{.*\})\s*$")
+IMPORT_BATCH_SIZE = 100000  # 导入日志时每批的行数，内存占用和事务大小都以此为上限
+
+def iter_log_statuses(path: str, offset: int) -> Iterator[Tuple[bytes, int]]:
+    """从 offset 开始逐行读取日志，产出 (状态 JSON, 这一行结束处的偏移量)
+
+    不解析 JSON，交给 read_json 批量处理；末尾没写完的半行不读，留给下次续传。
+    """
+    with open(path, "rb") as log_file:
+        log_file.seek(offset)
+        for line in log_file:
+            if not line.endswith(b"\n"):
+                break
+            offset += len(line)
+            match = LOG_LINE.match(line)
+            if match:
+                yield match.group(1), offset
+
+def import_log_batch(conn: duckdb.DuckDBPyConnection, payloads: List[bytes], offset_key: str, offset: int) -> int:
+    """导入一批日志行，返回新写入的行数
+
+    已经存在的 (provider, timestamp) 跳过（包括已归档的数据），
+    写入、预聚合和续传偏移量在同一个事务里提交，中断后重跑不会重复也不会遗漏。
+    """
+    if not payloads:
+        # 这一段全是无关的行，只推进偏移量
+        set_meta(conn, offset_key, offset)
+        return 0
+    with tempfile.NamedTemporaryFile("wb", suffix=".jsonl", delete=False) as batch_file:
+        for payload in payloads:
+            batch_file.write(payload)
+            batch_file.write(b"\n")
     try:
-        # 构造 SQL 查询和参数
-        query = """
-        INSERT INTO api_monitor (provider, online, response_time, error, timestamp)
-        VALUES (?, ?, ?, ?, ?)
-        """
-        params = (
-            status.provider,
-            status.online,
-            status.response_time,
-            status.error,
-            status.timestamp
+        conn.begin()
+        conn.execute(
+            f"""
+            CREATE OR REPLACE TEMP TABLE import_batch AS
+            SELECT DISTINCT ON (provider, timestamp) provider, online, response_time, error, timestamp
+            FROM read_json(?, columns = {STATUS_JSON_COLUMNS}, format = 'newline_delimited', ignore_errors = true)
+            WHERE provider IS NOT NULL AND timestamp IS NOT NULL
+            """,
+            [batch_file.name]
         )
+        ranges = {
+            provider: (start, end)
+            for provider, start, end in conn.execute(
+                "SELECT provider, min(timestamp), max(timestamp) FROM import_batch GROUP BY provider"
+            ).fetchall()
+        }
+        imported = 0
+        if ranges:
+            source = raw_source(conn, min(start for start, _ in ranges.values()))
+            imported = conn.execute(
+                f"""
+                INSERT INTO api_monitor (provider, online, response_time, error, timestamp)
+                SELECT provider, online, response_time, error, timestamp
+                FROM import_batch AS batch
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM {source} AS existing
+                    WHERE existing.provider = batch.provider AND existing.timestamp = batch.timestamp
+                )
+                """
+            ).fetchone()[0]
+            if imported:
+                refresh_rollups(conn, ranges)
+        set_meta(conn, offset_key, offset)
+        conn.execute("DROP TABLE import_batch")
+        conn.commit()
+        return imported
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        os.remove(batch_file.name)
+
+def log_file_id(path: str) -> Optional[int]:
+    """用第一行的 CRC32 标识日志文件，轮转后的新文件第一行（带时间戳）不同；还没有完整的一行时返回 None"""
+    with open(path, "rb") as log_file:
+        line = log_file.readline()
+    return zlib.crc32(line) if line.endswith(b"\n") else None
+
+def import_log(conn: duckdb.DuckDBPyConnection, path: str, restart: bool = False) -> int:
+    """把 monitor.py 的日志补录进数据库，从上次记录的偏移量续传，返回新写入的行数"""
+    offset_key = f"import_offset:{os.path.abspath(path)}"
+    file_key = f"import_file:{os.path.abspath(path)}"
+    size = os.path.getsize(path)
+    file_id = log_file_id(path)
+    offset = 0 if restart else get_meta(conn, offset_key, 0)
+    if offset > size or file_id != get_meta(conn, file_key):
+        # 不是上次导入的那个文件，或者文件比记录的偏移量还小，说明日志被轮转过，从头再来（重复的行会被跳过）
+        # 先清偏移量再记文件标识，中途退出时下次仍会从头导入
+        offset = 0
+        set_meta(conn, offset_key, 0)
+        set_meta(conn, file_key, file_id)
+    total, payloads, last_offset = 0, [], offset
+    for payload, last_offset in iter_log_statuses(path, offset):
+        payloads.append(payload)
+        if len(payloads) >= IMPORT_BATCH_SIZE:
+            total += import_log_batch(conn, payloads, offset_key, last_offset)
+            payloads = []
+            print(f"{path}: {last_offset}/{size} bytes, {total} statuses imported")
+    if last_offset != offset:
+        total += import_log_batch(conn, payloads, offset_key, last_offset)
+    print(f"{path}: done, {total} statuses imported")
+    return total
+
+class StatusIngestor:
+    """写缓冲：post_status 只把数据放进队列，后台任务按数量或时间整批写入 DuckDB
+
+    写入用独立的 cursor 在线程里执行，不阻塞事件循环，也不和查询抢同一个连接。
+    """
+    def __init__(self, conn: duckdb.DuckDBPyConnection):
+        self.conn = conn.cursor()
+        self.queue: Optional[asyncio.Queue] = None
+        self.task: Optional[asyncio.Task] = None
+        self.batch: List[Status] = []  # 已经从队列取出、正在攒批的数据
+        self.lock = asyncio.Lock()  # 和维护任务互斥，归档时不写入
+        self.rows_written = 0
+        self.batches_written = 0
+        self.failed_rows = 0
+
+    async def start(self):
+        self.queue = asyncio.Queue(maxsize=INGEST_QUEUE_SIZE)
+        self.task = asyncio.create_task(self.run())
+
+    async def put(self, statuses: List[Status]):
+        for status in statuses:
+            await self.queue.put(status)
+
+    async def run(self):
+        while True:
+            self.batch.append(await self.queue.get())
+            deadline = time.monotonic() + INGEST_FLUSH_INTERVAL
+            while len(self.batch) < INGEST_BATCH_SIZE:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    self.batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            batch, self.batch = self.batch, []
+            await self.flush(batch)
+
+    async def flush(self, batch: List[Status]):
+        try:
+            async with self.lock:
+                await asyncio.to_thread(insert_statuses, self.conn, batch)
+            self.rows_written += len(batch)
+            self.batches_written += 1
+        except Exception as e:
+            self.failed_rows += len(batch)
+            print(f"Failed to store {len(batch)} statuses: {str(e)}")
+        finally:
+            for _ in batch:
+                self.queue.task_done()
+
+    async def stop(self):
+        """等队列里和正在攒的批次全部写完，再停掉后台任务"""
+        if self.task is not None:
+            await self.queue.join()
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        self.conn.close()
+
+    def stats(self) -> dict:
+        return {
+            "queued": self.queue.qsize() if self.queue else 0,
+            "rows_written": self.rows_written,
+            "batches_written": self.batches_written,
+            "failed_rows": self.failed_rows
+        }
+
+class StatusHub:
+    """状态推送的发布/订阅中心
+
+    每个订阅者一个有界队列；写入时把新状态放进所有队列，
+    读得太慢的订阅者直接断开，浏览器的 EventSource 会自动重连并重新拿快照。
+    """
+    def __init__(self):
+        self.subscribers: Set[asyncio.Queue] = set()
+        self.published = 0
+        self.dropped = 0
+
+    def subscribe(self) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)
+        self.subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        self.subscribers.discard(queue)
 
-        # 插入数据到 DuckDB，使用 params 参数
-        db_conn.sql(query, params=params)
-        
-        return {"message": "Status received and stored successfully."}
+    def _disconnect(self, queue: asyncio.Queue):
+        # 清空积压的消息，放一个 None 通知它结束
+        while not queue.empty():
+            queue.get_nowait()
+        queue.put_nowait(None)
+        self.subscribers.discard(queue)
+        self.dropped += 1
+
+    def publish(self, statuses: List[Status]):
+        if not self.subscribers:
+            return
+        message = [status.model_dump() for status in statuses]
+        self.published += 1
+        for queue in list(self.subscribers):
+            try:
+                queue.put_nowait(message)
+            except asyncio.QueueFull:
+                self._disconnect(queue)
+
+    def close(self):
+        for queue in list(self.subscribers):
+            self._disconnect(queue)
+
+    def stats(self) -> dict:
+        return {
+            "subscribers": len(self.subscribers),
+            "published": self.published,
+            "dropped": self.dropped
+        }
+
+class StatusCache:
+    """最近状态的内存视图
+
+    写入时和写缓冲一起更新，启动时从数据库预热：
+    latest 是每个服务商的最新一条，recent / providers 是有界环形缓冲。
+    版本号每次写入加一，用作 ETag；同一版本下渲染好的响应体也缓存起来。
+    版本号从启动时的纳秒时间戳开始，重启后不会和上一个进程发出去的 ETag 重复。
+    """
+    def __init__(self):
+        self.latest: Dict[str, dict] = {}
+        self.recent: Deque[dict] = deque(maxlen=RECENT_TOTAL)
+        self.providers: Dict[str, Deque[dict]] = {}
+        self.version = time.time_ns()
+        self.provider_versions: Dict[str, int] = {}
+        self.rendered: Dict[tuple, tuple] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _add(self, row: dict):
+        provider = row["provider"]
+        self.recent.append(row)
+        if provider not in self.providers:
+            self.providers[provider] = deque(maxlen=RECENT_PER_PROVIDER)
+        self.providers[provider].append(row)
+        current = self.latest.get(provider)
+        if current is None or row["timestamp"] >= current["timestamp"]:
+            self.latest[provider] = row
+        self.provider_versions[provider] = self.version
+
+    def warm(self, conn: duckdb.DuckDBPyConnection):
+        # 每个服务商最近 RECENT_PER_PROVIDER 条，以及全局最近 RECENT_TOTAL 条，按时间顺序放进缓冲
+        columns = ", ".join(STATUS_FIELDS)
+        per_provider = conn.execute(f"""
+            SELECT {columns} FROM (
+                SELECT *, row_number() OVER (PARTITION BY provider ORDER BY timestamp DESC) AS rn
+                FROM api_monitor
+            ) WHERE rn <= ? ORDER BY timestamp
+        """, [RECENT_PER_PROVIDER]).fetchall()
+        overall = conn.execute(
+            f"SELECT {columns} FROM api_monitor ORDER BY timestamp DESC LIMIT ?", [RECENT_TOTAL]
+        ).fetchall()
+        self.version += 1
+        for values in per_provider:
+            row = dict(zip(STATUS_FIELDS, values))
+            self.providers.setdefault(row["provider"], deque(maxlen=RECENT_PER_PROVIDER)).append(row)
+            self.latest[row["provider"]] = row
+            self.provider_versions[row["provider"]] = self.version
+        self.recent.extend(dict(zip(STATUS_FIELDS, values)) for values in reversed(overall))
+        self.rendered.clear()
+
+    def update(self, statuses: List[Status]):
+        self.version += 1
+        for status in statuses:
+            self._add(status.model_dump())
+        self.rendered.clear()
+
+    def covers(self, limit: int, provider: Optional[str] = None, archived_before: int = 0) -> bool:
+        # 缓冲没满说明热表里的数据都在内存里；满了则只能回答不超过容量的 limit
+        # 归档过的数据只在 Parquet 里，有归档时超出缓冲条数的 limit 要查库
+        buffer = self.providers.get(provider) if provider else self.recent
+        if archived_before and limit > (len(buffer) if buffer is not None else 0):
+            return False
+        if buffer is None:
+            return True  # 没有这个服务商的数据
+        return limit <= buffer.maxlen or len(buffer) < buffer.maxlen
+
+    def history(self, limit: int, provider: Optional[str] = None) -> List[dict]:
+        buffer = self.providers.get(provider, ()) if provider else self.recent
+        return sorted(buffer, key=lambda row: row["timestamp"], reverse=True)[:max(limit, 0)]
+
+    def etag(self, provider: Optional[str] = None) -> str:
+        version = self.provider_versions.get(provider, 0) if provider else self.version
+        return f'W/"{version}"'
+
+    def render(self, key: tuple, build) -> tuple:
+        # 返回 (etag, 响应体)，同一版本下只序列化一次
+        cached = self.rendered.get(key)
+        if cached is None:
+            self.misses += 1
+            cached = (self.etag(key[1]), json.dumps(build(), ensure_ascii=False).encode("utf-8"))
+            self.rendered[key] = cached
+        else:
+            self.hits += 1
+        return cached
+
+    def stats(self) -> dict:
+        return {
+            "version": self.version,
+            "providers": len(self.latest),
+            "recent": len(self.recent),
+            "rendered": len(self.rendered),
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+class StatusMaintenance:
+    """后台维护：定期归档过期的原始数据，然后 CHECKPOINT / VACUUM 回收空间
+
+    和写缓冲共用一把锁，归档期间新数据留在队列里等待；
+    热表只保留 RETENTION_DAYS 天的数据，大小和查询延迟不会随时间增长。
+    """
+    def __init__(self, conn: duckdb.DuckDBPyConnection, lock: asyncio.Lock):
+        self.conn = conn.cursor()
+        self.lock = lock
+        self.task: Optional[asyncio.Task] = None
+        self.stopping = asyncio.Event()
+        self.runs = 0
+        self.archived_rows = 0
+        self.last_run: Optional[int] = None
+        self.last_error: Optional[str] = None
+        self.needs_checkpoint = False
+
+    async def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        while not self.stopping.is_set():
+            try:
+                async with self.lock:
+                    await asyncio.to_thread(self.run_once)
+                self.last_error = None
+            except Exception as e:
+                self.last_error = str(e)
+                print(f"Maintenance failed: {str(e)}")
+            try:
+                await asyncio.wait_for(self.stopping.wait(), MAINTENANCE_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    def run_once(self):
+        # 截止时间按天对齐（UTC），归档的 1h / 1d 桶都是完整的
+        cutoff = int(time.time()) - RETENTION_DAYS * 86400
+        cutoff -= cutoff % 86400
+        archived = archive_statuses(self.conn, cutoff)
+        self.archived_rows += archived
+        self.runs += 1
+        self.last_run = int(time.time())
+        if archived:
+            self.needs_checkpoint = True
+            print(f"Archived {archived} statuses older than {cutoff}")
+        if self.needs_checkpoint:
+            # 有查询正在进行时 CHECKPOINT 会失败，下一轮再试
+            self.conn.execute("VACUUM ANALYZE api_monitor")
+            self.conn.execute("CHECKPOINT")
+            self.needs_checkpoint = False
+
+    async def stop(self):
+        """等当前这一轮做完再退出，不在导出中途取消"""
+        self.stopping.set()
+        if self.task is not None:
+            await self.task
+        self.conn.close()
+
+    def stats(self) -> dict:
+        return {
+            "retention_days": RETENTION_DAYS,
+            "archived_before": get_meta(db, "archived_before", 0),
+            "archived_rows": self.archived_rows,
+            "runs": self.runs,
+            "last_run": self.last_run,
+            "last_error": self.last_error
+        }
+
+ingestor = StatusIngestor(db)
+hub = StatusHub()
+cache = StatusCache()
+maintenance = StatusMaintenance(db, ingestor.lock)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    cache.warm(db)
+    await ingestor.start()
+    await maintenance.start()
+    yield
+    # 关闭时先结束推送连接和维护任务，再把缓冲区写完
+    hub.close()
+    await maintenance.stop()
+    await ingestor.stop()
+
+app = FastAPI(lifespan=lifespan)
+
+# 挂载静态文件路径 (将其他静态文件放在 static 文件夹中)
+app.mount("/static", StaticFiles(directory="static"), name="static")
+
+# 定义接收监控数据的接口
+# 数据先进写缓冲，最多 INGEST_FLUSH_INTERVAL 秒后落库
+@app.post("/api_status", tags=["monitor"])
+async def post_status(status: Status):
+    try:
+        await ingestor.put([status])
+        cache.update([status])
+        hub.publish([status])
+        return {"message": "Status received and queued for storage."}
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Failed to store status: {str(e)}")
 
+# 批量接收监控数据
+@app.post("/api_status/batch", tags=["monitor"])
+async def post_status_batch(statuses: List[Status]):
+    try:
+        await ingestor.put(statuses)
+        cache.update(statuses)
+        hub.publish(statuses)
+        return {"message": f"{len(statuses)} statuses received and queued for storage."}
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Failed to store statuses: {str(e)}")
+
+# 写缓冲和推送的状态
+@app.get("/api_status/ingest", tags=["monitor"])
+async def get_ingest_stats():
+    return {**ingestor.stats(), "stream": hub.stats(), "cache": cache.stats()}
+
+# 归档和维护任务的状态
+@app.get("/api_status/maintenance", tags=["monitor"])
+async def get_maintenance_stats():
+    return maintenance.stats()
+
+def cached_json(request: Request, key: tuple, build) -> Response:
+    # 内容没变（If-None-Match 命中）直接返回 304，不再发送响应体
+    etag, body = cache.render(key, build)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+# 每个服务商的最新状态，直接从内存返回
+@app.get("/api_status/latest", tags=["monitor"])
+async def get_latest_status(request: Request):
+    return cached_json(request, ("latest", None), lambda: sorted(cache.latest.values(), key=lambda row: row["provider"]))
+
+def sse_event(event: str, data) -> bytes:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n".encode("utf-8")
+
+# 状态推送接口（Server-Sent Events）：先发一份快照，之后只推新数据
+@app.get("/api_status/stream", tags=["monitor"])
+async def stream_status():
+    # 先订阅再取快照，快照和增量之间不会漏数据（可能有少量重复）
+    queue = hub.subscribe()
+
+    async def events() -> AsyncIterator[bytes]:
+        try:
+            snapshot = cache.history(STREAM_SNAPSHOT_SIZE)
+            yield sse_event("snapshot", snapshot)
+            while True:
+                try:
+                    message = await asyncio.wait_for(queue.get(), STREAM_HEARTBEAT)
+                except asyncio.TimeoutError:
+                    yield b": keep-alive\n\n"
+                    continue
+                if message is None:
+                    return
+                yield sse_event("status", message)
+        finally:
+            hub.unsubscribe(queue)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 # 定义查询历史监控数据的接口
 @app.get("/api_status/history", tags=["monitor"])
-async def get_status_history(limit: int = Query(100, description="Maximum number of records to return")):
+async def get_status_history(
+    request: Request,
+    limit: int = Query(100, description="Maximum number of records to return"),
+    provider: Optional[str] = Query(None, description="Only return records of this provider"),
+    from_ts: Optional[int] = Query(None, alias="from", description="Start timestamp (inclusive, epoch seconds)"),
+    to_ts: Optional[int] = Query(None, alias="to", description="End timestamp (exclusive, epoch seconds)")
+):
+    # 不带时间范围、且条数在内存缓冲范围内时直接从内存返回
+    if from_ts is None and to_ts is None and cache.covers(limit, provider, get_meta(db, "archived_before", 0)):
+        return cached_json(request, ("history", provider, limit), lambda: cache.history(limit, provider))
     try:
-        # 查询历史数据
-        result = db.sql("SELECT * FROM api_monitor ORDER BY timestamp DESC LIMIT ?", params=(limit,))
+        # 查询历史数据，过滤条件都在数据库里做
+        conditions, params = [], []
+        if provider:
+            conditions.append("provider = ?")
+            params.append(provider)
+        if from_ts is not None:
+            conditions.append("timestamp >= ?")
+            params.append(from_ts)
+        if to_ts is not None:
+            conditions.append("timestamp < ?")
+            params.append(to_ts)
+        columns = ", ".join(STATUS_FIELDS)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        rows = db.sql(
+            f"SELECT {columns} FROM api_monitor {where} ORDER BY timestamp DESC LIMIT ?",
+            params=(*params, limit)
+        ).fetchall()
+        # 热表不够 limit 条、或者已经查到归档水位线以下时，再去读归档的 Parquet
+        archived_before = get_meta(db, "archived_before", 0)
+        if (
+            (len(rows) < limit or rows[-1][4] < archived_before)
+            and (from_ts is None or from_ts < archived_before)
+            and has_archive()
+        ):
+            # 按月份分区裁剪，只读涉及的 Parquet 文件
+            if from_ts is not None:
+                conditions.append("month >= ?")
+                params.append(archive_month(from_ts))
+            if to_ts is not None:
+                conditions.append("month <= ?")
+                params.append(archive_month(to_ts - 1))
+            archived = db.sql(
+                f"SELECT {columns} FROM {archive_source()} WHERE {' AND '.join(conditions) or 'true'} ORDER BY timestamp DESC LIMIT ?",
+                params=(*params, limit)
+            ).fetchall()
+            rows = sorted(rows + archived, key=lambda row: row[4], reverse=True)[:limit]
         # 将结果转换为 JSON 格式的列表
-        return [dict(zip(["provider", "online", "response_time", "error", "timestamp"], row)) for row in result.fetchall()]
+        return [dict(zip(STATUS_FIELDS, row)) for row in rows]
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to retrieve status history: {str(e)}")
 
+# 定义查询预聚合时间序列的接口
+@app.get("/api_status/series", tags=["monitor"])
+async def get_status_series(
+    provider: Optional[str] = Query(None, description="Provider name, all providers if omitted"),
+    from_ts: Optional[int] = Query(None, alias="from", description="Start timestamp (inclusive, epoch seconds), default 24h ago"),
+    to_ts: Optional[int] = Query(None, alias="to", description="End timestamp (exclusive, epoch seconds), default now"),
+    resolution: str = Query("auto", description="1m, 1h, 1d or auto")
+):
+    to_ts = to_ts if to_ts is not None else int(time.time())
+    from_ts = from_ts if from_ts is not None else to_ts - 86400
+    if from_ts >= to_ts:
+        raise HTTPException(status_code=400, detail="'from' must be earlier than 'to'")
+    if resolution == "auto":
+        # 选能让点数不超过 SERIES_MAX_POINTS 的最细分辨率；1m 的桶只保留到归档水位线
+        archived_before = get_meta(db, "archived_before", 0)
+        resolution = next(
+            (
+                name for name, width in ROLLUP_RESOLUTIONS.items()
+                if (to_ts - from_ts) / width <= SERIES_MAX_POINTS and not (name == "1m" and from_ts < archived_before)
+            ),
+            "1d"
+        )
+    if resolution not in ROLLUP_RESOLUTIONS:
+        raise HTTPException(status_code=400, detail=f"Unsupported resolution: {resolution}")
+    try:
+        width = ROLLUP_RESOLUTIONS[resolution]
+        conditions = ["resolution = ?", "bucket >= ?", "bucket < ?"]
+        params = [resolution, from_ts - from_ts % width, to_ts]
+        if provider:
+            conditions.append("provider = ?")
+            params.append(provider)
+        result = db.sql(
+            f"""
+            SELECT provider, bucket, count, online_count, error_count,
+                   min_latency, avg_latency, p50_latency, p95_latency, max_latency
+            FROM api_monitor_rollup
+            WHERE {' AND '.join(conditions)}
+            ORDER BY provider, bucket
+            """,
+            params=params
+        )
+        return {
+            "resolution": resolution,
+            "from": from_ts,
+            "to": to_ts,
+            "points": [
+                {
+                    "provider": row[0],
+                    "bucket": row[1],
+                    "count": row[2],
+                    "availability": round(row[3] / row[2], 4) if row[2] else None,
+                    "error_count": row[4],
+                    "min": row[5],
+                    "avg": row[6],
+                    "p50": row[7],
+                    "p95": row[8],
+                    "max": row[9]
+                }
+                for row in result.fetchall()
+            ]
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to retrieve status series: {str(e)}")
+
 
 # 处理根路径请求，返回 index.html
 @app.get("/")
@@ -91,6 +874,18 @@ async def read_index():
     return FileResponse('static/index.html')
 
 # 启动 FastAPI 服务器
+# python server.py import-log mqtt_status.log.1 mqtt_status.log  补录日志（需要先停掉服务，DuckDB 文件只能被一个进程写）
 if __name__ == "__main__":
-    import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command")
+    import_parser = commands.add_parser("import-log", help="Import mqtt_status.log lines that are missing from the database")
+    import_parser.add_argument("paths", nargs="+", help="Log files, oldest first (e.g. mqtt_status.log.1 mqtt_status.log)")
+    import_parser.add_argument("--restart", action="store_true", help="Ignore the stored offset and read from the beginning")
+    args = parser.parse_args()
+    if args.command == "import-log":
+        for path in args.paths:
+            import_log(db, path, restart=args.restart)
+        db.execute("CHECKPOINT")
+    else:
+        import uvicorn
+        uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
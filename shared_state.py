@@ -0,0 +1,196 @@
+"""多进程网关的进程间共享：worker 之间广播路由统计，并选出唯一负责探测的 worker
+
+每个 worker 在 GATEWAY_SHARED_DIR 下绑定一个 Unix 数据报 socket（worker-<pid>.sock），
+本地记录的请求结果和探测结果攒成小批，每 FLUSH_INTERVAL 秒发给目录里其他所有 worker；
+收到的事件按同样的方式记进自己的 RoutingManager，所有 worker 的在线状态、延迟窗口和熔断状态因此保持一致。
+不需要单独的协调进程：发不通的 socket 说明那个 worker 已经退出，直接清理掉；
+新 worker 启动时广播一个 hello，负责探测的 worker 把最近的探测结果发给它，不用等下一轮探测。
+
+探测由拿到 prober.lock 排他 flock 的 worker 负责，进程退出时锁由内核释放，其他 worker 定期重试接手。
+只支持 POSIX（Linux / macOS）。
+"""
+import os
+import glob
+import json
+import math
+import socket
+import asyncio
+import tempfile
+from typing import Any, Callable, List, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+WORKERS = max(1, int(os.getenv("GATEWAY_WORKERS", "1")))
+SHARED_DIR = os.getenv("GATEWAY_SHARED_DIR")  # 多 worker 时由 gateway.py 的 __main__ 设置
+FLUSH_INTERVAL = 0.05  # 事件攒批发送的间隔（秒）
+FLUSH_BATCH = 500  # 攒够这么多事件不等间隔直接发
+PEER_REFRESH = 1.0  # 多久重新扫描一次目录里的 worker
+LEADER_RETRY = 5.0  # 没抢到探测锁时多久再试一次
+MAX_DATAGRAM = 256 * 1024
+
+
+def per_worker(limit: Optional[int]) -> Optional[int]:
+    """服务商和客户端的限额按 worker 数平分（请求由内核大致均匀地分给各个 worker）；None / 0 表示不限，原样返回"""
+    if not limit or WORKERS == 1:
+        return limit
+    return max(1, math.ceil(limit / WORKERS))
+
+
+def prepare_shared_dir(port: int) -> str:
+    """创建共享目录，清掉上次运行留下的 socket 文件，并通过环境变量传给 worker 进程"""
+    if fcntl is None:
+        raise RuntimeError("多 worker 模式只支持 POSIX 系统")
+    directory = SHARED_DIR or os.path.join(tempfile.gettempdir(), f"ai_gateway_{port}")
+    os.makedirs(directory, exist_ok=True)
+    for path in glob.glob(os.path.join(directory, "worker-*.sock")):
+        os.unlink(path)
+    os.environ["GATEWAY_SHARED_DIR"] = directory
+    return directory
+
+
+class WorkerBus:
+    """worker 之间的事件广播
+
+    事件是可以 JSON 编码的列表，第一个元素是事件类型；handler(event, sender) 处理收到的每个事件，
+    sender 是发送方 socket 的路径，可以用 send_to 单独回复。
+    """
+    def __init__(self, directory: str, handler: Callable[[List[Any], str], None]):
+        self.directory = directory
+        self.handler = handler
+        self.path = os.path.join(directory, f"worker-{os.getpid()}.sock")
+        self.sock: Optional[socket.socket] = None
+        self.peers: List[str] = []
+        self.peers_refreshed = 0.0
+        self.pending: List[List[Any]] = []
+        self.flush_task: Optional[asyncio.Task] = None
+        self.sent = 0
+        self.received = 0
+        self.dropped = 0
+
+    async def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(self.path)
+        self.sock.setblocking(False)
+        asyncio.get_running_loop().add_reader(self.sock.fileno(), self._on_readable)
+        self.flush_task = asyncio.create_task(self._run_flush())
+
+    async def close(self):
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            try:
+                await self.flush_task
+            except asyncio.CancelledError:
+                pass
+        self.flush()
+        if self.sock is not None:
+            asyncio.get_running_loop().remove_reader(self.sock.fileno())
+            self.sock.close()
+            self.sock = None
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def publish(self, event: List[Any]):
+        self.pending.append(event)
+        if len(self.pending) >= FLUSH_BATCH:
+            self.flush()
+
+    def send_to(self, peer: str, events: List[List[Any]]):
+        if events:
+            self._send(peer, json.dumps(events, ensure_ascii=False).encode("utf-8"))
+
+    def flush(self):
+        if not self.pending or self.sock is None:
+            return
+        data = json.dumps(self.pending, ensure_ascii=False).encode("utf-8")
+        self.pending = []
+        loop_time = asyncio.get_running_loop().time()
+        if loop_time - self.peers_refreshed >= PEER_REFRESH:
+            self.peers = [p for p in glob.glob(os.path.join(self.directory, "worker-*.sock")) if p != self.path]
+            self.peers_refreshed = loop_time
+        for peer in list(self.peers):
+            self._send(peer, data)
+
+    def _send(self, peer: str, data: bytes):
+        try:
+            self.sock.sendto(data, peer)
+            self.sent += 1
+        except (ConnectionRefusedError, FileNotFoundError):
+            # 对方进程已经退出，socket 文件是残留的
+            if peer in self.peers:
+                self.peers.remove(peer)
+            try:
+                os.unlink(peer)
+            except OSError:
+                pass
+        except OSError:
+            # 对方的接收缓冲满了（BlockingIOError）或者数据太大，这一批丢掉，统计会被后面的事件追平
+            self.dropped += 1
+
+    def _on_readable(self):
+        while self.sock is not None:
+            try:
+                data, sender = self.sock.recvfrom(MAX_DATAGRAM)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                return
+            try:
+                events = json.loads(data)
+            except ValueError:
+                continue
+            self.received += 1
+            for event in events:
+                self.handler(event, sender)
+
+    async def _run_flush(self):
+        while True:
+            await asyncio.sleep(FLUSH_INTERVAL)
+            self.flush()
+
+    def snapshot(self):
+        return {
+            "path": self.path,
+            "peers": len(self.peers),
+            "sent": self.sent,
+            "received": self.received,
+            "dropped": self.dropped
+        }
+
+
+class ProbeLeader:
+    """用 prober.lock 的排他 flock 选出唯一负责探测的 worker
+
+    锁跟着文件描述符走，持有者进程退出（包括被 kill）时由内核释放。
+    """
+    def __init__(self, directory: str):
+        self.path = os.path.join(directory, "prober.lock")
+        self.fd: Optional[int] = None
+
+    @property
+    def is_leader(self) -> bool:
+        return self.fd is not None
+
+    def try_acquire(self) -> bool:
+        if self.fd is not None:
+            return True
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        os.ftruncate(fd, 0)
+        os.write(fd, str(os.getpid()).encode())
+        self.fd = fd
+        return True
+
+    def release(self):
+        if self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
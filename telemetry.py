@@ -0,0 +1,253 @@
+"""网关的可观测性：Prometheus 指标、异步采样日志和可选的链路追踪
+
+指标是进程内的计数器 / 直方图，/metrics 按 Prometheus 文本格式（0.0.4，OpenMetrics 兼容）输出，
+不依赖 prometheus_client；网关是单线程事件循环，更新指标不需要加锁。
+日志走 QueueHandler，请求路径上只是把记录放进队列，由后台线程写 stdout；
+WARNING 以下的记录按 GATEWAY_LOG_SAMPLE 采样，每行一个 JSON。
+追踪需要 GATEWAY_TRACING=1 并安装 opentelemetry（uv add opentelemetry-sdk，
+导出器按 OpenTelemetry 的环境变量配置），否则 span() 什么都不做。
+"""
+import os
+import sys
+import json
+import math
+import queue
+import random
+import logging
+import logging.handlers
+from bisect import bisect_left
+from contextlib import nullcontext
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+LOG_LEVEL = os.getenv("GATEWAY_LOG_LEVEL", "INFO").upper()
+LOG_SAMPLE = float(os.getenv("GATEWAY_LOG_SAMPLE", "0.1"))  # WARNING 以下的日志保留的比例
+TRACING_ENABLED = os.getenv("GATEWAY_TRACING", "0") == "1"
+
+# 直方图分桶（秒）：上游耗时从几十毫秒到几十秒，网关自身的开销在微秒到毫秒级
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30, 60)
+FAST_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Metric:
+    """一个指标族，按标签值区分时间序列"""
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.series: Dict[Tuple[str, ...], Any] = {}
+
+    def _key(self, labels: Dict[str, Any]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labels)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return lines
+
+    def _samples(self) -> List[str]:
+        return [
+            f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}"
+            for key, value in self.series.items()
+        ]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self.series[key] = self.series.get(key, 0) + amount
+
+    def set_total(self, value: float, **labels):
+        """抓取时从别处已有的累计值同步过来"""
+        self.series[self._key(labels)] = value
+
+    def _samples(self) -> List[str]:
+        return [
+            f"{self.name}_total{_format_labels(self.labels, key)} {_format_value(value)}"
+            for key, value in self.series.items()
+        ]
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        self.series[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        series = self.series.get(key)
+        if series is None:
+            # 每个桶的计数（最后一个是 +Inf）、总和
+            series = self.series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def _samples(self) -> List[str]:
+        lines = []
+        for key, (counts, total) in self.series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    """收集指标并渲染成 /metrics 的文本"""
+    def __init__(self):
+        self.metrics: List[Metric] = []
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, help, labels))
+
+    def gauge(self, name: str, help: str, labels: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge(name, help, labels))
+
+    def histogram(self, name: str, help: str, labels: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help, labels, buckets))
+
+    def _register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+class SampleFilter(logging.Filter):
+    """WARNING 以下的记录按比例随机保留，WARNING 及以上全部保留"""
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno >= logging.WARNING or random.random() < self.rate
+
+
+class JsonFormatter(logging.Formatter):
+    """一行一个 JSON：时间、级别、事件名，加上 log_event 传进来的字段"""
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname.lower(),
+            "event": record.getMessage()
+        }
+        entry.update(getattr(record, "fields", {}))
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class LogListener:
+    """后台线程把队列里的日志写到 stdout，start / stop 放在 lifespan 里"""
+    def __init__(self, log_queue: queue.Queue):
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(JsonFormatter())
+        self.listener = logging.handlers.QueueListener(log_queue, handler)
+        self.running = False
+
+    def start(self):
+        if not self.running:
+            self.listener.start()
+            self.running = True
+
+    def stop(self):
+        # stop 会先写完队列里剩下的记录
+        if self.running:
+            self.listener.stop()
+            self.running = False
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # 格式化留给后台线程做，请求路径上只入队
+        return record
+
+
+def setup_logging(name: str, level: str = LOG_LEVEL, sample: float = LOG_SAMPLE) -> Tuple[logging.Logger, LogListener]:
+    """返回异步、采样的 logger 和负责写出的 LogListener"""
+    log_queue: queue.Queue = queue.Queue(-1)
+    handler = _QueueHandler(log_queue)
+    handler.addFilter(SampleFilter(sample))
+    logger = logging.getLogger(name)
+    logger.setLevel(level)
+    logger.handlers = [handler]
+    logger.propagate = False
+    listener = LogListener(log_queue)
+    # lifespan 之外（脚本直接 import）也能看到日志
+    listener.start()
+    return logger, listener
+
+
+def log_event(logger: logging.Logger, level: int, event: str, **fields):
+    """记一条结构化日志，级别没开时直接跳过"""
+    if logger.isEnabledFor(level):
+        logger.log(level, event, extra={"fields": fields})
+
+
+_tracer = None
+if TRACING_ENABLED:
+    try:
+        from opentelemetry import trace
+
+        _tracer = trace.get_tracer("ai_gateway")
+    except ImportError:
+        print("GATEWAY_TRACING=1 但没有安装 opentelemetry，追踪已关闭")
+
+
+def span(name: str, **attributes) -> Any:
+    """开一个追踪 span（with 语句使用），没开追踪时返回空的上下文，as 得到 None"""
+    if _tracer is None:
+        return nullcontext()
+    return _tracer.start_as_current_span(name, attributes={k: v for k, v in attributes.items() if v is not None})
+
+
+def span_event(current: Optional[Any], name: str, **attributes):
+    """给 span 记一个事件（比如一次失败重试），current 为 None 时忽略"""
+    if current is not None:
+        current.add_event(name, {k: v for k, v in attributes.items() if v is not None})
+
+
+def span_set(current: Optional[Any], **attributes):
+    if current is not None:
+        for key, value in attributes.items():
+            if value is not None:
+                current.set_attribute(key, value)